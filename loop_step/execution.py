@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""Support for running the iterations of a loop concurrently in threads."""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadLocalVariables(dict):
+    """Flowchart variables that are private to each worker thread.
+
+    The thread that creates the object sees the shared variables, while each
+    other thread gets its own copy of them the first time that it uses them.
+    Iterations running at the same time therefore do not overwrite each
+    other's loop variable, `_loop_index`, `_loop_indices`, etc.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        self._main_thread = threading.get_ident()
+        self._local = threading.local()
+
+    def _thread_data(self):
+        """The variables for the current thread, or None for the main thread."""
+        if threading.get_ident() == self._main_thread:
+            return None
+        data = getattr(self._local, "data", None)
+        if data is None:
+            # Not dict.copy(self), which would use the overridden methods
+            data = self._local.data = dict(dict.items(self))
+        return data
+
+
+def _per_thread(name):
+    """Create a method of ThreadLocalVariables that uses the thread's variables."""
+    method = getattr(dict, name)
+
+    def wrapper(self, *args, **kwargs):
+        data = self._thread_data()
+        return method(self if data is None else data, *args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in (
+    "__contains__",
+    "__delitem__",
+    "__getitem__",
+    "__iter__",
+    "__len__",
+    "__repr__",
+    "__setitem__",
+    "clear",
+    "copy",
+    "get",
+    "items",
+    "keys",
+    "pop",
+    "popitem",
+    "setdefault",
+    "update",
+    "values",
+):
+    setattr(ThreadLocalVariables, _name, _per_thread(_name))
+del _name
+
+
+class ThreadRoutingHandler(logging.Handler):
+    """Send each log record to the handlers for the thread that created it.
+
+    Each worker thread adds the handlers for its own output, e.g. the
+    iteration.out file of the iteration it is running, and only sees the
+    records that it created itself.
+    """
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level=level)
+        self._handlers = {}
+
+    def add(self, handler, thread=None):
+        """Add a handler for the records from a thread, by default this one."""
+        if thread is None:
+            thread = threading.get_ident()
+        self._handlers[thread] = (*self._handlers.get(thread, ()), handler)
+
+    def remove(self, handler):
+        """Remove a handler, whichever thread it was added for."""
+        for thread, handlers in [*self._handlers.items()]:
+            if handler in handlers:
+                handlers = tuple(h for h in handlers if h is not handler)
+                if len(handlers) == 0:
+                    del self._handlers[thread]
+                else:
+                    self._handlers[thread] = handlers
+
+    def handle(self, record):
+        """Pass the record on to the handlers for its thread.
+
+        This overrides Handler.handle so that the records from different
+        threads are not serialized by the lock of this handler.
+        """
+        rv = self.filter(record)
+        if rv:
+            thread = record.thread
+            if thread is None:
+                thread = threading.get_ident()
+            for handler in self._handlers.get(thread, ()):
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        return rv
+
+    def emit(self, record):
+        """Not used, since handle() passes the records on directly."""
+        pass
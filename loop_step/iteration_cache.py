@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""A content-addressed, on-disk cache of the results of loop iterations."""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import pickle
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def _directory_size(path):
+    """The total size of the files in a directory tree, in bytes."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class IterationCache(object):
+    """A cache of the directories and variables produced by loop iterations.
+
+    Each entry is a directory named by the key of the iteration, containing a
+    copy of the iteration's directory, the variables that the iteration set,
+    and its size. Using an entry touches it, and the least recently used
+    entries are removed when the cache grows beyond its maximum size, until it
+    is below the fraction `low_water` of the maximum.
+
+    The size of the cache is found once, and then kept up to date as entries
+    are added, so the entries are only scanned again when the cache is full.
+    Entries added by other processes are found when it is next scanned.
+
+    Parameters
+    ----------
+    directory : str or pathlib.Path
+        The directory for the cache.
+    max_size : float
+        The maximum size of the cache, in bytes.
+    """
+
+    low_water = 0.9
+
+    def __init__(self, directory, max_size):
+        self.path = Path(directory).expanduser()
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._size = None
+
+    @staticmethod
+    def make_key(*args):
+        """Create a key by hashing the arguments.
+
+        Parameters
+        ----------
+        args : any
+            Values that together identify the iteration. They are serialized as
+            JSON, using the repr() of values that JSON cannot handle.
+
+        Returns
+        -------
+        str
+            The hexadecimal hash.
+        """
+        text = json.dumps(args, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key, destination):
+        """Restore the results of an iteration from the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the iteration.
+        destination : pathlib.Path
+            The directory for the iteration, which the cached files are copied to.
+
+        Returns
+        -------
+        dict(str, any) or None
+            The variables set by the iteration, or None if it is not in the cache.
+        """
+        entry = self.path / key
+        try:
+            with open(entry / "variables.pkl", "rb") as fd:
+                variables = pickle.load(fd)
+            if any((entry / "files").iterdir()):
+                shutil.copytree(entry / "files", destination, dirs_exist_ok=True)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            if entry.exists():
+                logger.warning(f"Could not use cache entry {entry}: {e}")
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return variables
+
+    def put(self, key, source, variables):
+        """Add the results of an iteration to the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the iteration.
+        source : pathlib.Path
+            The directory of the iteration.
+        variables : dict(str, any)
+            The variables set by the iteration. Any that cannot be pickled are
+            not cached.
+        """
+        entry = self.path / key
+        if entry.exists():
+            return
+
+        picklable = {}
+        for name, value in variables.items():
+            try:
+                pickle.dumps(value)
+            except Exception:
+                logger.info(f"Variable '{name}' cannot be cached.")
+            else:
+                picklable[name] = value
+
+        # Write to a temporary directory and rename, so other processes never
+        # see a partial entry.
+        tmp = self.path / f".{key}.{uuid.uuid4().hex}"
+        try:
+            if Path(source).is_dir():
+                shutil.copytree(source, tmp / "files")
+            else:
+                # The iteration did not write any files
+                (tmp / "files").mkdir(parents=True)
+            with open(tmp / "variables.pkl", "wb") as fd:
+                pickle.dump(picklable, fd)
+            size = _directory_size(tmp)
+            (tmp / "size").write_text(str(size))
+            tmp.rename(entry)
+        except OSError as e:
+            # Another process may have added the same entry in the meantime
+            if not entry.exists():
+                logger.warning(f"Could not add iteration to the cache: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += size
+            if self._size > self.max_size:
+                self.evict()
+
+    @property
+    def size(self):
+        """The size of the cache in bytes, as far as this process knows."""
+        if self._size is None:
+            self.evict()
+        return self._size
+
+    def evict(self):
+        """Remove the least recently used entries if the cache is too large.
+
+        The entries are scanned to find the current size of the cache. If it is
+        larger than the maximum, the least recently used entries are removed
+        until it is below the fraction `low_water` of the maximum, so that the
+        entries are not scanned again for every new entry.
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.path) as it:
+            for item in it:
+                if item.name.startswith(".") or not item.is_dir():
+                    continue
+                try:
+                    size = int((Path(item.path) / "size").read_text())
+                    mtime = item.stat().st_mtime
+                except (OSError, ValueError):
+                    continue
+                entries.append((mtime, size, item.path))
+                total += size
+
+        if total > self.max_size:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.low_water * self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+        self._size = total
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""Handling the output of the iterations of a loop."""
+
+import logging
+import logging.handlers
+import os
+from pathlib import Path
+import queue
+import shutil
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class IterationOutputHandler(logging.StreamHandler):
+    """A handler writing to the output file of the current iteration.
+
+    The handler is created once for a loop and switched to the file for each
+    iteration with retarget(), rather than creating a new handler and adding
+    it to the logger for every iteration. Writes are buffered, and only flushed
+    when flush() is called, e.g. at the end of the iteration, or the handler
+    is retargeted or closed.
+
+    Parameters
+    ----------
+    level : int
+        The level of the handler.
+    buffer_size : int
+        The size of the buffer for the file, in bytes.
+    """
+
+    def __init__(self, level=logging.NOTSET, buffer_size=65536):
+        super().__init__()
+        self.setLevel(level)
+        self.setFormatter(logging.Formatter(fmt="{message:s}", style="{"))
+        self.buffer_size = buffer_size
+        self.path = None
+        self.stream = None
+
+    def __repr__(self):
+        level = logging.getLevelName(self.level)
+        return f"<{self.__class__.__name__} {self.path} ({level})>"
+
+    def retarget(self, path, mode="w"):
+        """Write to a new file, by default replacing any existing file.
+
+        Parameters
+        ----------
+        path : pathlib.Path or None
+            The file, or None to stop writing.
+        mode : str
+            "w" to replace the file, or "a" to add to it.
+        """
+        self.acquire()
+        try:
+            self._close_stream()
+            if path is not None:
+                self.stream = open(
+                    path, mode, buffering=self.buffer_size, encoding="utf-8"
+                )
+            self.path = path
+        finally:
+            self.release()
+
+    def _close_stream(self):
+        """Flush and close the current file, if any."""
+        if self.stream is not None:
+            try:
+                self.stream.flush()
+            finally:
+                self.stream.close()
+                self.stream = None
+
+    def emit(self, record):
+        """Write the record to the buffer of the file, without flushing."""
+        if self.stream is None:
+            return
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Write any buffered output to the file."""
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        """Close the file and the handler."""
+        self.acquire()
+        try:
+            self._close_stream()
+            self.path = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+class _ControlledListener(logging.handlers.QueueListener):
+    """A queue listener that also runs functions placed in the queue.
+
+    The functions are run in order with the records, so e.g. switching the
+    file for the output of an iteration happens after the earlier records have
+    been written.
+    """
+
+    def handle(self, record):
+        control = getattr(record, "loop_control", None)
+        if control is None:
+            super().handle(record)
+        else:
+            function, args = control
+            try:
+                function(*args)
+            except Exception:
+                logger.exception(f"Error handling the output: {function}")
+
+
+class AsynchronousOutput(object):
+    """Write the output of a logger in a background thread.
+
+    The handlers of the logger are moved to a listener running in a background
+    thread, and replaced by a single handler that puts the records in a queue,
+    so that logging does not wait for the files to be written. Changes to the
+    handlers are also put in the queue, so they happen in order with the
+    records.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        The logger, e.g. the printer for the job.
+    """
+
+    # The running instances, by logger, so that nested loops share one.
+    _active = {}
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.listener = _ControlledListener(self.queue, respect_handler_level=True)
+
+    @classmethod
+    def active(cls, logger):
+        """The instance writing the output for the logger, if any."""
+        return cls._active.get(logger.name)
+
+    def start(self):
+        """Move the handlers of the logger to the background thread."""
+        self.listener.handlers = (*self.logger.handlers,)
+        for handler in self.listener.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.queue_handler)
+        self.listener.start()
+        AsynchronousOutput._active[self.logger.name] = self
+
+    def stop(self):
+        """Write any queued output and give the handlers back to the logger."""
+        AsynchronousOutput._active.pop(self.logger.name, None)
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            self.logger.addHandler(handler)
+        self.listener.handlers = ()
+
+    def restart(self):
+        """Start a new background thread in a forked process.
+
+        The background thread is not copied when a process forks, so a forked
+        worker needs its own thread and queue for the same handlers.
+        """
+        handlers = self.listener.handlers
+        self.queue = queue.SimpleQueue()
+        self.queue_handler.queue = self.queue
+        self.listener = _ControlledListener(
+            self.queue, *handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def call(self, function, *args):
+        """Call a function in the background thread, after the queued records."""
+        self.queue.put(logging.makeLogRecord({"loop_control": (function, args)}))
+
+    def wait(self):
+        """Wait until all the queued output has been handled."""
+        if self.listener._thread is None:
+            return
+        done = threading.Event()
+        self.call(done.set)
+        done.wait()
+
+    def addHandler(self, handler):
+        """Add a handler, once the queued records have been handled."""
+        self.call(self._add, handler)
+
+    def removeHandler(self, handler):
+        """Remove a handler, once the queued records have been handled."""
+        self.call(self._remove, handler)
+
+    def _add(self, handler):
+        if handler not in self.listener.handlers:
+            self.listener.handlers = (*self.listener.handlers, handler)
+
+    def _remove(self, handler):
+        self.listener.handlers = tuple(
+            h for h in self.listener.handlers if h is not handler
+        )
+
+
+class DirectoryReaper(object):
+    """Remove the directories of skipped iterations in a background thread.
+
+    A directory is first renamed to a hidden 'tombstone' name, which is quick,
+    so that the name can be used again at once. The tombstone is then removed
+    by the background thread, which is started when first needed. Worker
+    processes only rename the directories and leave the removal to the main
+    process, since they may exit before the thread has finished.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def bury(self, path):
+        """Rename a directory to a tombstone name, ready for removal.
+
+        Parameters
+        ----------
+        path : pathlib.Path
+            The directory.
+
+        Returns
+        -------
+        pathlib.Path or None
+            The tombstone, or None if there is no directory.
+        """
+        path = Path(path)
+        if not path.exists():
+            return None
+        tombstone = path.with_name(f".deleted_{path.name}_{uuid.uuid4().hex}")
+        try:
+            path.rename(tombstone)
+        except OSError as e:
+            logger.warning(f"Could not rename {path} for removal: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        return tombstone
+
+    def reap(self, tombstone):
+        """Remove a tombstone in the background.
+
+        Parameters
+        ----------
+        tombstone : pathlib.Path or None
+            The tombstone from bury().
+        """
+        if tombstone is None:
+            return
+        with self._lock:
+            # A thread in the parent of a forked process is not running here.
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.SimpleQueue()
+                self._thread = threading.Thread(
+                    target=self._run, name="loop-reaper", daemon=True
+                )
+                self._pid = os.getpid()
+                self._thread.start()
+            self._queue.put(tombstone)
+
+    def _run(self):
+        while True:
+            tombstone = self._queue.get()
+            if tombstone is None:
+                break
+            shutil.rmtree(tombstone, ignore_errors=True)
+
+    def join(self):
+        """Wait until all the tombstones have been removed."""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""A journal of the iterations of a loop, used to resume partially completed loops."""
+
+import json
+import logging
+from pathlib import Path
+import time
+
+logger = logging.getLogger(__name__)
+
+# The statuses of iterations that do not need to be run again
+complete_statuses = ("success", "continue", "skip")
+
+
+class LoopJournal(object):
+    """The status of the iterations of a loop, kept in the loop's directory.
+
+    Each line of the journal is a small JSON record giving the key of the
+    iteration, its number and directory, its status and timing. The last
+    record for a key is its current status.
+
+    Parameters
+    ----------
+    directory : str or pathlib.Path
+        The directory of the loop.
+    resume : bool
+        Whether to read and extend an existing journal, or start a new one.
+    """
+
+    filename = "loop_journal.jsonl"
+
+    def __init__(self, directory, resume=False):
+        self.path = Path(directory) / self.filename
+        self.entries = {}
+
+        if resume and self.path.exists():
+            self._read()
+            mode = "a"
+        else:
+            mode = "w"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = open(self.path, mode, buffering=1)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def n_complete(self):
+        """The number of iterations that have completed."""
+        return sum(1 for e in self.entries.values() if e["status"] in complete_statuses)
+
+    def _read(self):
+        """Read an existing journal, ignoring a truncated final record."""
+        with open(self.path) as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Ignoring bad line in {self.path}: {line}")
+                    continue
+                self.entries[entry["key"]] = entry
+
+    def close(self):
+        """Close the journal."""
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def directory(self, key):
+        """The directory name used for an iteration, or None if it has not run."""
+        entry = self.entries.get(str(key))
+        return None if entry is None else entry["directory"]
+
+    def is_complete(self, key):
+        """Whether the iteration has completed."""
+        entry = self.entries.get(str(key))
+        return entry is not None and entry["status"] in complete_statuses
+
+    def record(self, key, iteration, directory, status, start=None, elapsed=None):
+        """Record the status of an iteration.
+
+        Parameters
+        ----------
+        key : any
+            The key of the iteration, e.g. the value or table index.
+        iteration : int
+            The number of the iteration, starting at 1.
+        directory : str
+            The directory for the iteration, relative to the loop's directory.
+        status : str
+            The status, e.g. 'running', 'success', or 'error'.
+        start : float
+            The time the iteration started, defaults to now.
+        elapsed : float
+            The time the iteration took, in seconds.
+        """
+        entry = {
+            "key": str(key),
+            "iteration": iteration,
+            "directory": directory,
+            "status": status,
+            "start": round(time.time() if start is None else start, 3),
+        }
+        if elapsed is not None:
+            entry["elapsed"] = round(elapsed, 3)
+        self.entries[entry["key"]] = entry
+        if self._fd is not None:
+            self._fd.write(json.dumps(entry) + "\n")
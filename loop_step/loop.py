@@ -2,19 +2,43 @@
 
 """Non-graphical part of the Loop step in a SEAMM flowchart"""
 
-import fnmatch
+import array
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import io
 import logging
+import multiprocessing
+import numbers
+import os
 from pathlib import Path
+import pickle
 import re
 import shlex
-import shutil
+import sqlite3
 import sys
+import threading
+import time
 import traceback
 
 import psutil
 import pprint
 
 import loop_step
+from loop_step import system_query, table_query
+from loop_step.execution import ThreadLocalVariables, ThreadRoutingHandler
+from loop_step.iteration_cache import IterationCache
+from loop_step.iteration_output import (
+    AsynchronousOutput,
+    DirectoryReaper,
+    IterationOutputHandler,
+)
+from loop_step.journal import LoopJournal
+from loop_step.output_archive import OutputArchive
+from loop_step.sequences import Batches, FileLines, ForRange
+from loop_step.table_file import TableFile
 import seamm
 import seamm_util
 import seamm_util.printing as printing
@@ -24,15 +48,206 @@ logger = logging.getLogger(__name__)
 job = printing.getPrinter()
 printer = printing.getPrinter("loop")
 
-
-def _get_decimal_places(value):
-    """Get the number of decimal places in a float."""
-    if not isinstance(value, float):
-        return 0
-    parts = str(value).split(".")
-    if len(parts) == 2:
-        return len(parts[1])
-    return 0
+# Whether this process is a worker running iterations of a loop, and the state
+# that the forked workers inherit from the main process.
+_in_worker = False
+_worker_state = None
+
+# Objects holding connections inherited from the main process, which the
+# workers must neither use nor close.
+_inherited = []
+
+# SQL statements that change the database
+_write_statement = re.compile(
+    r"\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE
+)
+
+# Variables that belong to the loop in the main process, so are not merged
+# back from the workers.
+_loop_variables = frozenset(("_loop_index", "_loop_indices", "_row", "_rows"))
+
+# The routing of output for worker threads running iterations
+_thread_worker = threading.local()
+
+
+def _same_value(a, b):
+    """Whether two values from a table are the same, treating NaN's as equal."""
+    try:
+        return bool(a == b) or (a != a and b != b)
+    except (TypeError, ValueError):
+        return False
+
+
+def _initialize_worker():
+    """Mark this process as a worker for the iterations of a loop."""
+    global _in_worker
+    _in_worker = True
+
+    # The thread writing output in the background does not survive the fork
+    asynchronous = AsynchronousOutput.active(job)
+    if asynchronous is not None:
+        asynchronous.restart()
+
+    # The handlers for the references open their own connections when needed
+    loop = _worker_state[0]
+    for node in _flowchart_nodes(loop.flowchart):
+        if getattr(node, "_references", None) is not None:
+            _inherited.append(node._references)
+            node._references = None
+
+
+def _flowchart_nodes(flowchart):
+    """The nodes in a flowchart, including those in any subflowcharts."""
+    for node in flowchart:
+        yield node
+        subflowchart = getattr(node, "subflowchart", None)
+        if subflowchart is not None:
+            yield from _flowchart_nodes(subflowchart)
+
+
+def _can_fork():
+    """Whether worker processes can be forked on this platform."""
+    # macOS lists fork, but it is not safe with the system libraries
+    return (
+        "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin"
+    )
+
+
+def _shared_database(system_db):
+    """Whether workers can open their own connections to the database."""
+    filename = system_db.filename
+    return (
+        bool(filename) and ":memory:" not in filename and "mode=memory" not in filename
+    )
+
+
+def _database_state(system_db):
+    """What the workers need to open the database, with the current system.
+
+    Any changes not yet committed are committed, so that the workers see them.
+    The workers only read the database, since they cannot safely change it at
+    the same time.
+    """
+    db = system_db.db
+    getattr(db, "commit_now", db.commit)()
+    filename = system_db.filename
+    if filename.startswith("file:"):
+        filename += ("&" if "?" in filename else "?") + "mode=ro"
+    else:
+        filename = Path(filename).resolve().as_uri() + "?mode=ro"
+    system = system_db.system
+    return (type(system_db), filename, None if system is None else system.id)
+
+
+def _open_database(database):
+    """Open the database in a worker, with the same current system.
+
+    Parameters
+    ----------
+    database : tuple
+        The class, read-only URI and current system id from `_database_state`.
+
+    Returns
+    -------
+    molsystem.SystemDB
+        The database.
+    """
+    cls, filename, system_id = database
+    system_db = cls(filename=filename)
+    if system_id is not None:
+        system_db.system = system_id
+    return system_db
+
+
+def _changes_database(statements):
+    """Whether any of the SQL statements change the database."""
+    return any(_write_statement.match(statement) for statement in statements)
+
+
+# The types of objects that are shared, not copied, by the threads
+_handle_types = (
+    sqlite3.Connection,
+    sqlite3.Cursor,
+    io.IOBase,
+    logging.Handler,
+    logging.Logger,
+    type(threading.Lock()),
+    type(threading.RLock()),
+    threading.Thread,
+    concurrent.futures.Executor,
+)
+
+
+def _is_handle(value):
+    """Whether a value is, or directly holds, a connection, file, lock, etc.
+
+    Nodes and flowcharts hold loggers, but are copied.
+    """
+    if isinstance(value, _handle_types):
+        return True
+    if isinstance(value, (seamm.Node, seamm.Flowchart)):
+        return False
+    try:
+        attributes = vars(value)
+    except TypeError:
+        return False
+    return any(isinstance(v, _handle_types) for v in attributes.values())
+
+
+def _database_misuse(exception):
+    """How an iteration in a worker misused the database, or None."""
+    message = str(exception)
+    if isinstance(exception, sqlite3.ProgrammingError) and "thread" in message:
+        return "used a database connection from another thread"
+    if isinstance(exception, sqlite3.OperationalError) and "readonly" in message:
+        return "tried to change the database, which the workers cannot do"
+    return None
+
+
+def _picklable(value):
+    """Whether a value can be sent back from a worker process."""
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+def _in_thread_worker():
+    """Whether the current thread is a worker running iterations of a loop."""
+    return getattr(_thread_worker, "router", None) is not None
+
+
+def _available_cpus():
+    """The number of CPUs that this process can use."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _run_worker_iteration(count, directory=None, item=None):
+    """Run an iteration of the loop in a worker process.
+
+    The item for the iteration is only passed in if the iterations cannot be
+    indexed, e.g. rows streamed from a file.
+    """
+    loop, P, iterations, database = _worker_state
+    if item is None:
+        item = iterations[count - 1]
+    result = loop._run_in_worker(P, count, item, directory, database)
+
+    # Only the variables that can be sent back to the main process
+    variables = result["variables"]
+    for name in [k for k, v in variables.items() if not _picklable(v)]:
+        logger.debug(f"The variable '{name}' cannot be returned from the worker.")
+        del variables[name]
+    return result
+
+
+@functools.lru_cache(maxsize=4096)
+def _safe_variable_name(name):
+    """A safe variable name for a column of a table."""
+    return re.sub(r"[-\\ / \+\*()]", "_", name)
 
 
 class BreakLoop(Exception):
@@ -87,7 +302,29 @@ class Loop(seamm.Node):
         self._loop_value = None
         self._loop_length = None
         self._file_handler = None
+        self._async = None
+        self._edge_nodes = None
+        self._body_ids = None
+        self._body_graph = None
+        self._filenames = None
+        self._filename_counts = None
         self._custom_directory_name = None
+        self._shard = None
+        self._directory_format = None
+        self._index_is_int = False
+        self._journal = None
+        self._key = None
+        self._foreach_cache = None
+        self._values_file = None
+        self._row_layout = None
+        self._row_columns = None
+        self._batch_size = 1
+        self._row_indices = None
+        self._cache = None
+        self._signature = None
+        self._archive = None
+        self._reaper = None
+        self._tombstone = None
 
         super().__init__(
             flowchart=flowchart, title="Loop", extension=extension, logger=logger
@@ -109,6 +346,7 @@ class Loop(seamm.Node):
     @all_options.setter
     def all_options(self, value):
         self._all_options = value
+        self._edge_nodes = None
         # and set for the subnodes
         node = self.loop_node()
         while node is not None and node != self:
@@ -130,16 +368,25 @@ class Loop(seamm.Node):
 
     @property
     def working_path(self):
+        tmp = Path(self.directory)
+        if self._shard is not None:
+            tmp = tmp / self._shard
         if self._custom_directory_name is not None:
-            tmp = Path(self.directory) / self._custom_directory_name
+            tmp = tmp / self._custom_directory_name
         else:
-            tmp = Path(self.directory) / f"iter_{self._loop_value:{self.iter_format}}"
+            tmp = tmp / f"iter_{self._loop_value:{self.iter_format}}"
         return tmp
 
+    @property
+    def iteration_directory(self):
+        """The directory of the iteration relative to the loop's directory."""
+        return self.working_path.relative_to(self.directory).as_posix()
+
     def describe(self):
         """Write out information about what this node will do"""
 
         self.visited = True
+        self._edge_nodes = None
 
         # The description
         job.job(__(self.description_text(), indent=self.indent))
@@ -161,23 +408,22 @@ class Loop(seamm.Node):
         if not P:
             P = self.parameters.values_to_dict()
 
+        self._edge_nodes = None
         text = ""
 
         if P["type"] == "For":
             subtext = "For {variable} from {start} to {end} by {step}\n"
         elif P["type"] == "Foreach":
-            if self.is_expr(P["values"]):
+            if P["values from"] == "lines of file":
+                subtext = "Foreach {variable} in the lines of {values file}\n"
+            elif self.is_expr(P["values"]):
                 subtext = f"Foreach {P['variable']} in {P['values']}\n"
             else:
-                if isinstance(P["values"], str):
-                    values = [str(v) for v in shlex.split(P["values"])]
-                else:
-                    values = [str(v) for v in P["values"]]
+                values = self._foreach_values(P["values"])
                 if len(values) > 5:
-                    last = values[-1]
-                    values = values[0:6]
-                    values.append("...")
-                    values.append(last)
+                    values = [*(str(v) for v in values[0:6]), "...", str(values[-1])]
+                else:
+                    values = [str(v) for v in values]
                 tmp = ", ".join(values)
                 if len(tmp) < 50:
                     subtext = f"Foreach {P['variable']} in {tmp}\n"
@@ -186,11 +432,22 @@ class Loop(seamm.Node):
                     subtext = f"Foreach {P['variable']} in\n   {tmp}\n"
         elif P["type"] == "For rows in table":
             subtext = "For rows in table {table}\n"
+            if P["table source"] == "file":
+                subtext = "For rows in the file {table file}\n"
+            if P["where"] == "Select rows matching criteria":
+                subtext = subtext[:-1] + " where {row criteria}\n"
         elif P["type"] == "For systems in the database":
             subtext = "For system in the database\n"
         else:
             subtext = "Loop type defined by {type}\n"
 
+        if P["type"] == "Foreach" or (
+            P["type"] == "For rows in table" and P["table source"] != "file"
+        ):
+            batch_size = P["batch size"]
+            if self.is_expr(batch_size) or int(batch_size) != 1:
+                subtext = subtext[:-1] + ", in batches of {batch size}\n"
+
         text += self.header + "\n" + __(subtext, **P, indent=4 * " ").__str__()
 
         # Print the body of the loop
@@ -205,6 +462,10 @@ class Loop(seamm.Node):
 
     def run(self):
         """Run a Loop step."""
+        # The flowchart may have been edited since the edges were last found
+        self._edge_nodes = None
+        self._body_ids = None
+
         # If the loop is empty, just go on
         if self.loop_node() is None:
             return self.exit_node()
@@ -222,576 +483,1591 @@ class Loop(seamm.Node):
         # Print out header to the main output
         printer.important(__(self.description_text(P), indent=self.indent))
 
-        # Set up some unchanging variables
-        if P["type"] == "For":
-            # Some local variables need each iteration
+        # Set up the values, rows or configurations to loop over
+        iterations = self._initialize_loop(P)
+
+        # Everything set up from here on is undone at the end, even on errors
+        job_handler = None
+        out_handler = None
+        own_async = False
+        try:
+            if self._loop_length is None:
+                text = "The number of iterations is not known until the end.\n\n"
+            else:
+                text = f"The loop will have {self._loop_length} iterations.\n\n"
+            printer.important(__(text, indent=self.indent + 4 * " "))
+
+            # The journal of the iterations, for resuming the loop
+            self._journal = LoopJournal(self.directory, resume=P["resume"])
+            if P["resume"] and len(self._journal) > 0:
+                printer.important(
+                    __(
+                        f"Resuming the loop: {self._journal.n_complete} iterations "
+                        "completed previously and will be skipped.\n\n",
+                        indent=self.indent + 4 * " ",
+                    )
+                )
+
+            # Remove any redirection of printing.
+            self._close_output_handler()
+
+            # Find the handler for job.out and set the level up
+            for handler in job.handlers:
+                if (
+                    isinstance(handler, logging.FileHandler)
+                    and "job.out" in handler.baseFilename
+                ):
+                    job_handler = handler
+                    job_level = job_handler.level
+                    job_handler.setLevel(printing.JOB)
+                elif isinstance(handler, logging.StreamHandler):
+                    out_handler = handler
+                    out_level = out_handler.level
+                    out_handler.setLevel(printing.JOB)
+
+            execution = P["execution"]
+
+            # Skipped iterations are removed in the background
+            self._reaper = DirectoryReaper()
+
+            # The archive for the small output files of the iterations
+            if P["iteration output"] == "archive":
+                self._archive = OutputArchive(
+                    Path(self.directory) / OutputArchive.filename,
+                    P["largest archived file"] * 1000,
+                )
+
+            # The cache of results of iterations
+            if P["use cache"]:
+                if P["type"] == "For systems in the database":
+                    printer.important(
+                        __(
+                            "Loops over systems in the database cannot use the "
+                            "cache.\n\n",
+                            indent=self.indent + 4 * " ",
+                        )
+                    )
+                else:
+                    self._cache = IterationCache(
+                        P["cache directory"], P["cache size"] * 1.0e9
+                    )
+                    self._signature = self._body_signature()
+
+            # Write the output in a background thread, unless an enclosing loop is.
+            # Forked workers start their own threads, so the main process does not
+            # fork with the thread running.
+            serial = execution == "serial" or _in_worker or _in_thread_worker()
+            self._async = AsynchronousOutput.active(job)
+            if P["asynchronous output"] and self._async is None:
+                if serial or execution == "thread pool":
+                    self._async = AsynchronousOutput(job)
+                    self._async.start()
+                    own_async = True
+
+            # Cycle through the iterations
+            if serial:
+                finished = self._run_serial(P, iterations)
+            else:
+                finished = self._run_pool(P, iterations)
+        finally:
+            # Write any queued output and remove any redirection of printing.
+            if own_async:
+                self._async.stop()
+                self._async = None
+            self._close_output_handler()
+            self._async = None
+            if job_handler is not None:
+                job_handler.setLevel(job_level)
+            if out_handler is not None:
+                out_handler.setLevel(out_level)
+
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+            if self._reaper is not None:
+                self._reaper.join()
+                self._reaper = None
+            self._cache = None
+            self._signature = None
+            self._finalize_loop(P)
+
+        if finished:
+            self.logger.info(f"The {P['type']} loop finished successfully")
+
+        # Return to the normally scheduled step, i.e. fall out of the loop.
+        return self.exit_node()
+
+    def _initialize_loop(self, P):
+        """Work out what the loop iterates over.
+
+        Sets the length of the loop and pushes a new level onto the loop index
+        variables.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+
+        Returns
+        -------
+        [any]
+            The values, table indices or configuration ids for the iterations.
+        """
+        self._loop_count = 0
 
+        if P["type"] == "For":
             # See if loop variables are all integers
             start = P["start"]
             if isinstance(start, str):
                 start = float(start)
-            if start.is_integer():
+            if isinstance(start, float) and start.is_integer():
                 start = int(start)
 
             step = P["step"]
             if isinstance(step, str):
                 step = float(step)
-            if step.is_integer():
+            if isinstance(step, float) and step.is_integer():
                 step = int(step)
 
             end = P["end"]
             if isinstance(end, str):
                 end = float(end)
-            if end.is_integer():
+            if isinstance(end, float) and end.is_integer():
                 end = int(end)
 
-            # If floating point, remove nasty extra digits
-            ndigits = max(
-                _get_decimal_places(start),
-                _get_decimal_places(step),
-                _get_decimal_places(end),
+            self.logger.info(
+                "For {} from {} to {} by {}".format(
+                    P["variable"], P["start"], P["end"], P["step"]
+                )
             )
-            if ndigits > 0:
-                fmt = f".{ndigits}f"
+            self.logger.info("Initializing loop")
+
+            # The values are computed as needed, using exact decimal arithmetic
+            values = ForRange(start, end, step)
+            if values.ndigits > 0:
+                self._directory_format = f".{values.ndigits}f"
             else:
-                fmt = f"0{len(str(end))}d"
+                self._directory_format = f"0{max(len(str(start)), len(str(end)))}d"
+            self._loop_length = len(values)
+            self._push_loop_index(start)
+            return values
+        elif P["type"] == "Foreach":
+            if P["values from"] == "lines of file":
+                # Only the offsets of the lines are kept in memory
+                values = self._values_file = FileLines(P["values file"])
+                self.logger.info(f"Foreach values from the lines of {values.path}")
+            else:
+                values = self._foreach_values(P["values"])
+            if P["batch size"] > 1:
+                self._batch_size = P["batch size"]
+                values = Batches(values, self._batch_size)
+            self._loop_length = len(values)
+            self._push_loop_index()
+            return values
+        elif P["type"] == "For rows in table" and P["table source"] == "file":
+            return self._initialize_table_file(P)
+        elif P["type"] == "For rows in table":
+            self.table_handle = self.get_variable(P["table"])
+            self.table = self.table_handle["table"]
+            self.table_handle["loop index"] = True
 
-            if self._loop_value is None:
-                self.logger.info(
-                    "For {} from {} to {} by {}".format(
-                        P["variable"], P["start"], P["end"], P["step"]
-                    )
+            self.logger.info(
+                "Initialize loop over {} rows in table {}".format(
+                    self.table.shape[0], P["table"]
                 )
-
-                self.logger.info("Initializing loop")
-                self._loop_count = 0
-                self._loop_value = start
-                self.set_variable(P["variable"], self._loop_value)
-
-                # Loop to get length... range doesn't work for nonintegers
-                count = 0
-                tmp = start
-                while tmp <= end:
-                    count += 1
-                    tmp += step
-                    if ndigits > 0:
-                        tmp = round(tmp, ndigits)
-                self._loop_length = count
-                printer.important(
-                    __(
-                        f"The loop will have {self._loop_length} iterations.\n\n",
-                        indent=self.indent + 4 * " ",
-                    )
+            )
+            self._push_loop_index()
+
+            # The selection may be reused if the table has not changed since
+            # the last time, e.g. for a loop nested in another.
+            where = P["where"]
+            if where == "Use all rows":
+                table_indices = self.table.index
+            elif where == "Select rows where column":
+                criteria = (
+                    (
+                        "and",
+                        P["query-column"],
+                        P["query-op"],
+                        str(P["query-value"]),
+                        str(P["query-value2"]),
+                    ),
                 )
-                if self.variable_exists("_loop_indices"):
-                    tmp = self.get_variable("_loop_indices")
-                    self.set_variable("_loop_indices", (*tmp, self._loop_value))
-                else:
-                    self.set_variable("_loop_indices", (self._loop_value,))
-                    self.set_variable("_loop_index", self._loop_value)
-        elif P["type"] == "Foreach":
-            if self._loop_value is None:
-                self._loop_value = 0
-                if isinstance(P["values"], str):
-                    self._loop_length = len(shlex.split(P["values"]))
-                else:
-                    self._loop_length = len(P["values"])
-                printer.important(
-                    __(
-                        f"The loop will have {self._loop_length} iterations.\n\n",
-                        indent=self.indent + 4 * " ",
-                    )
+                table_indices = table_query.cached_selection(
+                    self.table, criteria, functools.partial(self._select_rows, P)
                 )
-                if self.variable_exists("_loop_indices"):
-                    tmp = self.get_variable("_loop_indices")
-                    self.set_variable(
-                        "_loop_indices",
-                        (
-                            *tmp,
-                            None,
-                        ),
-                    )
-                else:
-                    self.set_variable("_loop_indices", (None,))
-        elif P["type"] == "For rows in table":
-            if self._loop_value is None:
-                self.table_handle = self.get_variable(P["table"])
-                self.table = self.table_handle["table"]
-                self.table_handle["loop index"] = True
-
-                self.logger.info(
-                    "Initialize loop over {} rows in table {}".format(
-                        self.table.shape[0], P["table"]
-                    )
+            elif where == "Select rows matching criteria":
+                criteria = tuple(table_query.parse_criteria(P["row criteria"]))
+                table_indices = table_query.cached_selection(
+                    self.table,
+                    criteria,
+                    functools.partial(
+                        table_query.select_rows_matching, self.table, [*criteria]
+                    ),
                 )
-                self._loop_value = 0
-                self._loop_length = self.table.shape[0]
-                if self.variable_exists("_loop_indices"):
-                    tmp = self.get_variable("_loop_indices")
-                    self.set_variable(
-                        "_loop_indices",
-                        (
-                            *tmp,
-                            None,
-                        ),
-                    )
-                else:
-                    self.set_variable("_loop_indices", (None,))
-                where = P["where"]
-                if where == "Use all rows":
-                    table_indices = [*self.table.index]
-                    n_table_indices = len(table_indices)
-                elif where == "Select rows where column":
-                    tmp_col = P["query-column"].lower()
-                    column = None
-                    op = P["query-op"]
-
-                    for col in self.table:
-                        if col.lower() == tmp_col:
-                            column = col
-                    if column is None:
-                        column = P["query-column"]
-                        raise ValueError(
-                            f"Looping over table with criterion on column '{column}': "
-                            "that column does not exist."
-                        )
+            else:
+                raise NotImplementedError(f"Loop cannot handle '{where}'")
+            self._loop_length = len(table_indices)
 
-                    dtype = self.table.dtypes[column]
-                    value = dtype.type(P["query-value"])
-                    value2 = dtype.type(P["query-value2"])
-
-                    # Find the indices
-                    table_indices = []
-                    for i, row_value in zip(self.table.index, self.table[column]):
-                        if op == "==":
-                            if row_value == value:
-                                table_indices.append(i)
-                        elif op == "!=":
-                            if row_value != value:
-                                table_indices.append(i)
-                        elif op == ">":
-                            if row_value > value:
-                                table_indices.append(i)
-                        elif op == ">=":
-                            if row_value >= value:
-                                table_indices.append(i)
-                        elif op == "<":
-                            if row_value < value:
-                                table_indices.append(i)
-                        elif op == "<=":
-                            if row_value <= value:
-                                table_indices.append(i)
-                        elif op == "between":
-                            if row_value >= value and row_value <= value2:
-                                table_indices.append(i)
-                        elif op == "contains":
-                            if value in row_value:
-                                table_indices.append(i)
-                        elif op == "does not contain":
-                            if value not in row_value:
-                                table_indices.append(i)
-                        elif op == "contains regexp":
-                            if re.search(value, row_value) is not None:
-                                table_indices.append(i)
-                        elif op == "does not contain regexp":
-                            if re.search(value, row_value) is None:
-                                table_indices.append(i)
-                        elif op == "is empty":
-                            # Might be numpy.nan, and NaN != NaN hence odd test.
-                            if row_value == "" or row_value != row_value:
-                                table_indices.append(i)
-                        elif op == "is not empty":
-                            if row_value != "" and row_value == row_value:
-                                table_indices.append(i)
-                        else:
-                            raise NotImplementedError(
-                                f"Loop query '{op}' not implemented"
-                            )
-                    n_table_indices = len(table_indices)
-                else:
-                    raise NotImplementedError(f"Loop cannot handle '{where}'")
-                printer.important(
-                    __(
-                        f"The loop will have {n_table_indices} iterations.\n\n",
-                        indent=self.indent + 4 * " ",
-                    )
+            # The columns given to the body of the loop
+            columns = shlex.split(P["columns"])
+            if len(columns) == 0 or columns == ["all"]:
+                self._row_columns = None
+            else:
+                self._row_columns = [
+                    table_query.find_column(self.table, column) for column in columns
+                ]
+
+            if self._loop_length > 0:
+                self._index_is_int = isinstance(table_indices[0], numbers.Integral)
+                if self._index_is_int:
+                    self._directory_format = f"0{len(str(table_indices.max() + 1))}d"
+
+            if P["batch size"] > 1:
+                self._batch_size = P["batch size"]
+                table_indices = Batches(table_indices, self._batch_size)
+                self._loop_length = len(table_indices)
+            return table_indices
+        elif P["type"] == "For systems in the database":
+            configuration_ids = self._select_configurations(P)
+            self._loop_length = len(configuration_ids)
+            self._push_loop_index()
+            return configuration_ids
+        else:
+            raise NotImplementedError(f"Loop cannot handle '{P['type']}' loops")
+
+    def _initialize_table_file(self, P):
+        """Set up a loop over the rows of a table in a file.
+
+        The rows are read a chunk at a time, and the criteria for the rows are
+        applied to each chunk, so the table is never all in memory.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+
+        Returns
+        -------
+        TableFile
+            The row numbers and values of the selected rows.
+        """
+        where = P["where"]
+        if where == "Use all rows":
+            criteria = None
+        elif where == "Select rows where column":
+            criteria = [
+                (
+                    "and",
+                    P["query-column"],
+                    P["query-op"],
+                    P["query-value"],
+                    P["query-value2"],
                 )
+            ]
+        elif where == "Select rows matching criteria":
+            criteria = table_query.parse_criteria(P["row criteria"])
+        else:
+            raise NotImplementedError(f"Loop cannot handle '{where}'")
+
+        columns = shlex.split(P["columns"])
+        if len(columns) == 0 or columns == ["all"]:
+            columns = None
+
+        rows = TableFile(P["table file"], criteria=criteria, columns=columns)
+        if rows.length is None and P["directory layout"] != "flat":
+            # The number of subdirectories depends on the number of rows
+            rows.count()
+        self.logger.info(
+            f"Initialize loop over {rows.length} of the {rows.n_rows} rows in "
+            f"{rows.path}"
+        )
+        self._push_loop_index()
+        self._loop_length = rows.length
+        self._index_is_int = True
+        if rows.n_rows is None:
+            self._directory_format = f"{self.iter_format}d"
+        else:
+            self._directory_format = f"0{len(str(rows.n_rows))}d"
+
+        if P["batch size"] > 1:
+            printer.important(
+                __(
+                    "Rows read from a file are handled one at a time, ignoring the "
+                    "batch size.\n\n",
+                    indent=self.indent + 4 * " ",
+                )
+            )
+        return rows
+
+    def _foreach_values(self, values):
+        """The values for a Foreach loop as an immutable sequence.
+
+        Strings are split like a shell command line. Tuples, ranges and arrays
+        are used as they are, and other iterables such as lists or generators
+        are converted to a tuple. The result is kept for the lifetime of the
+        loop, so the values are only parsed or consumed once.
+
+        Parameters
+        ----------
+        values : str or iterable
+            The values from the parameters.
+
+        Returns
+        -------
+        tuple, range or numpy.ndarray
+            The values.
+        """
+        if self._foreach_cache is not None:
+            original, result = self._foreach_cache
+            if original is values or (isinstance(values, str) and original == values):
+                return result
+
+        if isinstance(values, str):
+            result = tuple(shlex.split(values))
+        elif isinstance(values, (tuple, range)) or hasattr(values, "dtype"):
+            result = values
+        else:
+            result = tuple(values)
+        self._foreach_cache = (values, result)
+        return result
+
+    def _select_rows(self, P):
+        """The indices of the rows of the table that meet the criterion.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+
+        Returns
+        -------
+        pandas.Index
+            The indices of the selected rows.
+        """
+        return table_query.select_rows(
+            self.table,
+            P["query-column"],
+            P["query-op"],
+            P["query-value"],
+            P["query-value2"],
+        )
+
+    def _select_configurations(self, P):
+        """The configurations in the database that meet the criteria.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+
+        Returns
+        -------
+        array.array
+            The ids of the selected configurations.
+        """
+        system_db = self.get_variable("_system_db")
+        ids = system_query.select_configuration_ids(
+            system_db,
+            system_criterion=P["where system name"],
+            system_name=P["system name"],
+            configuration_criterion=P["default configuration"],
+            configuration_name=P["configuration name"],
+        )
+        # Keep just the ids, creating the configuration when it is needed.
+        return array.array("q", ids)
+
+    def _push_loop_index(self, value=None):
+        """Add a level for this loop to the loop index variables."""
+        if self.variable_exists("_loop_indices"):
+            tmp = self.get_variable("_loop_indices")
+            self.set_variable("_loop_indices", (*tmp, value))
+        else:
+            self.set_variable("_loop_indices", (value,))
+            if value is not None:
+                self.set_variable("_loop_index", value)
+
+    def _set_loop_index(self, value):
+        """Set the index of the current iteration in the loop index variables."""
+        tmp = self.get_variable("_loop_indices")
+        self.set_variable("_loop_indices", (*tmp[0:-1], value))
+        self.set_variable("_loop_index", value)
+
+    def _pop_loop_index(self):
+        """Revert the loop index variables to the next outer loop, if there is one,
+        or remove them."""
+        if not self.variable_exists("_loop_indices"):
+            return
+        tmp = self.get_variable("_loop_indices")
+        if len(tmp) <= 1:
+            self.delete_variable("_loop_indices")
+            if self.variable_exists("_loop_index"):
+                self.delete_variable("_loop_index")
+        else:
+            self.set_variable("_loop_indices", tmp[0:-1])
+            self.set_variable("_loop_index", tmp[-2])
+
+    def _body_nodes(self):
+        """The nodes in the body of the loop, including those in nested loops."""
+        node = self.loop_node()
+        while node is not None and node is not self:
+            yield node
+            if isinstance(node, Loop):
+                yield from node._body_nodes()
+                node = node.exit_node()
+            else:
+                node = node.next()
+
+    def _body_signature(self):
+        """The parameters of the nodes in the body, for the cache keys.
 
-                if n_table_indices > 0:
-                    index = table_indices[0]
-                    index_is_int = isinstance(index, int)
-                    if index_is_int:
-                        fmt = f"0{len(str(max(table_indices) + 1))}d"
+        Returns
+        -------
+        dict(str, any)
+            The class and digest of each node, including the version, parameters
+            and any subflowchart, and the names of the variables referenced in
+            the parameters.
+        """
+        nodes = []
+        parameters = []
+        for node in self._body_nodes():
+            nodes.append(
+                (type(node).__module__, type(node).__name__, node.digest(strict=True))
+            )
+            subflowchart = getattr(node, "subflowchart", None)
+            subnodes = () if subflowchart is None else _flowchart_nodes(subflowchart)
+            for step in (node, *subnodes):
+                if getattr(step, "parameters", None) is not None:
+                    parameters.append(str(step.parameters.to_dict()))
+        variables = sorted(set(re.findall(r"\$(\w+)", "\n".join(parameters))))
+        return {"nodes": nodes, "variables": variables}
+
+    def _cache_key(self, P):
+        """The key for the current iteration in the cache.
+
+        The key is the hash of the values for the iteration, the parameters of
+        the nodes in the body of the loop, and the values of the variables that
+        the parameters refer to.
+        """
+        if P["type"] == "For rows in table" and self._batch_size > 1:
+            values = self.get_variable("_rows").to_dict(orient="split")
+        elif P["type"] == "For rows in table":
+            values = self.get_variable("_row")
+        else:
+            values = self.get_variable(P["variable"])
+            if hasattr(values, "tolist"):
+                # Arrays of values, which would otherwise be abbreviated
+                values = values.tolist()
+        referenced = {}
+        for name in self._signature["variables"]:
+            if self.variable_exists(name):
+                referenced[name] = self.get_variable(name)
+        return IterationCache.make_key(
+            P["type"],
+            P["variable"],
+            values,
+            self._signature["nodes"],
+            referenced,
+            self._configuration_signature(),
+        )
+
+    def _configuration_signature(self):
+        """The current system and configuration, for the key in the cache.
+
+        Most steps in the body of a loop work on the current configuration
+        without referring to it in their parameters, so its contents are part
+        of the key.
+        """
+        if not self.variable_exists("_system_db"):
+            return None
+        system = self.get_variable("_system_db").system
+        if system is None:
+            return None
+        configuration = system.configuration
+        if configuration is None:
+            return {"system": system.name}
+        signature = {
+            "system": system.name,
+            "configuration": configuration.name,
+            "charge": configuration.charge,
+            "spin multiplicity": configuration.spin_multiplicity,
+            "periodicity": configuration.periodicity,
+            "symbols": configuration.atoms.symbols,
+            "coordinates": configuration.atoms.get_coordinates(fractionals=False),
+            "bonds": configuration.bonds.get_as_dict(),
+        }
+        if configuration.periodicity != 0:
+            signature["cell"] = configuration.cell.parameters
+        return signature
+
+    def _database_changes(self):
+        """The number of changes made to the system database, or None."""
+        if not self.variable_exists("_system_db"):
+            return None
+        db = getattr(self.get_variable("_system_db"), "db", None)
+        return getattr(db, "total_changes", None)
+
+    def _iteration_key(self, P, count, item):
+        """A key identifying an iteration, that is the same if the job is rerun.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        count : int
+            The number of the iteration, starting at 1.
+        item : any
+            The value, table index or configuration id for the iteration.
+
+        Returns
+        -------
+        str
+            The key for the iteration.
+        """
+        if P["type"] == "Foreach":
+            # The position and value, so that iterations are not skipped for
+            # the wrong values if the list of values is edited.
+            return f"{count}: {item}"
+        elif P["type"] == "For rows in table" and self._batch_size > 1:
+            # The first index of the batch
+            return str(item[0])
+        elif P["type"] == "For rows in table" and P["table source"] == "file":
+            # The row number
+            return str(item[0])
+        else:
+            return str(item)
+
+    def _directory_name(self, name, key=None):
+        """A safe, unique directory name for an iteration.
+
+        If the iteration ran in a previous run of the job that is being resumed,
+        the same directory is used again.
+
+        Parameters
+        ----------
+        name : str
+            The name to base the directory name on.
+        key : str
+            The key of the iteration, defaults to the current iteration.
+        """
+        if self._journal is not None:
+            previous = self._journal.directory(self._key if key is None else key)
+            if previous is not None:
+                # The journal includes any shard, which is found again.
+                return Path(previous).name
+        return self.safe_filename(name)
+
+    def _allocate_directory(self, P, key, item):
+        """The directory name for an iteration that will run in a worker.
+
+        Names that must be made unique, e.g. the names of systems, are given out
+        by the main process, since the workers do not see each other's names.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        key : str
+            The key of the iteration.
+        item : any
+            The value, table index or configuration id for the iteration.
+
+        Returns
+        -------
+        str or None
+            The directory name, or None if the worker can name the directory.
+        """
+        if P["type"] == "For rows in table" and not self._index_is_int:
+            index = item[0] if self._batch_size > 1 else item
+            return self._directory_name(str(index), key)
+        if P["type"] == "For systems in the database":
+            if P["directory name"] == "system name":
+                system_db = self.get_variable("_system_db")
+                name = system_db.get_configuration(item).system.name
+                return self._directory_name(name, key)
+            if P["directory name"] == "configuration name":
+                system_db = self.get_variable("_system_db")
+                name = system_db.get_configuration(item).name
+                return self._directory_name(name, key)
+        return None
+
+    def _set_iteration(self, P, count, item, directory=None):
+        """Set up the variables, directory name, etc. for an iteration.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        count : int
+            The number of the iteration, starting at 1.
+        item : any
+            The value, table index or configuration id for the iteration.
+        directory : str
+            The directory name given out by the main process, if any.
+        """
+        self._loop_count = count
+        self._key = self._iteration_key(P, count, item)
+        self._shard = None
+
+        if P["type"] == "For":
+            self._loop_value = item
+            self.set_variable(P["variable"], self._loop_value)
+
+            # Use the value for the directory names
+            self._custom_directory_name = f"iter_{item:{self._directory_format}}"
+
+            self._set_loop_index(self._loop_value)
+            self.logger.info("    Loop value = {}".format(self._loop_value))
+        elif P["type"] == "Foreach":
+            self._loop_value = count
+            self.set_variable(P["variable"], item)
+
+            self._set_loop_index(self._loop_value)
+            self.logger.info("    Loop value = {}".format(item))
+        elif P["type"] == "For rows in table" and P["table source"] == "file":
+            self._loop_value = count
+
+            # The number of the row in the file, and its values
+            index, row = item
+            self._row_indices = None
+            self._set_loop_index(index)
+            self._custom_directory_name = f"iter_{index + 1:{self._directory_format}}"
+
+            self.set_variable("_row", row)
+            if P["as variables"]:
+                for key, value in row.items():
+                    self.set_variable(_safe_variable_name(key), value)
+            self.logger.debug("   _row = {}".format(row))
+        elif P["type"] == "For rows in table":
+            self._loop_value = count
+            self.logger.debug("  _loop_value = {}".format(self._loop_value))
+
+            # Set up the index variables, using the first row of a batch
+            self._row_indices = item if self._batch_size > 1 else (item,)
+            index = self._row_indices[0]
+            self._set_loop_index(index)
+            self.logger.debug("   --> {}".format(self.get_variable("_loop_indices")))
+            self.table_handle["current index"] = index
+
+            # Name of directory is the index (+1 since tends to be 0 based)
+            if self._index_is_int:
+                fmt = self._directory_format
+                self._custom_directory_name = f"iter_{index + 1:{fmt}}"
+            elif directory is not None:
+                self._custom_directory_name = directory
+            else:
+                self._custom_directory_name = self._directory_name(str(index))
+
+            if self._batch_size > 1:
+                # The rows as a table, and the columns as arrays
+                if self._row_columns is None:
+                    rows = self.table.loc[item]
+                else:
+                    rows = self.table.loc[item, self._row_columns]
+                self.set_variable("_rows", rows)
+                if P["as variables"]:
+                    row = self._row_values(item)
+                    variables = self._row_layout[4]
+                    for key, value in zip(variables, row.values()):
+                        self.set_variable(key, value)
+                self.logger.debug("   _rows = {}".format(rows))
+            else:
+                row = self._row_values(index)
+                self.set_variable("_row", row)
+                if P["as variables"]:
+                    variables = self._row_layout[4]
+                    for key, value in zip(variables, row.values()):
+                        self.set_variable(key, value)
+                self.logger.debug("   _row = {}".format(row))
         elif P["type"] == "For systems in the database":
-            # Get a list of all the matching systems and configurations
+            self._loop_value = count
+
+            # Set the default system and configuration
             system_db = self.get_variable("_system_db")
-            systems = system_db.systems
-
-            # Filter on system names
-            choice = P["where system name"]
-            if choice == "is anything":
-                pass
-            elif choice == "is":
-                name = P["system name"]
-                systems = [s for s in systems if s.name == name]
-            elif choice == "matches":
-                pattern = P["system name"]
-                systems = [s for s in systems if fnmatch.fnmatch(s.name, pattern)]
-            elif choice == "regexp":
-                pattern = P["system name"]
-                systems = [s for s in systems if re.search(pattern, s.name) is not None]
+            configuration = system_db.get_configuration(item)
+            system = configuration.system
+            system_db.system = configuration.system
+            system.configuration = configuration
+
+            if directory is not None:
+                self._custom_directory_name = directory
+            elif P["directory name"] == "system name":
+                self._custom_directory_name = self._directory_name(system.name)
+            elif P["directory name"] == "configuration name":
+                self._custom_directory_name = self._directory_name(configuration.name)
             else:
-                raise RuntimeError(
-                    f"Matching system names by '{choice}' is not supported"
-                )
+                self._custom_directory_name = None
 
-            # Finally, allow only systems that contain the requested configuration
-            choice = P["default configuration"]
-            if choice == "last" or choice == "-1":
-                systems = [s for s in systems if s.n_configurations > 0]
-                configurations = [s.configurations[-1] for s in systems]
-            elif choice == "first" or choice == "1":
-                systems = [s for s in systems if s.n_configurations > 0]
-                configurations = [s.configurations[0] for s in systems]
-            elif choice == "name is":
-                name = P["configuration name"]
-                systems = [s for s in systems if s.n_configurations > 0]
-                configurations = []
-                for s in systems:
-                    for c in s.configurations:
-                        if c.name is name:
-                            configurations.append(c)
-            elif choice == "matches":
-                pattern = P["configuration name"]
-                systems = [s for s in systems if s.n_configurations > 0]
-                configurations = []
-                for s in systems:
-                    for c in s.configurations:
-                        if fnmatch.fnmatch(c.name, pattern):
-                            configurations.append(c)
-            elif choice == "regexp":
-                pattern = P["configuration name"]
-                configurations = []
-                for s in systems:
-                    for c in s.configurations:
-                        if re.search(pattern, c.name) is not None:
-                            configurations.append(c)
-            elif choice == "all":
-                name = P["configuration name"]
-                systems = [s for s in systems if s.n_configurations > 0]
-                configurations = []
-                for s in systems:
-                    configurations.extend(s.configurations)
-
-            if self._loop_value is None:
-                self._loop_value = 0
-                self._loop_length = len(configurations)
-                printer.important(
-                    __(
-                        f"The loop will have {self._loop_length} iterations.\n\n",
-                        indent=self.indent + 4 * " ",
-                    )
-                )
-                if self.variable_exists("_loop_indices"):
-                    tmp = self.get_variable("_loop_indices")
-                    self.set_variable(
-                        "_loop_indices",
-                        (
-                            *tmp,
-                            None,
-                        ),
-                    )
-                else:
-                    self.set_variable("_loop_indices", (None,))
+            self._set_loop_index(self._loop_value)
+            self.logger.info(f"       system = {system.name}")
+            self.logger.info(f"configuration = {configuration.name}")
 
-        # Remove any redirection of printing.
-        if self._file_handler is not None:
-            job.removeHandler(self._file_handler)
-            self._file_handler = None
+        self._shard = self._shard_name(P, count)
 
-        # Find the handler for job.out and set the level up
-        job_handler = None
-        out_handler = None
-        for handler in job.handlers:
-            if (
-                isinstance(handler, logging.FileHandler)
-                and "job.out" in handler.baseFilename
-            ):
-                job_handler = handler
-                job_level = job_handler.level
-                job_handler.setLevel(printing.JOB)
-            elif isinstance(handler, logging.StreamHandler):
-                out_handler = handler
-                out_level = out_handler.level
-                out_handler.setLevel(printing.JOB)
-
-        # Cycle through the iterations
-        next_node = self
-        while next_node is not None:
-            if next_node is self:
-                next_node = self.loop_node()
-
-                if P["type"] == "For":
-                    self._loop_count += 1
-                    if self._loop_count > 1:
-                        self._loop_value += step
-                        if ndigits > 0:
-                            self._loop_value = round(self._loop_value, ndigits)
-
-                    self.set_variable(P["variable"], self._loop_value)
-
-                    # Use the value for the directory names
-                    self._custom_directory_name = f"iter_{self._loop_value:{fmt}}"
-
-                    # Set up the index variables
-                    tmp = self.get_variable("_loop_indices")
-                    self.set_variable(
-                        "_loop_indices",
-                        (
-                            *tmp[0:-1],
-                            self._loop_value,
-                        ),
-                    )
-                    self.set_variable("_loop_index", self._loop_value)
-
-                    # See if we are at the end of loop
-                    if self._loop_count > self._loop_length:
-                        self._loop_value = None
-                        self._custom_directory_name = None
-
-                        # Revert the loop index variables to the next outer loop
-                        # if there is one, or remove them.
-                        tmp = self.get_variable("_loop_indices")
-
-                        if len(tmp) <= 1:
-                            self.delete_variable("_loop_indices")
-                            self.delete_variable("_loop_index")
-                        else:
-                            self.set_variable("_loop_indices", tmp[0:-1])
-                            self.set_variable("_loop_index", tmp[-2])
-
-                        self.logger.info(
-                            f"The loop over {P['variable']} from {start} to "
-                            f"{end} by {step} finished successfully"
-                        )
-                        break
+    def _shard_name(self, P, count):
+        """The subdirectory for the directory of the iteration, if any.
 
-                    self.logger.info("    Loop value = {}".format(self._loop_value))
-                elif P["type"] == "Foreach":
-                    self.logger.debug(f"Foreach {P['variable']} in {P['values']}")
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        count : int
+            The number of the iteration, starting at 1.
 
-                    self._loop_value += 1
+        Returns
+        -------
+        str or None
+            The name of the subdirectory, or None if the layout is flat.
+        """
+        layout = P["directory layout"]
+        if layout == "flat":
+            return None
 
-                    if self._loop_value > self._loop_length:
-                        self._loop_value = None
-                        self._loop_length = None
+        size = max(1, P["shard size"])
+        n_shards = max(1, -(-self._loop_length // size))
+        if layout == "sharded by iteration":
+            shard = (count - 1) // size
+        elif layout == "sharded by name":
+            name = self.working_path.name
+            digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+            shard = int.from_bytes(digest, "big") % n_shards
+        else:
+            raise RuntimeError(f"Don't recognize the directory layout '{layout}'")
+        return f"shard_{shard:0{len(str(n_shards - 1))}d}"
 
-                        # Revert the loop index variables to the next outer loop
-                        # if there is one, or remove them.
-                        tmp = self.get_variable("_loop_indices")
-                        if len(tmp) <= 1:
-                            self.delete_variable("_loop_indices")
-                            self.delete_variable("_loop_index")
-                        else:
-                            self.set_variable("_loop_indices", tmp[0:-1])
-                            self.set_variable("_loop_index", tmp[-2])
-                        self.logger.info("The loop over value finished successfully")
+    def _finalize_loop(self, P):
+        """Clean up the variables, etc. at the end of the loop."""
+        self._loop_value = None
+        self._loop_length = None
+        self._custom_directory_name = None
+        self._shard = None
+        self._foreach_cache = None
+        self._filenames = None
+        self._filename_counts = None
+        if self._values_file is not None:
+            self._values_file.close()
+            self._values_file = None
+
+        self._pop_loop_index()
+
+        if P["type"] == "For rows in table":
+            for name in ("_row", "_rows"):
+                if self.variable_exists(name):
+                    self.delete_variable(name)
+
+        if P["type"] == "For rows in table" and self.table_handle is not None:
+            # and the other info in the table handle
+            self.table_handle["loop index"] = False
+            self._row_layout = None
+            self._row_columns = None
+            self._row_indices = None
+
+            self.table = None
+            self.table_handle = None
+        self._batch_size = 1
+
+    def _add_output_handler(self, handler):
+        """Add a handler for the output of the iterations.
+
+        In a worker thread the handler only gets the output from that thread.
+        """
+        router = getattr(_thread_worker, "router", None)
+        if router is None:
+            self._output_logger().addHandler(handler)
+        else:
+            self._call_output(router.add, handler, threading.get_ident())
 
-                        # return the next node after the loop
-                        break
+    def _remove_output_handler(self, handler):
+        """Remove a handler for the output of the iterations."""
+        router = getattr(_thread_worker, "router", None)
+        if router is None:
+            self._output_logger().removeHandler(handler)
+        else:
+            self._call_output(router.remove, handler)
 
-                    if isinstance(P["values"], str):
-                        value = shlex.split(P["values"])[self._loop_value - 1]
-                    else:
-                        value = P["values"][self._loop_value - 1]
-                    self.set_variable(P["variable"], value)
-
-                    # Set up the index variables
-                    tmp = self.get_variable("_loop_indices")
-                    self.set_variable(
-                        "_loop_indices",
-                        (
-                            *tmp[0:-1],
-                            self._loop_value,
-                        ),
-                    )
-                    self.set_variable("_loop_index", self._loop_value)
-                    self.logger.info("    Loop value = {}".format(value))
-                elif P["type"] == "For rows in table":
-                    self._loop_value += 1
-                    if self._loop_value > n_table_indices:
-                        self._loop_value = None
-
-                        self.delete_variable("_row")
-                        # Revert the loop index variables to the next outer loop
-                        # if there is one, or remove them.
-                        tmp = self.get_variable("_loop_indices")
-                        if len(tmp) <= 1:
-                            self.delete_variable("_loop_indices")
-                            self.delete_variable("_loop_index")
-                        else:
-                            self.set_variable("_loop_indices", tmp[0:-1])
-                            self.set_variable("_loop_index", tmp[-2])
-
-                        # and the other info in the table handle
-                        self.table_handle["loop index"] = False
-
-                        self.table = None
-                        self.table_handle = None
-
-                        self.logger.info(
-                            "The loop over table "
-                            + self.parameters["table"].value
-                            + " finished successfully"
-                        )
+    def _output_logger(self):
+        """The logger for the job's output, or the writer in the background."""
+        return job if self._async is None else self._async
 
-                        # return the next node after the loop
-                        break
+    def _call_output(self, function, *args):
+        """Call a method of an output handler, in order with the output."""
+        if self._async is None:
+            function(*args)
+        else:
+            self._async.call(function, *args)
 
-                    # Set up the index variables
-                    self.logger.debug("  _loop_value = {}".format(self._loop_value))
-                    index = table_indices[self._loop_value - 1]
-                    tmp = self.get_variable("_loop_indices")
-                    self.logger.debug("  _loop_indices = {}".format(tmp))
-                    self.set_variable("_loop_indices", (*tmp[0:-1], index))
-                    self.logger.debug(
-                        "   --> {}".format(self.get_variable("_loop_indices"))
-                    )
-                    self.set_variable("_loop_index", index)
-                    self.table_handle["current index"] = index
-
-                    # Name of directory is the index (+1 since tends to be 0 based)
-                    if index_is_int:
-                        self._custom_directory_name = f"iter_{index + 1:{fmt}}"
-                    else:
-                        self._custom_directory_name = self.safe_filename(str(index))
-
-                    row = {k: self.table.at[index, k] for k in self.table}
-                    self.set_variable("_row", row)
-                    if P["as variables"]:
-                        for key, value in row.items():
-                            # Make a safe variable name
-                            key = re.sub(r"[-\\ / \+\*()]", "_", key)
-                            self.set_variable(key, value)
-                    self.logger.debug("   _row = {}".format(row))
-                elif P["type"] == "For systems in the database":
-                    self._loop_value += 1
-
-                    if self._loop_value > self._loop_length:
-                        self._loop_value = None
-                        self._loop_length = None
-                        self._custom_directory_name = None
-
-                        # Revert the loop index variables to the next outer loop
-                        # if there is one, or remove them.
-                        tmp = self.get_variable("_loop_indices")
-                        if len(tmp) <= 1:
-                            self.delete_variable("_loop_indices")
-                            self.delete_variable("_loop_index")
-                        else:
-                            self.set_variable("_loop_indices", tmp[0:-1])
-                            self.set_variable("_loop_index", tmp[-2])
-                        self.logger.info("The loop over value finished successfully")
-
-                        # return the next node after the loop
-                        break
+    def _close_output_handler(self):
+        """Remove and close the handler for the output of the iterations."""
+        if self._file_handler is not None:
+            self._remove_output_handler(self._file_handler)
+            self._call_output(self._file_handler.close)
+            self._file_handler = None
 
-                    # Set the default system and configuration
-                    configuration = configurations[self._loop_value - 1]
-                    system_db = configuration.system_db
-                    system = configuration.system
-                    system_db.system = configuration.system
-                    system.configuration = configuration
-
-                    if P["directory name"] == "system name":
-                        self._custom_directory_name = self.safe_filename(system.name)
-                    elif P["directory name"] == "configuration name":
-                        self._custom_directory_name = self.safe_filename(
-                            configuration.name
-                        )
-                    else:
-                        self._custom_directory_name = None
-
-                    # Set up the index variables
-                    tmp = self.get_variable("_loop_indices")
-                    self.set_variable(
-                        "_loop_indices",
-                        (
-                            *tmp[0:-1],
-                            self._loop_value,
-                        ),
-                    )
-                    self.set_variable("_loop_index", self._loop_value)
-                    self.logger.info(f"       system = {system.name}")
-                    self.logger.info(f"configuration = {configuration.name}")
+    def _finish_output(self, P):
+        """Make sure the output of the iteration is written.
 
-                # Direct most output to iteration.out
-                # A handler for the file
-                iter_dir = self.working_path
-                iter_dir.mkdir(parents=True, exist_ok=True)
+        The file is closed if it will be archived, and otherwise flushed.
+        """
+        if self._file_handler is None:
+            return
+        if P["iteration output"] == "archive":
+            self._call_output(self._file_handler.retarget, None)
+        else:
+            self._call_output(self._file_handler.flush)
 
-                if self._file_handler is not None:
-                    self._file_handler.close()
-                    job.removeHandler(self._file_handler)
-                path = iter_dir / "iteration.out"
-                path.unlink(missing_ok=True)
-                self._file_handler = logging.FileHandler(path)
-                self._file_handler.setLevel(printing.NORMAL)
-                formatter = logging.Formatter(fmt="{message:s}", style="{")
-                self._file_handler.setFormatter(formatter)
-                job.addHandler(self._file_handler)
-
-                # Add the iteration to the ids so the directory structure is
-                # reasonable
-                self.flowchart.reset_visited()
-                tmp = self.working_path.name
-                self.set_subids((*self._id, tmp))
-
-            # Run through the steps in the loop body
+    def _flush_output(self):
+        """Write any buffered output, e.g. before forking worker processes."""
+        if self._async is None:
+            handlers = job.handlers
+        else:
+            self._async.wait()
+            handlers = self._async.listener.handlers
+        for handler in handlers:
+            handler.flush()
+
+    def _run_serial(self, P, iterations):
+        """Run the iterations of the loop one after another.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        iterations : [any]
+            The values, table indices or configuration ids to loop over.
+
+        Returns
+        -------
+        bool
+            True if all the iterations ran, False if the loop was exited early.
+        """
+        return self._run_numbered(P, enumerate(iterations, start=1))
+
+    def _run_numbered(self, P, numbered):
+        """Run numbered iterations of the loop one after another.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        numbered : iterator of (int, any)
+            The number of each iteration, starting at 1, and the value, table
+            index or configuration id for it.
+
+        Returns
+        -------
+        bool
+            True if all the iterations ran, False if the loop was exited early.
+        """
+        for count, item in numbered:
+            status = self._run_one(P, count, item)
+            if status == "break" or (status == "error" and "exit" in P["errors"]):
+                return False
+        return True
+
+    def _run_one(self, P, count, item, trace=None):
+        """Run one iteration of the loop, recording it in the journal.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        count : int
+            The number of the iteration, starting at 1.
+        item : any
+            The value, table index or configuration id for the iteration.
+        trace : callable, optional
+            A function given each SQL statement run on the database by the
+            body of the loop.
+
+        Returns
+        -------
+        str or None
+            The status of the iteration, or None if it was completed before
+            and the loop is being resumed.
+        """
+        key = self._iteration_key(P, count, item)
+        if P["resume"] and self._journal.is_complete(key):
+            return None
+
+        self._set_iteration(P, count, item)
+        directory = self.iteration_directory
+        t0 = time.time()
+        self._journal.record(key, count, directory, "running", start=t0)
+        try:
+            status = self._run_iteration(P, trace)
+        except Exception:
+            self._journal.record(
+                key, count, directory, "error", start=t0, elapsed=time.time() - t0
+            )
+            raise
+        self._journal.record(
+            key, count, directory, status, start=t0, elapsed=time.time() - t0
+        )
+        if status == "skip":
+            self._release_filename(Path(directory).name)
+        else:
+            self._archive_output(key, directory)
+        return status
+
+    def _run_iteration(self, P, trace=None):
+        """Run the body of the loop for the current iteration.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        trace : callable, optional
+            A function given each SQL statement run on the database by the
+            body of the loop.
+
+        Returns
+        -------
+        str
+            The status of the iteration: "success", "continue", "skip",
+            "break" or "error".
+        """
+        # See if the results of the iteration are in the cache, restoring the
+        # files before the output is directed to iteration.out
+        iter_dir = self.working_path
+        cached = None
+        if self._cache is not None:
+            cache_key = self._cache_key(P)
+            cached = self._cache.get(cache_key, iter_dir)
+
+        # Direct most output to iteration.out, unless the iterations have no
+        # output of their own, in which case the directory is only created if
+        # a step in the body writes to it.
+        if P["iteration output"] != "none":
+            iter_dir.mkdir(parents=True, exist_ok=True)
+
+            # A handler for the file, adding to any restored from the cache
+            if self._file_handler is None:
+                self._file_handler = IterationOutputHandler(level=printing.NORMAL)
+                self._add_output_handler(self._file_handler)
+            mode = "w" if cached is None else "a"
+            self._call_output(
+                self._file_handler.retarget, iter_dir / "iteration.out", mode
+            )
+
+        # Add the iteration to the ids so the directory structure is
+        # reasonable
+        self.set_subids((*self._id, *iter_dir.relative_to(self.directory).parts))
+
+        if cached is not None:
+            rows = cached.pop("_table rows", None)
+            for name, value in cached.items():
+                self.set_variable(name, value)
+            self._update_rows(rows)
+            printer.normal("The results of this iteration came from the cache.")
+            self._finish_output(P)
+            return "success"
+        if self._cache is not None:
+            before = dict(seamm.flowchart_variables._data)
+            changes = self._database_changes()
+
+        # Run through the steps in the loop body
+        if trace is None:
+            status = self._run_body(P, iter_dir)
+        else:
+            connection = self.get_variable("_system_db").db
+            connection.set_trace_callback(trace)
+            try:
+                status = self._run_body(P, iter_dir)
+            finally:
+                connection.set_trace_callback(None)
+
+        self._finish_output(P)
+
+        # Save the results in the cache, unless the body changed the database,
+        # since those changes could not be made again from the cache.
+        if (
+            self._cache is not None
+            and status == "success"
+            and self._database_changes() != changes
+        ):
+            self.logger.info(
+                "The iteration changed the database, so is not put in the cache."
+            )
+        elif self._cache is not None and status == "success":
+            variables = {
+                name: value
+                for name, value in seamm.flowchart_variables._data.items()
+                if name not in before or before[name] is not value
+            }
+            if P["type"] == "For rows in table":
+                variables["_table rows"] = self._current_rows(self._row_indices)
+            if self._async is not None:
+                self._async.wait()
+            self._cache.put(cache_key, iter_dir, variables)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            p = psutil.Process()
+            self.logger.debug(pprint.pformat(p.open_files()))
+
+        self.logger.debug(f"Bottom of loop, status = {status}")
+
+        return status
+
+    def _run_body(self, P, iter_dir):
+        """Run through the steps in the body of the loop.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        iter_dir : pathlib.Path
+            The directory for the iteration.
+
+        Returns
+        -------
+        str
+            The status of the iteration: "success", "continue", "skip",
+            "break" or "error".
+        """
+        status = "success"
+        next_node = self.loop_node()
+        while next_node is not None and next_node is not self:
             try:
                 next_node = next_node.run()
             except DeprecationWarning as e:
                 printer.normal("\nDeprecation warning: " + str(e))
                 traceback.print_exc(file=sys.stderr)
                 traceback.print_exc(file=sys.stdout)
+                status = "continue"
+                break
             except BreakLoop:
+                status = "break"
                 break
             except ContinueLoop:
-                next_node = self
+                status = "continue"
+                break
             except SkipIteration:
-                next_node = self
-                shutil.rmtree(iter_dir, ignore_errors=True)
+                if self._file_handler is not None:
+                    self._call_output(self._file_handler.retarget, None)
+                # Workers leave the removal to the main process.
+                tombstone = self._reaper.bury(iter_dir)
+                if _in_worker:
+                    self._tombstone = tombstone
+                else:
+                    self._reaper.reap(tombstone)
+                status = "skip"
+                break
             except Exception as e:
-                tmp = self.working_path.name
-                printer.job(f"Caught exception in loop iteration {tmp}: {str(e)}")
+                misuse = _database_misuse(e)
+                if misuse is not None and (_in_worker or _in_thread_worker()):
+                    # Not an error in the iteration, so stop whatever the policy
+                    raise RuntimeError(
+                        f"Iteration {iter_dir.name} of the loop {misuse}: {e}. Run "
+                        "the iterations serially instead."
+                    ) from e
+                printer.job(f"Caught exception in loop iteration {iter_dir.name}: {e}")
+                iter_dir.mkdir(parents=True, exist_ok=True)
                 with open(iter_dir / "stderr.out", "a") as fd:
                     traceback.print_exc(file=fd)
-                if "continue" in P["errors"]:
-                    next_node = self
-                elif "exit" in P["errors"]:
+                if "continue" in P["errors"] or "exit" in P["errors"]:
+                    status = "error"
                     break
                 else:
                     raise
+        else:
+            if next_node is None:
+                # The body did not return to the loop, so fall out of it.
+                status = "break"
+
+        return status
+
+    def _run_pool(self, P, iterations):
+        """Run the iterations of the loop in a pool of worker processes or threads.
+
+        The iterations are dispatched to the workers in order, keeping only a few
+        more in flight than there are workers, and the results are collected in
+        the order of the iterations.
+
+        The iterations are run serially if the workers cannot be started, or
+        cannot use what the body of the loop needs. If there is a database the
+        first iteration is run in the main process to see how the body uses
+        it. The workers cannot safely change the database at the same time,
+        and cannot use a database held in memory. Otherwise each iteration
+        opens its own read-only connection to the database.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        iterations : [any]
+            The values, table indices or configuration ids to loop over.
+
+        Returns
+        -------
+        bool
+            True if all the iterations ran, False if the loop was exited early.
+        """
+        global _worker_state
+
+        use_threads = P["execution"] == "thread pool"
+        remaining = enumerate(iterations, start=1)
+        database = None
+        reason = None
+        if not use_threads and not _can_fork():
+            reason = "worker processes cannot be forked on this platform"
+        elif P["type"] == "For systems in the database":
+            reason = (
+                "the loop sets the current configuration in the database, which "
+                "the workers would share"
+            )
+        elif self.variable_exists("_system_db"):
+            # Run the first iteration here, to see how it uses the database
+            statements = []
+            for count, item in remaining:
+                status = self._run_one(P, count, item, trace=statements.append)
+                if status is not None:
+                    break
+            else:
+                return True
+            if status == "break" or (status == "error" and "exit" in P["errors"]):
+                return False
+            system_db = self.get_variable("_system_db")
+            if _changes_database(statements):
+                reason = (
+                    "the body changes the database, which the workers cannot "
+                    "safely do at the same time"
+                )
+            elif _shared_database(system_db):
+                database = _database_state(system_db)
+            elif len(statements) > 0:
+                reason = (
+                    "the body uses the database, which is in memory so cannot be "
+                    "shared"
+                )
+        if reason is not None:
+            printer.important(
+                __(
+                    f"The iterations are run serially, since {reason}.\n\n",
+                    indent=self.indent + 4 * " ",
+                )
+            )
+            return self._run_numbered(P, remaining)
+
+        n_workers = P["number of workers"]
+        if n_workers <= 0:
+            n_workers = _available_cpus()
+        if self._loop_length is not None:
+            n_workers = min(n_workers, max(self._loop_length, 1))
+        kind = "threads" if use_threads else "processes"
+        printer.important(
+            __(
+                f"Running the iterations using {n_workers} worker {kind}.\n\n",
+                indent=self.indent + 4 * " ",
+            )
+        )
 
-            if self.logger.isEnabledFor(logging.DEBUG):
-                p = psutil.Process()
-                self.logger.debug(pprint.pformat(p.open_files()))
+        if use_threads:
+            # Each thread gets its own copy of the variables, the nodes in the
+            # flowchart, and the output of its iterations.
+            variables = seamm.flowchart_variables
+            shared_variables = variables._data
+            variables._data = ThreadLocalVariables(shared_variables)
+            router = ThreadRoutingHandler()
+            self._output_logger().addHandler(router)
+            clones = {}
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=n_workers, thread_name_prefix="loop"
+            )
 
-            self.logger.debug(f"Bottom of loop {next_node}")
+            def submit(count, item, directory):
+                return executor.submit(
+                    self._run_in_thread,
+                    P,
+                    count,
+                    item,
+                    directory,
+                    database,
+                    router,
+                    clones,
+                )
 
-        # Return to the normally scheduled step, i.e. fall out of the loop.
+        else:
+            # The workers are forked, so they inherit the flowchart, this node,
+            # and the variables as they are now.
+            _worker_state = (self, P, iterations, database)
+            # Write any buffered output, so the workers do not inherit it
+            self._flush_output()
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_initialize_worker,
+            )
 
-        # Remove any redirection of printing.
+            # Iterations that cannot be indexed are sent to the workers
+            indexable = isinstance(iterations, collections.abc.Sequence)
+
+            def submit(count, item, directory):
+                if indexable:
+                    return executor.submit(_run_worker_iteration, count, directory)
+                return executor.submit(_run_worker_iteration, count, directory, item)
+
+        pending = collections.deque()
+        finished = True
+        try:
+            while True:
+                while len(pending) < 2 * n_workers:
+                    try:
+                        count, item = next(remaining)
+                    except StopIteration:
+                        break
+                    key = self._iteration_key(P, count, item)
+                    if P["resume"] and self._journal.is_complete(key):
+                        continue
+                    directory = self._allocate_directory(P, key, item)
+                    pending.append((submit(count, item, directory), item, key))
+                if len(pending) == 0:
+                    break
+                future, item, key = pending.popleft()
+                status = self._merge_result(P, future.result(), item, key)
+                if status == "break" or (status == "error" and "exit" in P["errors"]):
+                    finished = False
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            _worker_state = None
+            if use_threads:
+                for clone in clones.values():
+                    if clone._file_handler is not None:
+                        self._call_output(clone._file_handler.close)
+                        clone._file_handler = None
+                self._output_logger().removeHandler(router)
+                # Keep the variables set in the main thread, e.g. by the workers
+                shared_variables.clear()
+                shared_variables.update(dict.items(variables._data))
+                variables._data = shared_variables
+            if database is not None:
+                # End the transaction, to see the changes made by the workers
+                db = self.get_variable("_system_db").db
+                getattr(db, "commit_now", db.commit)()
+
+        return finished
+
+    def _run_in_thread(self, P, count, item, directory, database, router, clones):
+        """Run an iteration of the loop in a worker thread.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        count : int
+            The number of the iteration, starting at 1.
+        item : any
+            The value, table index or configuration id for the iteration.
+        directory : str or None
+            The directory name for the iteration, if given by the main thread.
+        database : tuple or None
+            How to open the database for the iteration, from `_database_state`.
+        router : ThreadRoutingHandler
+            The handler that routes the output to the handlers for each thread.
+        clones : dict(int, Loop)
+            The copies of this loop for each thread, keyed by the thread id.
+
+        Returns
+        -------
+        dict(str, any)
+            The results of the iteration.
+        """
+        thread = threading.get_ident()
+        if thread not in clones:
+            _thread_worker.router = router
+            clone = self._clone()
+            if clone.table_handle is not None:
+                # The thread needs its own current index, etc. for the table
+                self.set_variable(P["table"], clone.table_handle)
+            clones[thread] = clone
+        return clones[thread]._run_in_worker(P, count, item, directory, database)
+
+    def _clone(self):
+        """Make a private copy of this loop and the rest of the flowchart.
+
+        The copy of the flowchart shares everything except the graph of nodes, so
+        that a thread running iterations has its own nodes with their ids,
+        directories and other state. Connections, files, loggers and the like
+        held by the nodes are shared rather than copied, except that the
+        handlers for the references are left for each copy to open, since an
+        SQLite connection can only be used in the thread that made it. The copy
+        has its own copy of the table being looped over, and the changes to the
+        rows are put back in the table by the main thread.
+
+        Returns
+        -------
+        Loop
+            The copy of this loop.
+        """
+        flowchart = copy.copy(self.flowchart)
+        memo = {id(self.flowchart): flowchart}
+        for key, value in vars(self.flowchart).items():
+            if key != "graph":
+                memo.setdefault(id(value), value)
+        for node in _flowchart_nodes(self.flowchart):
+            for key, value in vars(node).items():
+                if key == "_references":
+                    memo[id(value)] = None
+                elif _is_handle(value):
+                    memo.setdefault(id(value), value)
+        if self.table_handle is not None:
+            table = self.table.copy()
+            memo[id(self.table)] = table
+            memo[id(self.table_handle)] = {**self.table_handle, "table": table}
+        if self._row_layout is not None:
+            memo[id(self._row_layout)] = None
+        for shared in (
+            self._journal,
+            self._foreach_cache,
+            self._values_file,
+            self._async,
+            self._reaper,
+        ):
+            if shared is not None:
+                memo[id(shared)] = shared
+        try:
+            flowchart.graph = copy.deepcopy(self.flowchart.graph, memo)
+        except Exception as e:
+            raise RuntimeError(
+                f"The loop body could not be copied to run it in threads: {e}. "
+                "Try running the iterations in a process pool instead."
+            ) from e
+        return memo[id(self)]
+
+    def _run_in_worker(self, P, count, item, directory=None, database=None):
+        """Run an iteration of the loop in a worker process.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        count : int
+            The number of the iteration, starting at 1.
+        item : any
+            The value, table index or configuration id for the iteration.
+        directory : str or None
+            The directory name for the iteration, if given by the main process.
+        database : tuple or None
+            How to open the database for the iteration, from `_database_state`.
+
+        Returns
+        -------
+        dict(str, any)
+            The results of the iteration.
+        """
+        if _in_worker and self._async is None and P["asynchronous output"]:
+            self._async = AsynchronousOutput(job)
+            self._async.start()
+
+        t0 = time.time()
+        result = {"count": count, "message": None, "rows": None, "start": t0}
+        before = dict(seamm.flowchart_variables._data.items())
+        system_db = None
+        try:
+            # The iteration has its own connection to the database
+            if database is not None:
+                system_db = _open_database(database)
+                self.set_variable("_system_db", system_db)
+            self._set_iteration(P, count, item, directory)
+            result["directory"] = self.iteration_directory
+            result["status"] = self._run_iteration(P)
+        except Exception as e:
+            result["status"] = "stop"
+            result["message"] = f"{e}\n{traceback.format_exc()}"
+        finally:
+            if system_db is not None:
+                system_db.close()
+                self.set_variable("_system_db", before["_system_db"])
+        result["elapsed"] = time.time() - t0
+
+        # The variables set by the iteration, to set in the main process
+        excluded = _loop_variables
+        if P["type"] == "For rows in table":
+            excluded = excluded | {P["table"]}
+        result["variables"] = {
+            name: value
+            for name, value in seamm.flowchart_variables._data.items()
+            if name not in excluded
+            and (name not in before or before[name] is not value)
+        }
+        result["tombstone"] = self._tombstone
+        self._tombstone = None
+
+        # Return the row of the table so that changes can be merged
+        if P["type"] == "For rows in table" and result["status"] != "skip":
+            result["rows"] = self._current_rows(self._row_indices)
+
+        # Make sure the output is written before the process reports back
         if self._file_handler is not None:
-            self._file_handler.close()
-            job.removeHandler(self._file_handler)
-            self._file_handler = None
-        if job_handler is not None:
-            job_handler.setLevel(job_level)
-        if out_handler is not None:
-            out_handler.setLevel(out_level)
+            self._call_output(self._file_handler.flush)
+        if _in_worker and self._async is not None:
+            self._async.wait()
+
+        return result
+
+    def _row_values(self, index):
+        """The values in a row of the table being looped over.
+
+        The columns of the table are extracted as arrays, and the safe variable
+        names for the columns found, once for the loop, or again if columns or
+        rows are added or removed. Each row is then a lookup in the arrays,
+        keeping the NumPy types of the values, rather than a lookup in the
+        table for every column. Only the columns selected by the 'columns'
+        parameter are used.
+
+        Parameters
+        ----------
+        index : any
+            The index of the row, or the indices of the rows in a batch.
+
+        Returns
+        -------
+        dict(str, any)
+            The values in the row, or arrays of the values in the batch, keyed
+            by the column names.
+        """
+        table = self.table
+        layout = self._row_layout
+        if layout is None or table.columns is not layout[0] or table.shape != layout[1]:
+            if self._row_columns is None:
+                columns = [*table.columns]
+                positions = range(len(columns))
+            else:
+                columns = self._row_columns
+                positions = [table.columns.get_loc(k) for k in columns]
+            arrays = [table.iloc[:, i].to_numpy() for i in positions]
+            variables = [_safe_variable_name(k) for k in columns]
+            layout = (table.columns, table.shape, columns, arrays, variables)
+            self._row_layout = layout
+
+        if self._batch_size > 1:
+            position = table.index.get_indexer(index)
+            if (position < 0).any():
+                missing = [i for i, p in zip(index, position) if p < 0]
+                raise KeyError(f"The rows {missing} are not in the table")
+        else:
+            position = table.index.get_loc(index)
+        return {k: array[position] for k, array in zip(layout[2], layout[3])}
 
-        return self.exit_node()
+    def _current_row(self, index):
+        """The current values in a row of the table, or None if it is not there.
+
+        Parameters
+        ----------
+        index : any
+            The index of the row.
+
+        Returns
+        -------
+        dict(str, any)
+            The values in the row, keyed by the column names.
+        """
+        table = self.table_handle["table"]
+        if index in table.index:
+            return {k: table.at[index, k] for k in table}
+        return None
+
+    def _current_rows(self, indices):
+        """The current values in the rows of the table, keyed by the index.
+
+        Parameters
+        ----------
+        indices : [any]
+            The indices of the rows.
+
+        Returns
+        -------
+        dict(any, dict(str, any))
+            The values in each row, keyed by the column names.
+        """
+        if indices is None or self.table_handle is None:
+            return None
+        return {index: self._current_row(index) for index in indices}
+
+    def _update_rows(self, rows):
+        """Update rows of the table with any changed values.
+
+        Parameters
+        ----------
+        rows : dict(any, dict(str, any)) or None
+            The values in each row, keyed by the index of the row.
+        """
+        if rows is None:
+            return
+        for index, row in rows.items():
+            self._update_row(index, row)
+
+    def _update_row(self, index, row):
+        """Update a row of the table with any changed values.
+
+        Parameters
+        ----------
+        index : any
+            The index of the row.
+        row : dict(str, any)
+            The values in the row, keyed by the column names.
+        """
+        if row is None:
+            return
+        table = self.table_handle["table"]
+        for column, value in row.items():
+            if column in table.columns and _same_value(table.at[index, column], value):
+                continue
+            table.at[index, column] = value
+
+    def _merge_result(self, P, result, item, key):
+        """Merge the results of an iteration from a worker into the main process.
+
+        Parameters
+        ----------
+        P : dict(str, any)
+            The current values of the parameters
+        result : dict(str, any)
+            The results of the iteration from the worker.
+        item : any
+            The value, table index or configuration id for the iteration.
+        key : str
+            The key of the iteration, for the journal.
+
+        Returns
+        -------
+        str
+            The status of the iteration.
+        """
+        status = result["status"]
+        self._journal.record(
+            key,
+            result["count"],
+            result.get("directory"),
+            "error" if status == "stop" else status,
+            start=result["start"],
+            elapsed=result["elapsed"],
+        )
+        self._loop_count = result["count"]
+        if status == "skip" and result.get("directory") is not None:
+            self._release_filename(Path(result["directory"]).name)
+            self._reaper.reap(result.get("tombstone"))
+        elif status != "stop":
+            self._archive_output(key, result.get("directory"))
+        self.logger.info(
+            f"    Iteration {result['count']} ({result.get('directory', '')}): "
+            f"{status} in {result['elapsed']:.2f} s"
+        )
+
+        if status == "stop":
+            raise RuntimeError(
+                f"Loop iteration {result['count']} failed: {result['message']}"
+            )
+
+        # Put any changes to the row back into the table, and set the variables
+        self._update_rows(result["rows"])
+        for name, value in result["variables"].items():
+            self.set_variable(name, value)
+
+        return status
 
     def default_edge_subtype(self):
         """Return the default subtype of the edge. Usually this is 'next'
@@ -805,6 +2081,7 @@ class Loop(seamm.Node):
         """
 
         # how many outgoing edges are there?
+        self._edge_nodes = None
         n_edges = len(self.flowchart.edges(self, direction="out"))
 
         self.logger.debug(f"loop.default_edge_subtype, n_edges = {n_edges}")
@@ -833,12 +2110,10 @@ class Loop(seamm.Node):
             pass
 
         # Now need to walk through the steps in the loop...
-        for edge in self.flowchart.edges(self, direction="out"):
-            if edge.edge_subtype == "loop":
-                self.logger.debug("Loop, first node of loop is: {}".format(edge.node2))
-                next_node = edge.node2
-                while next_node and next_node != self:
-                    next_node = next_node.create_parser()
+        self._edge_nodes = None
+        next_node = self.loop_node()
+        while next_node and next_node != self:
+            next_node = next_node.create_parser()
 
         return self.exit_node()
 
@@ -849,50 +2124,157 @@ class Loop(seamm.Node):
             return None
         else:
             self.visited = True
+            self._edge_nodes = None
+            self._body_ids = None
             self._id = node_id
             self.set_subids(self._id)
             return self.exit_node()
 
     def set_subids(self, node_id=()):
-        """Set the ids of the nodes in the loop"""
+        """Set the ids of the nodes in the loop
+
+        The nodes in the body are found the first time. Afterwards, e.g. for
+        each iteration, only the start of the ids changes, so the ids of nodes
+        using the standard set_id() are changed directly, and only nodes with
+        their own set_id(), such as nested loops, are asked to set their ids.
+        Since those may set the ids of any nodes after them, all the nodes in
+        the body are marked as not visited first, unless they all use the
+        standard set_id().
+        """
+        if self._body_ids is None:
+            self._body_graph = self._body_subgraph()
+            if all(type(node).set_id is seamm.Node.set_id for node in self._body_graph):
+                self._body_graph = None
+            self._body_ids = []
+            next_node = self.loop_node()
+            n = 0
+            while next_node and next_node != self:
+                self._body_ids.append((next_node, str(n)))
+                next_node.visited = False
+                next_node = next_node.set_id((*node_id, str(n)))
+                n += 1
+        else:
+            if self._body_graph is not None:
+                for node in self._body_graph:
+                    node.visited = False
+            for node, n in self._body_ids:
+                if type(node).set_id is seamm.Node.set_id:
+                    node.visited = True
+                    node._id = (*node_id, n)
+                else:
+                    node.set_id((*node_id, n))
+
+    def _body_subgraph(self):
+        """All the nodes reachable from the start of the body, within the loop.
+
+        Returns
+        -------
+        [seamm.Node]
+            The nodes, including those in the bodies of nested loops.
+        """
+        nodes = []
+        seen = {self}
         next_node = self.loop_node()
-        n = 0
-        while next_node and next_node != self:
-            next_node = next_node.set_id((*node_id, str(n)))
-            n += 1
+        pending = [] if next_node is None else [next_node]
+        while len(pending) > 0:
+            node = pending.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            nodes.append(node)
+            for edge in self.flowchart.edges(node, direction="out"):
+                pending.append(edge.node2)
+        return nodes
+
+    def _edge_node(self, subtype):
+        """The node at the end of the edge of the given subtype leaving the loop.
+
+        The nodes are found once and cached, since this is called for every
+        iteration. The cache is cleared by the methods that start using the
+        flowchart, e.g. run(), set_id(), and describe(), so that they see any
+        edits to the flowchart.
+        """
+        if self._edge_nodes is None:
+            self._edge_nodes = {}
+            for edge in self.flowchart.edges(self, direction="out"):
+                self._edge_nodes.setdefault(edge.edge_subtype, edge.node2)
+        return self._edge_nodes.get(subtype)
 
     def exit_node(self):
         """The next node after the loop, if any"""
-
-        for edge in self.flowchart.edges(self, direction="out"):
-            if edge.edge_subtype == "exit":
-                self.logger.debug(f"Loop, node after loop is: {edge.node2}")
-                return edge.node2
-
-        # loop is the last node in the flowchart
-        self.logger.debug("There is no node after the loop")
-        return None
+        node = self._edge_node("exit")
+        if node is None:
+            # loop is the last node in the flowchart
+            self.logger.debug("There is no node after the loop")
+        else:
+            self.logger.debug(f"Loop, node after loop is: {node}")
+        return node
 
     def loop_node(self):
         """The first node in the loop body"""
-
-        for edge in self.flowchart.edges(self, direction="out"):
-            if edge.edge_subtype == "loop":
-                self.logger.debug(f"Loop, first node in loop is: {edge.node2}")
-                return edge.node2
-
-        # There is no body of the loop!
-        self.logger.debug("There is no loop body")
-        return None
+        node = self._edge_node("loop")
+        if node is None:
+            # There is no body of the loop!
+            self.logger.debug("There is no loop body")
+        else:
+            self.logger.debug(f"Loop, first node in loop is: {node}")
+        return node
 
     def safe_filename(self, filename):
         clean = re.sub(r"[/\\?%*:|\"<>\x7F\x00-\x1F]", "-", filename)
 
-        # Check for duplicates...
-        path = Path(self.directory) / clean
-        count = 1
-        while path.exists():
+        # Check for duplicates, using the names given out during this loop and
+        # those in the directory when the loop started.
+        if self._filenames is None:
+            self._filenames = {}
+            self._filename_counts = {}
+            directories = [self.directory]
+            while len(directories) > 0:
+                try:
+                    with os.scandir(directories.pop()) as it:
+                        for entry in it:
+                            if entry.name.startswith("shard_") and entry.is_dir():
+                                directories.append(entry.path)
+                            else:
+                                self._filenames[entry.name] = None
+                except FileNotFoundError:
+                    pass
+
+        count = self._filename_counts.get(clean, 0) + 1
+        name = clean if count == 1 else f"{clean}_{count}"
+        while name in self._filenames:
             count += 1
-            path = Path(self.directory) / f"{clean}_{count}"
+            name = f"{clean}_{count}"
+        self._filenames[name] = (clean, count)
+        self._filename_counts[clean] = count
+
+        return name
 
-        return path.name
+    def _archive_output(self, key, directory):
+        """Move the small output files of a finished iteration to the archive.
+
+        Parameters
+        ----------
+        key : str
+            The key of the iteration.
+        directory : str
+            The directory of the iteration, relative to the loop's directory.
+        """
+        if self._archive is None or directory is None:
+            return
+        if self._async is not None:
+            # The output of the iteration may still be queued
+            self._async.wait()
+        path = Path(self.directory) / directory
+        n = self._archive.add_directory(key, directory, path)
+        self.logger.debug(f"Archived {n} files from {directory}")
+
+    def _release_filename(self, name):
+        """Allow a name given out by safe_filename to be used again."""
+        if self._filenames is None or name is None:
+            return
+        issued = self._filenames.get(name)
+        if issued is not None:
+            del self._filenames[name]
+            clean, count = issued
+            self._filename_counts[clean] = min(self._filename_counts[clean], count - 1)
@@ -61,6 +61,29 @@ class LoopParameters(seamm.Parameters):
             "description": "by",
             "help_text": ("The step or increment of the loop value."),
         },
+        "values from": {
+            "default": "list of values",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": ("list of values", "lines of file"),
+            "format_string": "s",
+            "description": "",
+            "help_text": (
+                "Whether the values are given as a list, or are the lines of a file."
+            ),
+        },
+        "values file": {
+            "default": "",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "s",
+            "description": "file",
+            "help_text": (
+                "The file with one value per line, which may be compressed with "
+                "gzip if the name ends in '.gz'. Blank lines are ignored."
+            ),
+        },
         "values": {
             "default": "",
             "kind": "string",
@@ -70,6 +93,28 @@ class LoopParameters(seamm.Parameters):
             "description": "value in",
             "help_text": ("The list of values for the loop."),
         },
+        "table source": {
+            "default": "table in flowchart",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": ("table in flowchart", "file"),
+            "format_string": "s",
+            "description": "",
+            "help_text": (
+                "Whether to loop over a table in the flowchart, or the rows of a "
+                "CSV or Parquet file, which are read a chunk at a time so that "
+                "the table does not need to fit in memory."
+            ),
+        },
+        "table file": {
+            "default": "",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "s",
+            "description": "file",
+            "help_text": "The CSV or Parquet file with the table.",
+        },
         "table": {
             "default": "table1",
             "kind": "string",
@@ -83,7 +128,11 @@ class LoopParameters(seamm.Parameters):
             "default": "Use all rows",
             "kind": "string",
             "default_units": "",
-            "enumeration": ("Use all rows", "Select rows where column"),
+            "enumeration": (
+                "Use all rows",
+                "Select rows where column",
+                "Select rows matching criteria",
+            ),
             "format_string": "s",
             "description": "",
             "help_text": ("The filter for rows, defaults to all rows."),
@@ -138,6 +187,19 @@ class LoopParameters(seamm.Parameters):
             "description": "",
             "help_text": "The second value to use in the test",
         },
+        "row criteria": {
+            "default": "",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "s",
+            "description": "",
+            "help_text": (
+                "Criteria for the rows such as 'energy < 0 and converged == True'. "
+                "'and' takes precedence over 'or'. Quote names or values that "
+                "contain spaces."
+            ),
+        },
         "as variables": {
             "default": "yes",
             "kind": "boolean",
@@ -147,6 +209,32 @@ class LoopParameters(seamm.Parameters):
             "description": "Values as variables:",
             "help_text": "Whether to put the values for the row as seperate variables.",
         },
+        "columns": {
+            "default": "all",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": ("all",),
+            "format_string": "s",
+            "description": "Columns:",
+            "help_text": (
+                "The columns whose values are given to the body of the loop, "
+                "separated by spaces, or 'all'. Quote names that contain spaces."
+            ),
+        },
+        "batch size": {
+            "default": "1",
+            "kind": "integer",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "",
+            "description": "Batch size:",
+            "help_text": (
+                "The number of values or rows handled by each iteration. With more "
+                "than one, the loop variable is a list of values, or '_rows' is "
+                "the table of the rows and the variables for the columns are "
+                "arrays."
+            ),
+        },
         "where system name": {
             "default": "is anything",
             "kind": "string",
@@ -203,6 +291,58 @@ class LoopParameters(seamm.Parameters):
             "description": "Directory names:",
             "help_text": "The directory name for the loop iteration.",
         },
+        "directory layout": {
+            "default": "flat",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": (
+                "flat",
+                "sharded by iteration",
+                "sharded by name",
+            ),
+            "format_string": "s",
+            "description": "Directory layout:",
+            "help_text": (
+                "Whether the directories for the iterations are all in the loop's "
+                "directory, or grouped into subdirectories by the iteration number "
+                "or a hash of the directory name."
+            ),
+        },
+        "shard size": {
+            "default": "1000",
+            "kind": "integer",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "",
+            "description": "Iterations per subdirectory:",
+            "help_text": (
+                "The number of iteration directories in each subdirectory, on "
+                "average if grouped by the name."
+            ),
+        },
+        "iteration output": {
+            "default": "files",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": ("files", "archive", "none"),
+            "format_string": "s",
+            "description": "Output of iterations:",
+            "help_text": (
+                "Whether the output of each iteration stays in its directory, "
+                "the small files are moved into one archive file in the loop's "
+                "directory to save inodes, or there is no output for the "
+                "iterations, so their directories are not created unless needed."
+            ),
+        },
+        "largest archived file": {
+            "default": "1000",
+            "kind": "integer",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "",
+            "description": "Largest file to archive (kB):",
+            "help_text": "Larger files are left in the directory of the iteration.",
+        },
         "errors": {
             "default": "continue to next iteration",
             "kind": "string",
@@ -216,6 +356,95 @@ class LoopParameters(seamm.Parameters):
             "description": "On errors",
             "help_text": ("How to handle errors"),
         },
+        "resume": {
+            "default": "no",
+            "kind": "boolean",
+            "default_units": "",
+            "enumeration": ("yes", "no"),
+            "format_string": "",
+            "description": "Resume:",
+            "help_text": (
+                "Whether to skip the iterations that completed in a previous run "
+                "of the job, as recorded in the loop's journal."
+            ),
+        },
+        "use cache": {
+            "default": "no",
+            "kind": "boolean",
+            "default_units": "",
+            "enumeration": ("yes", "no"),
+            "format_string": "",
+            "description": "Cache results:",
+            "help_text": (
+                "Whether to reuse the results of iterations with the same values, "
+                "the same current configuration and the same steps in the loop, "
+                "from a cache on disk. Iterations that change the database are "
+                "not cached."
+            ),
+        },
+        "cache directory": {
+            "default": "~/.seamm.d/loop_cache",
+            "kind": "string",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "s",
+            "description": "Cache directory:",
+            "help_text": "The directory for the cache of results of iterations.",
+        },
+        "cache size": {
+            "default": "10.0",
+            "kind": "float",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": ".1f",
+            "description": "Maximum cache size (GB):",
+            "help_text": (
+                "The maximum size of the cache, in GB. The least recently used "
+                "results are removed when it is full."
+            ),
+        },
+        "execution": {
+            "default": "serial",
+            "kind": "enumeration",
+            "default_units": "",
+            "enumeration": ("serial", "process pool", "thread pool"),
+            "format_string": "s",
+            "description": "Run iterations:",
+            "help_text": (
+                "Whether to run the iterations one after another, or in parallel in "
+                "a pool of worker processes or threads. The iterations must be "
+                "independent of each other to run them in parallel. Threads are "
+                "best for bodies that mainly wait for external programs. The "
+                "iterations are run serially if the body changes the database or "
+                "uses one held in memory, for loops over systems in the database, "
+                "or if processes cannot be forked on this platform."
+            ),
+        },
+        "number of workers": {
+            "default": "0",
+            "kind": "integer",
+            "default_units": "",
+            "enumeration": tuple(),
+            "format_string": "",
+            "description": "Number of workers:",
+            "help_text": (
+                "The number of workers running iterations in parallel. 0 uses all "
+                "the available processors."
+            ),
+        },
+        "asynchronous output": {
+            "default": "no",
+            "kind": "boolean",
+            "default_units": "",
+            "enumeration": ("yes", "no"),
+            "format_string": "",
+            "description": "Write output in the background:",
+            "help_text": (
+                "Whether to write the output of the loop to the files in a "
+                "background thread, so that the iterations do not wait for slow "
+                "file systems."
+            ),
+        },
     }
 
     def __init__(self, defaults={}, data=None):
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""An archive of the small output files of the iterations of a loop."""
+
+import logging
+import os
+from pathlib import Path
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+class OutputArchive(object):
+    """The small files written by the iterations of a loop, in one SQLite file.
+
+    After an iteration finishes, the files in its directory that are no larger
+    than the limit are moved into the archive, and the directories left empty
+    are removed, so that a loop with many iterations does not use many inodes.
+    Larger files stay on disk. The files are found by the key of the iteration
+    and their path relative to the iteration's directory.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The archive file, which is created if it does not exist.
+    max_file_size : int
+        The size of the largest file to archive, in bytes.
+    """
+
+    filename = "iterations.sqlite"
+
+    def __init__(self, path, max_file_size=1000000):
+        self.path = Path(path)
+        self.max_file_size = max_file_size
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "  key TEXT NOT NULL,"
+            "  directory TEXT NOT NULL,"
+            "  path TEXT NOT NULL,"
+            "  data BLOB NOT NULL,"
+            "  PRIMARY KEY (key, path)"
+            ")"
+        )
+        self.db.commit()
+
+    def close(self):
+        """Close the archive."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def add_directory(self, key, directory, path):
+        """Move the small files of an iteration into the archive.
+
+        Parameters
+        ----------
+        key : str
+            The key of the iteration.
+        directory : str
+            The directory of the iteration relative to the loop's directory.
+        path : pathlib.Path
+            The directory of the iteration.
+
+        Returns
+        -------
+        int
+            The number of files archived.
+        """
+        path = Path(path)
+        if not path.is_dir():
+            return 0
+
+        archived = []
+        rows = []
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                filepath = Path(root) / filename
+                try:
+                    if filepath.is_symlink():
+                        continue
+                    if filepath.stat().st_size > self.max_file_size:
+                        continue
+                    data = filepath.read_bytes()
+                except OSError as e:
+                    logger.warning(f"Could not archive {filepath}: {e}")
+                    continue
+                rows.append(
+                    (str(key), directory, filepath.relative_to(path).as_posix(), data)
+                )
+                archived.append(filepath)
+
+        with self.db:
+            self.db.execute("DELETE FROM files WHERE key = ?", (str(key),))
+            self.db.executemany(
+                "INSERT INTO files (key, directory, path, data) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+        # Only remove the files once they are safely in the archive
+        for filepath in archived:
+            filepath.unlink(missing_ok=True)
+        for root, dirs, files in os.walk(path, topdown=False):
+            try:
+                os.rmdir(root)
+            except OSError:
+                # Not empty
+                pass
+
+        return len(archived)
+
+    def keys(self):
+        """The keys of the iterations in the archive."""
+        return [row[0] for row in self.db.execute("SELECT DISTINCT key FROM files")]
+
+    def files(self, key):
+        """The paths of the archived files of an iteration.
+
+        Parameters
+        ----------
+        key : str
+            The key of the iteration.
+
+        Returns
+        -------
+        [str]
+            The paths of the files relative to the iteration's directory.
+        """
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT path FROM files WHERE key = ? ORDER BY path", (str(key),)
+            )
+        ]
+
+    def read(self, key, path):
+        """The contents of an archived file.
+
+        Parameters
+        ----------
+        key : str
+            The key of the iteration.
+        path : str
+            The path of the file relative to the iteration's directory.
+
+        Returns
+        -------
+        bytes
+            The contents of the file.
+        """
+        row = self.db.execute(
+            "SELECT data FROM files WHERE key = ? AND path = ?", (str(key), path)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"'{path}' for iteration '{key}' is not in the archive")
+        return row[0]
+
+    def extract(self, key, destination):
+        """Write the archived files of an iteration back to a directory.
+
+        Parameters
+        ----------
+        key : str
+            The key of the iteration.
+        destination : str or pathlib.Path
+            The directory to write the files to.
+
+        Returns
+        -------
+        int
+            The number of files written.
+        """
+        destination = Path(destination)
+        n = 0
+        for path, data in self.db.execute(
+            "SELECT path, data FROM files WHERE key = ?", (str(key),)
+        ):
+            filepath = destination / path
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            filepath.write_bytes(data)
+            n += 1
+        return n
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""Sequences of values for loops that are generated as they are needed."""
+
+import array
+import collections.abc
+from decimal import Decimal
+import gzip
+import logging
+import os
+from pathlib import Path
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _decimal_places(value):
+    """The number of decimal places in a number."""
+    exponent = Decimal(str(value)).as_tuple().exponent
+    return -exponent if exponent < 0 else 0
+
+
+class ForRange(collections.abc.Sequence):
+    """The values of a For loop from start to end, inclusive, by step.
+
+    The number of values is computed in closed form, and each value is computed
+    as start + k * step when it is needed, using exact decimal arithmetic so
+    that there is no drift from adding the step repeatedly. Negative steps give
+    descending ranges.
+
+    Parameters
+    ----------
+    start : int or float
+        The first value.
+    end : int or float
+        The last possible value.
+    step : int or float
+        The increment, which may be negative but not zero.
+    """
+
+    def __init__(self, start, end, step):
+        if step == 0:
+            raise ValueError("The step of a For loop cannot be zero.")
+
+        self.start = start
+        self.end = end
+        self.step = step
+
+        # Work with exact integers scaled by the number of decimal places
+        self.ndigits = max(_decimal_places(v) for v in (start, end, step))
+        self._start = int(Decimal(str(start)).scaleb(self.ndigits))
+        self._step = int(Decimal(str(step)).scaleb(self.ndigits))
+        end = int(Decimal(str(end)).scaleb(self.ndigits))
+
+        self._length = max(0, (end - self._start) // self._step + 1)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(self._length))]
+        if k < 0:
+            k += self._length
+        if k < 0 or k >= self._length:
+            raise IndexError("ForRange index out of range")
+        value = self._start + k * self._step
+        if self.ndigits == 0:
+            return value
+        return float(Decimal(value).scaleb(-self.ndigits))
+
+    def __iter__(self):
+        for k in range(self._length):
+            yield self[k]
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return f"ForRange({self.start}, {self.end}, {self.step})"
+
+
+class FileLines(collections.abc.Sequence):
+    """The lines of a text file, optionally compressed with gzip, as values.
+
+    The file is read once to build an index of the byte offsets of the lines,
+    so the number of values is known and any value can be read directly without
+    holding all the values in memory. Leading and trailing whitespace is
+    removed, and blank lines are ignored.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The file, which is treated as compressed if its name ends in '.gz'.
+    encoding : str
+        The encoding of the text in the file.
+    """
+
+    def __init__(self, path, encoding="utf-8"):
+        self.path = Path(path).expanduser()
+        self.encoding = encoding
+        self.compressed = self.path.suffix == ".gz"
+
+        self._starts = array.array("q")
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        offset = 0
+        with self._open() as fd:
+            for line in fd:
+                if not line.isspace():
+                    self._starts.append(offset)
+                offset += len(line)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if k < 0 or k >= len(self):
+            raise IndexError("FileLines index out of range")
+
+        # Each process needs its own handle, since the position in the file is
+        # shared by forked processes, and threads take turns using it.
+        with self._lock:
+            if self._fd is None or self._pid != os.getpid():
+                self._fd = self._open()
+                self._pid = os.getpid()
+            self._fd.seek(self._starts[k])
+            line = self._fd.readline()
+        return line.decode(self.encoding).strip()
+
+    def __iter__(self):
+        with self._open() as fd:
+            for line in fd:
+                if not line.isspace():
+                    yield line.decode(self.encoding).strip()
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __repr__(self):
+        return f"FileLines('{self.path}')"
+
+    def _open(self):
+        """Open the file for reading bytes."""
+        if self.compressed:
+            return gzip.open(self.path, "rb")
+        return open(self.path, "rb")
+
+    def close(self):
+        """Close the file."""
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+class Batches(collections.abc.Sequence):
+    """The values for a loop taken a batch at a time.
+
+    Each item is a slice of the values, so that e.g. the batches of the index
+    of a table are themselves indices. The last batch may be smaller than the
+    others.
+
+    Parameters
+    ----------
+    values : sequence
+        The values, which must support slicing.
+    size : int
+        The number of values in each batch.
+    """
+
+    def __init__(self, values, size):
+        if size < 1:
+            raise ValueError("The batch size must be at least 1.")
+        self.values = values
+        self.size = size
+        self._length = -(-len(values) // size)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(self._length))]
+        if k < 0:
+            k += self._length
+        if k < 0 or k >= self._length:
+            raise IndexError("Batches index out of range")
+        return self.values[k * self.size : (k + 1) * self.size]
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return f"Batches({self.values!r}, {self.size})"
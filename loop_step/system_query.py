@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Selecting the systems and configurations in the database to loop over."""
+
+import fnmatch
+import functools
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=32)
+def _compile(pattern):
+    """Compile a regular expression, caching the result."""
+    return re.compile(pattern)
+
+
+def _regexp(pattern, value):
+    """The REGEXP function for SQLite: whether the pattern is found in the value."""
+    if pattern is None or value is None:
+        return False
+    return _compile(pattern).search(value) is not None
+
+
+def _wildcards(pattern):
+    """A regular expression matching the same names as a shell-style pattern."""
+    return r"\A" + fnmatch.translate(pattern)
+
+
+def select_configuration_ids(
+    system_db,
+    system_criterion="is anything",
+    system_name="",
+    configuration_criterion="last",
+    configuration_name="",
+):
+    """The ids of the configurations meeting the criteria.
+
+    The criteria are translated into a single SQL query run by the database, so
+    only the ids of the matching configurations are returned. 'matches' uses
+    the same shell-style patterns as fnmatch, evaluated as regular expressions.
+
+    Parameters
+    ----------
+    system_db : molsystem.SystemDB
+        The database of systems.
+    system_criterion : str
+        How to select systems by name: 'is anything', 'is', 'matches' or
+        'regexp'.
+    system_name : str
+        The name, pattern or regular expression for the system names.
+    configuration_criterion : str
+        Which configurations to select: 'all', 'last', 'first', 'name is',
+        'name matches' or 'name regexp'.
+    configuration_name : str
+        The name, pattern or regular expression for the configuration names.
+
+    Returns
+    -------
+    [int]
+        The ids of the configurations, ordered by system and configuration.
+    """
+    db = system_db.db
+    db.create_function("REGEXP", 2, _regexp, deterministic=True)
+
+    where = []
+    parameters = []
+
+    # Filter on system names
+    if system_criterion == "is anything":
+        pass
+    elif system_criterion == "is":
+        where.append("s.name = ?")
+        parameters.append(system_name)
+    elif system_criterion == "matches":
+        where.append("s.name REGEXP ?")
+        parameters.append(_wildcards(system_name))
+    elif system_criterion == "regexp":
+        where.append("s.name REGEXP ?")
+        parameters.append(system_name)
+    else:
+        raise RuntimeError(
+            f"Matching system names by '{system_criterion}' is not supported"
+        )
+
+    # and on the configurations
+    choice = configuration_criterion
+    if choice == "all":
+        pass
+    elif choice in ("last", "-1"):
+        where.append("c.id IN (SELECT MAX(id) FROM configuration GROUP BY system)")
+    elif choice in ("first", "1"):
+        where.append("c.id IN (SELECT MIN(id) FROM configuration GROUP BY system)")
+    elif choice == "name is":
+        where.append("c.name = ?")
+        parameters.append(configuration_name)
+    elif choice in ("name matches", "matches"):
+        where.append("c.name REGEXP ?")
+        parameters.append(_wildcards(configuration_name))
+    elif choice in ("name regexp", "regexp"):
+        where.append("c.name REGEXP ?")
+        parameters.append(configuration_name)
+    else:
+        raise RuntimeError(f"Selecting configurations by '{choice}' is not supported")
+
+    sql = "SELECT c.id FROM configuration AS c JOIN system AS s ON c.system = s.id"
+    if len(where) > 0:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY s.id, c.id"
+    logger.debug(f"Selecting configurations: {sql} {parameters}")
+
+    return [row[0] for row in db.execute(sql, parameters)]
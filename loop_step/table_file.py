@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""Reading the rows of a table from a file, a chunk at a time."""
+
+import logging
+from pathlib import Path
+
+import pandas
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    have_pyarrow = False
+else:
+    have_pyarrow = True
+
+from loop_step import table_query
+
+logger = logging.getLogger(__name__)
+
+csv_suffixes = (".csv", ".txt")
+parquet_suffixes = (".parquet", ".pq")
+
+
+class TableFile(object):
+    """The rows of a table in a CSV or Parquet file, read a chunk at a time.
+
+    The file is read each time the rows are iterated over, so only one chunk
+    of the table is in memory at a time, and only the columns that are needed
+    are read. The rows are numbered from 0 in the order of the file.
+
+    The number of rows is taken from the metadata of Parquet files. Otherwise
+    it is not known until the rows have been iterated over, or counted with
+    count(), which reads the file.
+
+    The types of the columns in a CSV file are those of the first chunk,
+    unless given, so that a value in a later chunk does not change the type of
+    the column from one chunk to the next.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The file. CSV files may be compressed, e.g. 'table.csv.gz'.
+    criteria : [(str, str, str, str, str)]
+        The criteria for the rows, as returned by table_query.parse_criteria,
+        or None to use all the rows.
+    columns : [str]
+        The columns to include in the rows, ignoring case, or None for all.
+    chunk_size : int
+        The number of rows to read at a time.
+    dtypes : dict(str, any)
+        The types of the columns, or None to use those of the first chunk.
+    """
+
+    def __init__(
+        self, path, criteria=None, columns=None, chunk_size=100000, dtypes=None
+    ):
+        self.path = Path(path).expanduser()
+        self.criteria = criteria if criteria else None
+        self.chunk_size = chunk_size
+        self.dtypes = dtypes
+
+        suffixes = [s.lower() for s in self.path.suffixes]
+        if any(s in csv_suffixes for s in suffixes):
+            self.format = "csv"
+        elif any(s in parquet_suffixes for s in suffixes):
+            self.format = "parquet"
+            if not have_pyarrow:
+                raise RuntimeError(
+                    "Reading Parquet files requires pyarrow, which is not installed."
+                )
+        else:
+            raise ValueError(
+                f"Can't tell the format of the table file '{self.path}'. It "
+                "should end in '.csv' or '.parquet'."
+            )
+
+        # The names of the columns, from the header or schema
+        if self.format == "csv":
+            names = [*pandas.read_csv(self.path, nrows=0).columns]
+            self.n_rows = None
+        else:
+            parquet = pyarrow.parquet.ParquetFile(self.path)
+            names = parquet.schema_arrow.names
+            self.n_rows = parquet.metadata.num_rows
+
+        if columns is None:
+            self.columns = names
+        else:
+            self.columns = [table_query.find_column(names, c) for c in columns]
+        self._criteria_columns = []
+        for criterion in self.criteria or []:
+            column = table_query.find_column(names, criterion[1])
+            if column not in self._criteria_columns:
+                self._criteria_columns.append(column)
+        self._read_columns = [
+            c for c in names if c in self.columns or c in self._criteria_columns
+        ]
+
+        self._length = self.n_rows if self.criteria is None else None
+
+    def __iter__(self):
+        """The selected rows as the row number and a dictionary of the values."""
+        n_rows = 0
+        length = 0
+        for chunk in self.chunks(self._read_columns):
+            n_rows += chunk.shape[0]
+            if chunk.shape[0] == 0:
+                continue
+            mask = self._mask(chunk)
+
+            # Pull out the columns once for the chunk, keeping the NumPy types
+            arrays = [chunk[column].to_numpy() for column in self.columns]
+            rows = range(chunk.shape[0]) if mask is None else mask.nonzero()[0]
+            length += len(rows)
+            start = chunk.index[0]
+            for position in rows:
+                row = {k: array[position] for k, array in zip(self.columns, arrays)}
+                yield int(start + position), row
+        self.n_rows = n_rows
+        self._length = length
+
+    def __repr__(self):
+        return f"TableFile('{self.path}')"
+
+    @property
+    def length(self):
+        """The number of selected rows, or None if not yet known."""
+        return self._length
+
+    def _mask(self, chunk):
+        """The mask of the selected rows in a chunk, or None for all rows."""
+        if self.criteria is None:
+            return None
+        return table_query.criteria_mask(chunk, self.criteria)
+
+    def count(self):
+        """Count the selected rows, reading the file if needed.
+
+        Only the columns used by the criteria are read.
+
+        Returns
+        -------
+        int
+            The number of selected rows.
+        """
+        if self._length is None:
+            columns = self._criteria_columns or self._read_columns[:1]
+            n_rows = 0
+            length = 0
+            for chunk in self.chunks(columns):
+                n_rows += chunk.shape[0]
+                mask = self._mask(chunk)
+                length += chunk.shape[0] if mask is None else int(mask.sum())
+            self.n_rows = n_rows
+            self._length = length
+        return self._length
+
+    def chunks(self, columns=None):
+        """The chunks of the table, indexed by the number of the rows.
+
+        Parameters
+        ----------
+        columns : [str]
+            The names of the columns to read, or None for all of them.
+
+        Returns
+        -------
+        iterator of pandas.DataFrame
+            The chunks.
+        """
+        start = 0
+        if self.format == "csv":
+            if self.dtypes is None:
+                first = pandas.read_csv(
+                    self.path, nrows=self.chunk_size, usecols=self._read_columns
+                )
+                self.dtypes = first.dtypes.to_dict()
+            reader = pandas.read_csv(
+                self.path,
+                chunksize=self.chunk_size,
+                usecols=columns,
+                dtype=self.dtypes,
+            )
+            with reader:
+                while True:
+                    try:
+                        chunk = next(reader)
+                    except StopIteration:
+                        break
+                    except ValueError as e:
+                        raise ValueError(
+                            f"The values after row {start} of '{self.path}' do not "
+                            f"have the same types as the earlier rows: {e}"
+                        ) from e
+                    chunk.index = pandas.RangeIndex(start, start + chunk.shape[0])
+                    start += chunk.shape[0]
+                    yield chunk
+        else:
+            parquet = pyarrow.parquet.ParquetFile(self.path)
+            for batch in parquet.iter_batches(
+                batch_size=self.chunk_size, columns=columns
+            ):
+                chunk = batch.to_pandas()
+                if self.dtypes is not None:
+                    chunk = chunk.astype(
+                        {k: v for k, v in self.dtypes.items() if k in chunk}
+                    )
+                chunk.index = pandas.RangeIndex(start, start + chunk.shape[0])
+                start += chunk.shape[0]
+                yield chunk
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+
+"""Selecting the rows of a table to loop over."""
+
+import collections
+import hashlib
+import logging
+import re
+import shlex
+import threading
+import weakref
+
+import numpy as np
+import pandas
+from pandas.api.types import is_bool_dtype, is_object_dtype, is_string_dtype
+
+try:
+    import numexpr  # noqa: F401
+except ImportError:
+    have_numexpr = False
+else:
+    have_numexpr = True
+
+logger = logging.getLogger(__name__)
+
+operators = (
+    "==",
+    "!=",
+    ">",
+    ">=",
+    "<",
+    "<=",
+    "between",
+    "contains",
+    "does not contain",
+    "contains regexp",
+    "does not contain regexp",
+    "is empty",
+    "is not empty",
+)
+
+# Operators that numexpr can evaluate, with their form in an expression
+_numexpr_operators = {
+    "==": "==",
+    "!=": "!=",
+    ">": ">",
+    ">=": ">=",
+    "<": "<",
+    "<=": "<=",
+}
+
+# Operators matching text in every row, which are slow enough to cache
+_text_operators = (
+    "contains",
+    "does not contain",
+    "contains regexp",
+    "does not contain regexp",
+)
+
+# The rows selected from recent tables, most recently used last
+_selections = collections.OrderedDict()
+_selections_lock = threading.Lock()
+max_selections = 32
+
+# The operators, longest first, for parsing criteria
+_parse_operators = sorted(
+    [*operators, "="], key=lambda op: len(op.split()), reverse=True
+)
+
+
+def find_column(table, name):
+    """Find a column in a table, ignoring the case of the name.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The table.
+    name : str
+        The name of the column.
+
+    Returns
+    -------
+    str
+        The name of the column in the table.
+    """
+    column = None
+    for col in table:
+        if col.lower() == name.lower():
+            column = col
+    if column is None:
+        raise ValueError(
+            f"Looping over table with criterion on column '{name}': "
+            "that column does not exist."
+        )
+    return column
+
+
+def coerce_value(column, value):
+    """Convert a value given as text to the type of the column.
+
+    Parameters
+    ----------
+    column : pandas.Series
+        The column of the table.
+    value : str or any
+        The value, usually as a string.
+
+    Returns
+    -------
+    any
+        The value with the same type as the column, if possible.
+    """
+    dtype = column.dtype
+    if is_bool_dtype(dtype) and isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "t", "y", "1")
+    try:
+        return dtype.type(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _is_text(column):
+    """Whether a column may contain strings."""
+    return is_object_dtype(column.dtype) or is_string_dtype(column.dtype)
+
+
+def _as_strings(column):
+    """The string methods of the column, for the text operators."""
+    if _is_text(column):
+        try:
+            return column.str
+        except AttributeError:
+            # Objects that are not strings
+            pass
+    return column.astype(str).str
+
+
+def criterion_mask(table, column, op, value="", value2=""):
+    """The mask of the rows of the table meeting a criterion.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The table.
+    column : str
+        The name of the column, which may differ in case from the table.
+    op : str
+        The operator, one of `operators`.
+    value : str or any
+        The value to compare to, if needed.
+    value2 : str or any
+        The second value for 'between'.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array that is True for the rows meeting the criterion.
+    """
+    data = table[find_column(table, column)]
+
+    if op in ("is empty", "is not empty"):
+        # Might be NaN, None or an empty string
+        mask = data.isna().to_numpy()
+        if _is_text(data):
+            mask = mask | (data == "").to_numpy(dtype=bool, na_value=False)
+        return ~mask if op == "is not empty" else mask
+
+    if op in ("contains", "does not contain"):
+        mask = _as_strings(data).contains(str(value), regex=False, na=False)
+    elif op in ("contains regexp", "does not contain regexp"):
+        mask = _as_strings(data).contains(re.compile(str(value)), na=False)
+    else:
+        value = coerce_value(data, value)
+        if op == "==":
+            mask = data == value
+        elif op == "!=":
+            mask = data != value
+        elif op == ">":
+            mask = data > value
+        elif op == ">=":
+            mask = data >= value
+        elif op == "<":
+            mask = data < value
+        elif op == "<=":
+            mask = data <= value
+        elif op == "between":
+            value2 = coerce_value(data, value2)
+            mask = (data >= value) & (data <= value2)
+        else:
+            raise NotImplementedError(f"Loop query '{op}' not implemented")
+
+    mask = mask.to_numpy(dtype=bool, na_value=False)
+    if op.startswith("does not"):
+        mask = ~mask
+    return mask
+
+
+def select_rows(table, column, op, value="", value2=""):
+    """The index of the rows of the table meeting a criterion.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The table.
+    column : str
+        The name of the column, which may differ in case from the table.
+    op : str
+        The operator, one of `operators`.
+    value : str or any
+        The value to compare to, if needed.
+    value2 : str or any
+        The second value for 'between'.
+
+    Returns
+    -------
+    pandas.Index
+        The index of the selected rows.
+    """
+    return table.index[criterion_mask(table, column, op, value, value2)]
+
+
+def parse_criteria(text):
+    """Parse criteria such as 'energy < 0 and converged == True'.
+
+    Each criterion is a column, an operator and the value(s) needed by the
+    operator, with the criteria joined by 'and' or 'or'. 'between' takes two
+    values, optionally separated by 'and'. Names or values with spaces must be
+    quoted.
+
+    Parameters
+    ----------
+    text : str
+        The criteria.
+
+    Returns
+    -------
+    [(str, str, str, str, str)]
+        The connector ('and' or 'or'), column, operator, value and second value
+        for each criterion.
+    """
+    tokens = shlex.split(text)
+    criteria = []
+    i = 0
+    try:
+        while i < len(tokens):
+            connector = "and"
+            if len(criteria) > 0:
+                connector = tokens[i].lower()
+                if connector not in ("and", "or"):
+                    raise ValueError(
+                        f"Expected 'and' or 'or' in the criteria '{text}', not "
+                        f"'{tokens[i]}'"
+                    )
+                i += 1
+            column = tokens[i]
+            i += 1
+
+            op = None
+            for candidate in _parse_operators:
+                words = candidate.split()
+                if [t.lower() for t in tokens[i : i + len(words)]] == words:
+                    op = "==" if candidate == "=" else candidate
+                    i += len(words)
+                    break
+            if op is None:
+                raise ValueError(
+                    f"Unknown operator after column '{column}' in the criteria "
+                    f"'{text}'"
+                )
+
+            value = value2 = ""
+            if "empty" not in op:
+                value = tokens[i]
+                i += 1
+                if op == "between":
+                    if tokens[i].lower() == "and":
+                        i += 1
+                    value2 = tokens[i]
+                    i += 1
+            criteria.append((connector, column, op, value, value2))
+    except IndexError:
+        raise ValueError(f"The criteria '{text}' are incomplete.")
+    return criteria
+
+
+def criteria_mask(table, criteria):
+    """The mask of the rows of the table meeting all the criteria.
+
+    'and' takes precedence over 'or'. If numexpr is available and the criteria
+    are all simple comparisons of numerical columns they are evaluated as a
+    single expression, otherwise the masks for the criteria are combined.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The table.
+    criteria : [(str, str, str, str, str)]
+        The connector, column, operator and values of the criteria, as
+        returned by parse_criteria.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array that is True for the rows meeting the criteria.
+    """
+    if have_numexpr and len(criteria) > 1:
+        expression = []
+        variables = {}
+        for n, (connector, column, op, value, value2) in enumerate(criteria):
+            column = find_column(table, column)
+            data = table[column]
+            if op not in _numexpr_operators and op != "between":
+                break
+            if is_object_dtype(data.dtype) or is_string_dtype(data.dtype):
+                break
+            if n > 0:
+                expression.append(connector)
+            variables[f"v{n}"] = coerce_value(data, value)
+            if op == "between":
+                variables[f"w{n}"] = coerce_value(data, value2)
+                expression.append(f"(`{column}` >= @v{n} and `{column}` <= @w{n})")
+            else:
+                expression.append(f"`{column}` {_numexpr_operators[op]} @v{n}")
+        else:
+            mask = table.eval(
+                " ".join(expression), engine="numexpr", local_dict=variables
+            )
+            return mask.to_numpy(dtype=bool, na_value=False)
+
+    # Evaluate each criterion, and combine the masks, 'and' before 'or'
+    result = None
+    term = None
+    for connector, column, op, value, value2 in criteria:
+        mask = criterion_mask(table, column, op, value, value2)
+        if term is None:
+            term = mask
+        elif connector == "and":
+            term = term & mask
+        else:
+            result = term if result is None else result | term
+            term = mask
+    if term is None:
+        return np.ones(table.shape[0], dtype=bool)
+    return term if result is None else result | term
+
+
+def select_rows_matching(table, criteria):
+    """The index of the rows of the table meeting the criteria.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The table.
+    criteria : str or [(str, str, str, str, str)]
+        The criteria as text, or as returned by parse_criteria.
+
+    Returns
+    -------
+    pandas.Index
+        The index of the selected rows.
+    """
+    if isinstance(criteria, str):
+        criteria = parse_criteria(criteria)
+    return table.index[criteria_mask(table, criteria)]
+
+
+def fingerprint(table, columns=()):
+    """A hash of the index and some of the columns of a table.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The table.
+    columns : [str]
+        The names of the columns, which may differ in case from the table.
+
+    Returns
+    -------
+    bytes
+        The hash of the values in the index and columns.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    index = table.index
+    if isinstance(index, pandas.RangeIndex):
+        # Described completely by its start, stop and step
+        h.update(repr((index.start, index.stop, index.step)).encode())
+        data = ()
+    else:
+        data = (index,)
+    for values in (*data, *(table[find_column(table, c)] for c in columns)):
+        if _is_text(values):
+            # The bytes of the array are only pointers to the objects
+            values = pandas.util.hash_pandas_object(values, index=False).to_numpy()
+        else:
+            values = np.ascontiguousarray(values.to_numpy())
+        h.update(str(values.dtype).encode())
+        h.update(memoryview(values).cast("B"))
+    return h.digest()
+
+
+def cached_selection(table, criteria, select):
+    """The index of the selected rows, reusing the result for an unchanged table.
+
+    A loop nested in another loop selects the same rows each time it starts.
+    Matching text in every row is slow, so if any of the criteria do so the
+    result is kept, keyed by the table and the criteria. It is only reused if
+    the table is the same object, with the same shape and columns, and the
+    values in its index and the columns used by the criteria have not
+    changed. Hashing these is cheaper than matching the text again. Other
+    criteria are as quick to evaluate as to check, so the rows are simply
+    selected again.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The table.
+    criteria : ((str, str, str, str, str))
+        The connector, column, operator and values of the criteria, as
+        returned by parse_criteria but as a tuple.
+    select : callable
+        Function returning the index of the selected rows if there is no
+        valid result to reuse.
+
+    Returns
+    -------
+    pandas.Index
+        The index of the selected rows.
+    """
+    if not any(op in _text_operators for _, _, op, _, _ in criteria):
+        return select()
+
+    key = (id(table), criteria)
+    columns = {column for _, column, _, _, _ in criteria}
+    state = (table.shape, tuple(table.columns), fingerprint(table, sorted(columns)))
+    with _selections_lock:
+        entry = _selections.get(key)
+        if entry is not None:
+            reference, previous, indices = entry
+            if reference() is table and previous == state:
+                _selections.move_to_end(key)
+                logger.debug(f"Reusing the selection {criteria}")
+                return indices
+            del _selections[key]
+
+    indices = select()
+
+    with _selections_lock:
+        _selections[key] = (weakref.ref(table), state, indices)
+        while len(_selections) > max_selections:
+            _selections.popitem(last=False)
+    return indices
@@ -133,6 +133,8 @@ class TkLoop(seamm.TkNode):
 
         for widget in (
             "type",
+            "values from",
+            "table source",
             "where",
             "query-op",
             "where system name",
@@ -143,6 +145,14 @@ class TkLoop(seamm.TkNode):
 
         self["errors"].combobox.config(state="readonly")
 
+        self["use cache"].bind("<<ComboboxSelected>>", self.reset_dialog)
+        self["directory layout"].bind("<<ComboboxSelected>>", self.reset_dialog)
+        self["directory layout"].combobox.config(state="readonly")
+        self["iteration output"].bind("<<ComboboxSelected>>", self.reset_dialog)
+        self["iteration output"].combobox.config(state="readonly")
+        self["execution"].bind("<<ComboboxSelected>>", self.reset_dialog)
+        self["execution"].combobox.config(state="readonly")
+
     def criteria_callback(self, widget, criterion, event, what):
         """Handle changes in the search criteria widget.
 
@@ -194,20 +204,39 @@ class TkLoop(seamm.TkNode):
             self["step"].grid(row=row, column=5, sticky=tk.W)
             row += 1
         elif loop_type == "Foreach":
+            frame.columnconfigure(3, weight=0)
             frame.columnconfigure(5, weight=0)
             self["variable"].grid(row=row, column=2, sticky=tk.W)
-            self["values"].grid(row=row, column=3, sticky=tk.EW)
+            self["values from"].grid(row=row, column=3, sticky=tk.W)
+            if self["values from"].get() == "lines of file":
+                self["values file"].grid(row=row, column=4, sticky=tk.EW)
+            else:
+                self["values"].grid(row=row, column=4, sticky=tk.EW)
             row += 1
-            frame.columnconfigure(3, weight=1)
+            self["batch size"].grid(row=row, column=2, columnspan=2, sticky=tk.W)
+            row += 1
+            frame.columnconfigure(4, weight=1)
         elif loop_type == "For rows in table":
             frame.columnconfigure(3, weight=0)
-            self["table"].grid(row=row, column=2, columnspan=2, sticky=tk.EW)
+            frame.columnconfigure(4, weight=0)
+            self["table source"].grid(row=row, column=2, sticky=tk.W)
+            if self["table source"].get() == "file":
+                self["table file"].grid(row=row, column=3, columnspan=2, sticky=tk.EW)
+            else:
+                self["table"].grid(row=row, column=3, columnspan=2, sticky=tk.EW)
             row += 1
             self["as variables"].grid(row=row, column=1, columnspan=2, sticky=tk.EW)
             row += 1
+            self["columns"].grid(row=row, column=1, columnspan=4, sticky=tk.EW)
+            row += 1
+            self["batch size"].grid(row=row, column=1, columnspan=2, sticky=tk.W)
+            row += 1
             self["where"].grid(row=row, column=1, columnspan=2, sticky=tk.EW)
             where = self["where"].get()
-            if where != "Use all rows":
+            if where == "Select rows matching criteria":
+                self["row criteria"].grid(row=row, column=3, columnspan=4, sticky=tk.EW)
+                frame.columnconfigure(3, weight=1)
+            elif where != "Use all rows":
                 self["query-column"].grid(row=row, column=3, sticky=tk.EW)
                 self["query-op"].grid(row=row, column=4)
                 op = self["query-op"].get()
@@ -246,8 +275,34 @@ class TkLoop(seamm.TkNode):
             row += 1
         else:
             raise RuntimeError("Don't recognize the loop_type {}".format(loop_type))
+        self["directory layout"].grid(row=row, column=0, columnspan=2, sticky=tk.W)
+        if self["directory layout"].get() != "flat":
+            self["shard size"].grid(row=row, column=2, columnspan=2, sticky=tk.W)
+        row += 1
+        self["iteration output"].grid(row=row, column=0, columnspan=2, sticky=tk.W)
+        if self["iteration output"].get() == "archive":
+            self["largest archived file"].grid(
+                row=row, column=2, columnspan=2, sticky=tk.W
+            )
+        row += 1
         self["errors"].grid(row=row, column=0, columnspan=4, sticky=tk.W)
         row += 1
+        self["resume"].grid(row=row, column=0, columnspan=4, sticky=tk.W)
+        row += 1
+        if loop_type != "For systems in the database":
+            self["use cache"].grid(row=row, column=0, columnspan=2, sticky=tk.W)
+            if self["use cache"].get() == "yes":
+                self["cache directory"].grid(
+                    row=row, column=2, columnspan=2, sticky=tk.EW
+                )
+                self["cache size"].grid(row=row, column=4, columnspan=2, sticky=tk.W)
+            row += 1
+        self["execution"].grid(row=row, column=0, columnspan=2, sticky=tk.W)
+        if self["execution"].get() != "serial":
+            self["number of workers"].grid(row=row, column=2, columnspan=2, sticky=tk.W)
+        row += 1
+        self["asynchronous output"].grid(row=row, column=0, columnspan=4, sticky=tk.W)
+        row += 1
         frame.columnconfigure(0, minsize=40)
 
     def right_click(self, event):
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for naming the directories of the iterations of a loop."""
+
+from pathlib import Path
+
+import pytest
+
+import loop_step
+import seamm
+
+
+@pytest.fixture
+def loop(tmp_path):
+    """A loop node in a flowchart in a temporary directory."""
+    flowchart = seamm.Flowchart(directory=str(tmp_path))
+    node = loop_step.Loop(flowchart=flowchart)
+    flowchart.add_node(node)
+    flowchart.add_edge(flowchart.get_node("1"), node, edge_type="execution")
+    flowchart.set_ids()
+    Path(node.directory).mkdir(parents=True, exist_ok=True)
+    return node
+
+
+def test_safe_filename_characters(loop):
+    assert loop.safe_filename('a/b\\c?d%e*f:g|h"i<j>k\tl') == "a-b-c-d-e-f-g-h-i-j-k-l"
+    assert loop.safe_filename("water dimer") == "water dimer"
+
+
+def test_safe_filename_duplicates(loop):
+    names = [loop.safe_filename("water") for _ in range(3)]
+    assert names == ["water", "water_2", "water_3"]
+    # Names that clean to the same name are also made unique
+    assert loop.safe_filename("a/b") == "a-b"
+    assert loop.safe_filename("a:b") == "a-b_2"
+
+
+def test_safe_filename_existing(loop):
+    """Names already in the loop's directory, or in its shards, are not used."""
+    directory = Path(loop.directory)
+    (directory / "water").mkdir()
+    (directory / "water_2").mkdir()
+    (directory / "shard_0" / "methane").mkdir(parents=True)
+    assert loop.safe_filename("water") == "water_3"
+    assert loop.safe_filename("methane") == "methane_2"
+    assert loop.safe_filename("ethane") == "ethane"
+
+
+def test_safe_filename_scans_once(loop):
+    """The directory is only read once; later names come from memory."""
+    assert loop.safe_filename("water") == "water"
+    (Path(loop.directory) / "methane").mkdir()
+    assert loop.safe_filename("methane") == "methane"
+
+
+def test_release_filename(loop):
+    """A released name, e.g. of a skipped iteration, is used again."""
+    assert loop.safe_filename("water") == "water"
+    assert loop.safe_filename("water") == "water_2"
+    loop._release_filename("water_2")
+    assert loop.safe_filename("water") == "water_2"
+    loop._release_filename("water")
+    assert loop.safe_filename("water") == "water"
+    assert loop.safe_filename("water") == "water_3"
+    # Names that were not given out are ignored
+    loop._release_filename("unknown")
+    loop._release_filename(None)
+
+
+def shards(loop, layout, size, names):
+    """The shards for iterations with the given directory names."""
+    P = {"directory layout": layout, "shard size": size}
+    loop._loop_length = len(names)
+    result = []
+    for count, name in enumerate(names, start=1):
+        loop._custom_directory_name = name
+        result.append(loop._shard_name(P, count))
+    return result
+
+
+def test_flat(loop):
+    assert shards(loop, "flat", 2, ["a", "b", "c"]) == [None, None, None]
+
+
+def test_sharded_by_iteration(loop):
+    names = [f"iter_{i:02d}" for i in range(1, 12)]
+    assert shards(loop, "sharded by iteration", 4, names) == (
+        ["shard_0"] * 4 + ["shard_1"] * 4 + ["shard_2"] * 3
+    )
+
+
+def test_shard_width(loop):
+    """The shard numbers are padded so that they sort correctly."""
+    names = [f"iter_{i}" for i in range(1, 22)]
+    result = shards(loop, "sharded by iteration", 2, names)
+    assert result[0] == "shard_00"
+    assert result[-1] == "shard_10"
+
+
+def test_sharded_by_name(loop):
+    """The shard depends only on the name, and the names are spread out."""
+    names = [f"system {i}" for i in range(200)]
+    first = shards(loop, "sharded by name", 20, names)
+    assert shards(loop, "sharded by name", 20, names) == first
+    assert len(set(first)) == 10
+    assert all(name.startswith("shard_") for name in first)
+
+
+def test_shard_in_path(loop):
+    loop._loop_length = 10
+    loop._custom_directory_name = "iter_07"
+    loop._shard = loop._shard_name(
+        {"directory layout": "sharded by iteration", "shard size": 5}, 7
+    )
+    assert loop.iteration_directory == "shard_1/iter_07"
+    assert loop.working_path == Path(loop.directory) / "shard_1" / "iter_07"
+
+
+def test_unknown_layout(loop):
+    with pytest.raises(RuntimeError):
+        shards(loop, "sideways", 2, ["a"])
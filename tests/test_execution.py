@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for running the iterations of loops in threads."""
+
+import logging
+import threading
+
+from loop_step.execution import ThreadLocalVariables, ThreadRoutingHandler
+
+
+def run_in_thread(function, *args):
+    """Run a function in a new thread and return its result or exception."""
+    result = {}
+
+    def target():
+        try:
+            result["value"] = function(*args)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def test_main_thread():
+    """The thread creating the variables uses them directly."""
+    variables = ThreadLocalVariables({"x": 1})
+    variables["y"] = 2
+    assert variables["x"] == 1
+    assert sorted(variables) == ["x", "y"]
+    assert dict.get(variables, "y") == 2
+
+
+def test_read_in_worker():
+    """A worker thread sees the shared variables."""
+    variables = ThreadLocalVariables({"x": 1, "y": "two"})
+
+    def read():
+        return variables["x"], variables.get("y"), "x" in variables, len(variables)
+
+    assert run_in_thread(read) == (1, "two", True, 2)
+
+
+def test_write_in_worker():
+    """Variables written by a worker thread are private to it."""
+    variables = ThreadLocalVariables({"x": 1})
+
+    def write():
+        variables["x"] = 10
+        variables["z"] = 3
+        del variables["x"]
+        variables["x"] = 11
+        return dict(variables.items())
+
+    assert run_in_thread(write) == {"x": 11, "z": 3}
+    assert dict(variables.items()) == {"x": 1}
+
+
+def test_workers_are_independent():
+    """Each worker thread has its own copy of the variables."""
+    variables = ThreadLocalVariables({"count": 0})
+    started = threading.Barrier(2)
+    results = [None, None]
+
+    def work(n):
+        started.wait()
+        for _ in range(1000):
+            variables["count"] = variables["count"] + n
+        results[n - 1] = variables["count"]
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1000, 2000]
+    assert variables["count"] == 0
+
+
+def test_routing_handler():
+    """Records only go to the handlers for the thread that created them."""
+    logger = logging.getLogger("test_routing_handler")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    router = ThreadRoutingHandler()
+    logger.addHandler(router)
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    main = ListHandler()
+    router.add(main)
+    worker = ListHandler()
+
+    def log():
+        router.add(worker)
+        logger.info("from the worker")
+        router.remove(worker)
+        logger.info("after removing")
+
+    try:
+        logger.info("from main")
+        run_in_thread(log)
+    finally:
+        logger.removeHandler(router)
+    assert main.messages == ["from main"]
+    assert worker.messages == ["from the worker"]
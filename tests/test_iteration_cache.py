@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the cache of loop iterations in `loop_step.iteration_cache`."""
+
+import os
+
+from loop_step.iteration_cache import IterationCache
+
+
+def iteration(path, name, size):
+    """A directory for an iteration with a file of the given size."""
+    directory = path / name
+    directory.mkdir()
+    (directory / "data").write_bytes(b"x" * size)
+    return directory
+
+
+def test_round_trip(tmp_path):
+    cache = IterationCache(tmp_path / "cache", 1.0e6)
+    key = IterationCache.make_key("Foreach", "x", 1)
+    cache.put(key, iteration(tmp_path, "iter", 10), {"energy": -1.5})
+
+    destination = tmp_path / "restored"
+    assert cache.get(key, destination) == {"energy": -1.5}
+    assert (destination / "data").read_bytes() == b"x" * 10
+
+
+def test_missing(tmp_path):
+    cache = IterationCache(tmp_path / "cache", 1.0e6)
+    assert cache.get("0" * 64, tmp_path / "restored") is None
+
+
+def test_make_key():
+    assert IterationCache.make_key(1, "a") == IterationCache.make_key(1, "a")
+    assert IterationCache.make_key(1, "a") != IterationCache.make_key(2, "a")
+
+
+def test_evict_least_recently_used(tmp_path):
+    """The oldest entries are removed until the cache is below the low water."""
+    cache = IterationCache(tmp_path / "cache", 3500)
+    keys = [IterationCache.make_key(i) for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.put(key, iteration(tmp_path, f"iter_{i}", 1000), {})
+        os.utime(cache.path / key, (i, i))
+    # Using the first entry makes the second the least recently used
+    cache.get(keys[0], tmp_path / "restored")
+
+    cache.put(keys[3], iteration(tmp_path, "iter_3", 1000), {})
+    remaining = {key for key in keys if (cache.path / key).exists()}
+    assert remaining == {keys[0], keys[2], keys[3]}
+    assert cache.size <= cache.max_size
+
+
+def test_size_kept_up_to_date(tmp_path, monkeypatch):
+    """The entries are only scanned again when the cache is full."""
+    cache = IterationCache(tmp_path / "cache", 1.0e6)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+    for i in range(5):
+        cache.put(IterationCache.make_key(i), iteration(tmp_path, f"i{i}", 100), {})
+    assert len(scans) == 1
+    assert cache.size >= 500
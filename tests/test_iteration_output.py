@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for handling the output of iterations in `loop_step.iteration_output`."""
+
+import logging
+import threading
+
+import pytest
+
+from loop_step.iteration_output import (
+    AsynchronousOutput,
+    DirectoryReaper,
+    IterationOutputHandler,
+)
+
+
+@pytest.fixture
+def output():
+    """A logger that only writes to its own handlers."""
+    logger = logging.getLogger("test_iteration_output")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    yield logger
+    for handler in [*logger.handlers]:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def test_retarget(output, tmp_path):
+    """One handler writes each iteration to its own file."""
+    handler = IterationOutputHandler()
+    output.addHandler(handler)
+    for i in range(3):
+        handler.retarget(tmp_path / f"{i}.out")
+        output.info(f"iteration {i}")
+    handler.retarget(None)
+    output.info("between iterations")
+    handler.close()
+
+    for i in range(3):
+        assert (tmp_path / f"{i}.out").read_text() == f"iteration {i}\n"
+
+
+def test_buffered(output, tmp_path):
+    """The output is only written when flushed."""
+    handler = IterationOutputHandler()
+    output.addHandler(handler)
+    path = tmp_path / "iteration.out"
+    handler.retarget(path)
+    output.info("buffered")
+    assert path.read_text() == ""
+    handler.flush()
+    assert path.read_text() == "buffered\n"
+    handler.close()
+
+
+def test_append(output, tmp_path):
+    """Mode 'a' adds to the file, and 'w' replaces it."""
+    path = tmp_path / "iteration.out"
+    path.write_text("restored\n")
+    handler = IterationOutputHandler()
+    output.addHandler(handler)
+    handler.retarget(path, "a")
+    output.info("new")
+    handler.retarget(None)
+    assert path.read_text() == "restored\nnew\n"
+
+    handler.retarget(path)
+    output.info("again")
+    handler.close()
+    assert path.read_text() == "again\n"
+
+
+def test_level(output, tmp_path):
+    handler = IterationOutputHandler(level=logging.WARNING)
+    output.addHandler(handler)
+    handler.retarget(tmp_path / "iteration.out")
+    output.info("ignored")
+    output.warning("written")
+    handler.close()
+    assert (tmp_path / "iteration.out").read_text() == "written\n"
+
+
+def test_no_file(output):
+    """Without a file the output is dropped."""
+    handler = IterationOutputHandler()
+    output.addHandler(handler)
+    output.info("dropped")
+    handler.flush()
+    assert handler.path is None
+    assert "None" in repr(handler)
+    handler.close()
+
+
+class Recorder(logging.Handler):
+    """A handler that remembers the messages and the threads handling them."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.threads.add(threading.current_thread().name)
+
+
+def test_asynchronous(output):
+    """The records are handled in a background thread, in order."""
+    recorder = Recorder()
+    output.addHandler(recorder)
+    asynchronous = AsynchronousOutput(output)
+    asynchronous.start()
+    try:
+        assert AsynchronousOutput.active(output) is asynchronous
+        assert recorder not in output.handlers
+        for i in range(100):
+            output.info(f"line {i}")
+        asynchronous.wait()
+        assert recorder.messages == [f"line {i}" for i in range(100)]
+        assert threading.current_thread().name not in recorder.threads
+    finally:
+        asynchronous.stop()
+    assert AsynchronousOutput.active(output) is None
+    assert recorder in output.handlers
+    assert asynchronous.queue_handler not in output.handlers
+
+
+def test_asynchronous_calls_in_order(output, tmp_path):
+    """Retargeting in the background happens after the earlier records."""
+    handler = IterationOutputHandler()
+    asynchronous = AsynchronousOutput(output)
+    asynchronous.start()
+    try:
+        asynchronous.addHandler(handler)
+        for i in range(3):
+            asynchronous.call(handler.retarget, tmp_path / f"{i}.out")
+            output.info(f"iteration {i}")
+        asynchronous.call(handler.retarget, None)
+        asynchronous.removeHandler(handler)
+        output.info("after")
+        asynchronous.wait()
+        assert handler not in asynchronous.listener.handlers
+    finally:
+        asynchronous.stop()
+    handler.close()
+
+    for i in range(3):
+        assert (tmp_path / f"{i}.out").read_text() == f"iteration {i}\n"
+
+
+def test_asynchronous_stop_writes_queue(output):
+    """Stopping writes any queued output first."""
+    recorder = Recorder()
+    output.addHandler(recorder)
+    asynchronous = AsynchronousOutput(output)
+    asynchronous.start()
+    for i in range(10):
+        output.info(f"line {i}")
+    asynchronous.stop()
+    assert recorder.messages == [f"line {i}" for i in range(10)]
+
+
+def test_asynchronous_restart(output):
+    """A new thread and queue carry on with the same handlers."""
+    recorder = Recorder()
+    output.addHandler(recorder)
+    asynchronous = AsynchronousOutput(output)
+    asynchronous.start()
+    try:
+        output.info("before")
+        asynchronous.wait()
+        # As in a forked process, where the old thread is not running
+        asynchronous.listener.stop()
+        asynchronous.restart()
+        output.info("after")
+        asynchronous.wait()
+    finally:
+        asynchronous.stop()
+    assert recorder.messages == ["before", "after"]
+
+
+def test_bury(tmp_path):
+    """The directory is renamed at once, so its name can be used again."""
+    path = tmp_path / "iter_1"
+    (path / "step_1").mkdir(parents=True)
+    (path / "step_1" / "step.out").write_text("output")
+    tombstone = DirectoryReaper().bury(path)
+    assert not path.exists()
+    assert tombstone.parent == tmp_path
+    assert tombstone.name.startswith(".deleted_iter_1_")
+    assert (tombstone / "step_1" / "step.out").read_text() == "output"
+
+
+def test_bury_missing(tmp_path):
+    assert DirectoryReaper().bury(tmp_path / "iter_1") is None
+
+
+def test_reap(tmp_path):
+    """Tombstones are removed in the background, and join() waits for them."""
+    reaper = DirectoryReaper()
+    tombstones = []
+    for i in range(3):
+        path = tmp_path / f"iter_{i}"
+        path.mkdir()
+        (path / "step.out").write_text("output")
+        tombstones.append(reaper.bury(path))
+    for tombstone in tombstones:
+        reaper.reap(tombstone)
+    reaper.reap(None)
+    reaper.join()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_reap_after_join(tmp_path):
+    """The thread is started again if needed after join()."""
+    reaper = DirectoryReaper()
+    reaper.join()
+    for name in ("iter_1", "iter_2"):
+        (tmp_path / name).mkdir()
+        reaper.reap(reaper.bury(tmp_path / name))
+        reaper.join()
+        assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the journal of loop iterations in `loop_step.journal`."""
+
+import json
+
+from loop_step.journal import LoopJournal
+
+
+def test_record(tmp_path):
+    journal = LoopJournal(tmp_path)
+    journal.record("a", 1, "iter_1", "running", start=10.0)
+    journal.record("a", 1, "iter_1", "success", start=10.0, elapsed=1.23456)
+    journal.close()
+
+    lines = (tmp_path / LoopJournal.filename).read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[-1]) == {
+        "key": "a",
+        "iteration": 1,
+        "directory": "iter_1",
+        "status": "success",
+        "start": 10.0,
+        "elapsed": 1.235,
+    }
+    assert len(journal) == 1
+    assert journal.directory("a") == "iter_1"
+    assert journal.directory("b") is None
+
+
+def test_complete(tmp_path):
+    journal = LoopJournal(tmp_path)
+    for key, status in [
+        (1, "success"),
+        (2, "continue"),
+        (3, "skip"),
+        (4, "error"),
+        (5, "running"),
+    ]:
+        journal.record(key, key, f"iter_{key}", status)
+    assert [journal.is_complete(key) for key in range(1, 7)] == [
+        True,
+        True,
+        True,
+        False,
+        False,
+        False,
+    ]
+    assert journal.n_complete == 3
+    journal.close()
+
+
+def test_resume(tmp_path):
+    """Resuming reads the last status of each iteration and appends to it."""
+    journal = LoopJournal(tmp_path)
+    journal.record(1, 1, "iter_1", "success")
+    journal.record(2, 2, "iter_2", "running")
+    journal.close()
+
+    journal = LoopJournal(tmp_path, resume=True)
+    assert len(journal) == 2
+    assert journal.is_complete(1) and not journal.is_complete(2)
+    journal.record(2, 2, "iter_2", "success")
+    journal.close()
+
+    lines = (tmp_path / LoopJournal.filename).read_text().splitlines()
+    assert len(lines) == 3
+    assert LoopJournal(tmp_path, resume=True).n_complete == 2
+
+
+def test_no_resume(tmp_path):
+    """Without resuming, any existing journal is replaced."""
+    journal = LoopJournal(tmp_path)
+    journal.record(1, 1, "iter_1", "success")
+    journal.close()
+
+    journal = LoopJournal(tmp_path)
+    assert len(journal) == 0
+    journal.close()
+    assert (tmp_path / LoopJournal.filename).read_text() == ""
+
+
+def test_truncated_record(tmp_path):
+    """A record cut short, e.g. by the job being killed, is ignored."""
+    path = tmp_path / LoopJournal.filename
+    record = {"key": "1", "iteration": 1, "directory": "iter_1", "status": "success"}
+    path.write_text(json.dumps(record) + '\n{"key": "2", "itera')
+
+    journal = LoopJournal(tmp_path, resume=True)
+    assert len(journal) == 1
+    assert journal.is_complete(1)
+    journal.close()
+
+
+def test_close_twice(tmp_path):
+    journal = LoopJournal(tmp_path)
+    journal.close()
+    journal.close()
+    # Records after closing are kept in memory only
+    journal.record(1, 1, "iter_1", "success")
+    assert journal.is_complete(1)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for running the iterations of a loop serially or in pools of workers."""
+
+import os
+from pathlib import Path
+import sqlite3
+import threading
+
+import pytest
+
+import loop_step
+from loop_step import loop as loop_module
+import seamm
+
+molsystem = pytest.importorskip("molsystem")
+
+
+class Body(seamm.Node):
+    """A step in the body of the loop that records what it did.
+
+    Each iteration sets 'last' to the loop variable, 'pid x' and 'thread x'
+    to the process and thread that ran it, and 'id x' to the id of the step.
+    In a loop over 'table1' the value is the column 'n', and the column
+    'double' is set. If 'read database' is set, 'name x' is set to the name of
+    the current system. If 'use database' is set, or 'write at' is the value,
+    a system named after the value is added to the database. If 'connection'
+    is set, it is used. If 'break at' is set, the loop is exited at that value.
+    """
+
+    def __init__(self, flowchart=None):
+        super().__init__(flowchart=flowchart, title="Body")
+
+    @property
+    def version(self):
+        return "1.0"
+
+    def run(self):
+        if self.variable_exists("table1"):
+            handle = self.get_variable("table1")
+            table, index = handle["table"], handle["current index"]
+            x = int(table.at[index, "n"])
+            table.at[index, "double"] = 2 * x
+        else:
+            x = int(self.get_variable("x"))
+        self.set_variable("last", x)
+        self.set_variable(f"pid {x}", os.getpid())
+        self.set_variable(f"thread {x}", threading.current_thread().name)
+        self.set_variable(f"id {x}", self._id)
+        if self.variable_exists("read database"):
+            system_db = self.get_variable("_system_db")
+            self.set_variable(f"name {x}", system_db.system.name)
+        if self.variable_exists("use database") or (
+            self.variable_exists("write at") and x == self.get_variable("write at")
+        ):
+            system_db = self.get_variable("_system_db")
+            system_db.create_system(f"system {x}")
+        if self.variable_exists("use references"):
+            self.references.conn.execute("SELECT 1")
+        if self.variable_exists("connection"):
+            self.get_variable("connection").execute("SELECT 1")
+        if self.variable_exists("break at") and x == self.get_variable("break at"):
+            raise loop_step.BreakLoop()
+        return super().run()
+
+
+@pytest.fixture
+def variables():
+    """Fresh flowchart variables for each test."""
+    saved = seamm.flowchart_variables
+    seamm.flowchart_variables = variables = seamm.Variables()
+    yield variables
+    seamm.flowchart_variables = saved
+    # Close the database here, not wherever it is garbage collected
+    if "_system_db" in variables:
+        variables["_system_db"].close()
+
+
+@pytest.fixture
+def loop(tmp_path, variables):
+    """A Foreach loop over 1-4 with the Body step in it."""
+    flowchart = seamm.Flowchart(directory=str(tmp_path))
+    start = flowchart.get_node("1")
+    node = loop_step.Loop(flowchart=flowchart)
+    flowchart.add_node(node)
+    body = Body(flowchart=flowchart)
+    flowchart.add_node(body)
+    flowchart.add_edge(node, body, edge_type="execution", edge_subtype="loop")
+    flowchart.add_edge(body, node, edge_type="execution")
+    flowchart.add_edge(start, node, edge_type="execution")
+    node.parameters["type"].value = "Foreach"
+    node.parameters["variable"].value = "x"
+    node.parameters["values"].value = "1 2 3 4"
+    node.parameters["number of workers"].value = 2
+    flowchart.set_ids()
+    return node
+
+
+def database(filename, variables):
+    """A database with one system, as the default for the flowchart."""
+    system_db = molsystem.SystemDB(filename=filename)
+    system = system_db.create_system("initial")
+    system.create_configuration("first")
+    variables["_system_db"] = system_db
+    return system_db
+
+
+def table(variables):
+    """A table with the values 1-4, for a loop over its rows."""
+    pandas = pytest.importorskip("pandas")
+    data = pandas.DataFrame({"n": [1, 2, 3, 4], "double": [0, 0, 0, 0]})
+    variables["table1"] = {"table": data, "defaults": {}, "index column": None}
+    return data
+
+
+def threads(variables):
+    """The threads that ran the iterations."""
+    return {variables[f"thread {x}"] for x in range(1, 5)}
+
+
+def pids(variables):
+    """The processes that ran the iterations."""
+    return {variables[f"pid {x}"] for x in range(1, 5)}
+
+
+def test_serial(loop, variables):
+    loop.run()
+    assert variables["last"] == 4
+    assert pids(variables) == {os.getpid()}
+    assert "_loop_index" not in variables
+
+
+def test_serial_break(loop, variables):
+    variables["break at"] = 2
+    loop.run()
+    assert variables["last"] == 2
+    assert "pid 3" not in variables
+
+
+def test_process_pool(loop, variables):
+    """The variables set in the workers are set in the main process."""
+    loop.parameters["execution"].value = "process pool"
+    loop.run()
+    assert variables["last"] == 4
+    assert os.getpid() not in pids(variables)
+    assert "_loop_index" not in variables
+
+
+def test_process_pool_database(loop, variables, tmp_path):
+    """Workers read the database with their own connections."""
+    system_db = database(str(tmp_path / "seamm.db"), variables)
+    variables["read database"] = True
+    loop.parameters["execution"].value = "process pool"
+    loop.run()
+    # The first iteration is run here, to see how it uses the database
+    assert variables["pid 1"] == os.getpid()
+    assert os.getpid() not in {variables[f"pid {x}"] for x in range(2, 5)}
+    assert {variables[f"name {x}"] for x in range(1, 5)} == {"initial"}
+    assert variables["_system_db"] is system_db
+
+
+def test_process_pool_changes_database(loop, variables, tmp_path):
+    """A body changing the database runs serially."""
+    system_db = database(str(tmp_path / "seamm.db"), variables)
+    variables["use database"] = True
+    loop.parameters["execution"].value = "process pool"
+    loop.run()
+    assert pids(variables) == {os.getpid()}
+    assert system_db.n_systems == 5
+
+
+def test_process_pool_late_change(loop, variables, tmp_path):
+    """Changing the database in a worker stops the loop."""
+    system_db = database(str(tmp_path / "seamm.db"), variables)
+    variables["read database"] = True
+    variables["write at"] = 3
+    loop.parameters["execution"].value = "process pool"
+    with pytest.raises(RuntimeError, match="tried to change the database"):
+        loop.run()
+    assert system_db.n_systems == 1
+
+
+def test_memory_database(loop, variables):
+    """A body using a database in memory runs serially."""
+    system_db = database(":memory:", variables)
+    variables["use database"] = True
+    loop.parameters["execution"].value = "process pool"
+    loop.run()
+    assert pids(variables) == {os.getpid()}
+    assert system_db.n_systems == 5
+
+
+def test_memory_database_unused(loop, variables):
+    """A body not using a database in memory still runs in the workers."""
+    database(":memory:", variables)
+    loop.parameters["execution"].value = "process pool"
+    loop.run()
+    assert variables["last"] == 4
+    # The first iteration is run here, to see whether it uses the database
+    assert variables["pid 1"] == os.getpid()
+    assert os.getpid() not in {variables[f"pid {x}"] for x in range(2, 5)}
+
+
+def test_no_fork(loop, variables, monkeypatch):
+    """Without fork the iterations are run serially."""
+    monkeypatch.setattr(loop_module, "_can_fork", lambda: False)
+    loop.parameters["execution"].value = "process pool"
+    loop.run()
+    assert variables["last"] == 4
+    assert pids(variables) == {os.getpid()}
+
+
+def test_run_returns_exit(loop, variables):
+    """The loop falls through to the step after it, here none."""
+    loop.parameters["execution"].value = "process pool"
+    assert loop.run() is None
+
+
+def test_process_pool_table(loop, variables):
+    """Changes to the rows in the workers are put back in the table."""
+    data = table(variables)
+    loop.parameters["type"].value = "For rows in table"
+    loop.parameters["execution"].value = "process pool"
+    loop.run()
+    assert data["double"].tolist() == [2, 4, 6, 8]
+    assert os.getpid() not in pids(variables)
+
+
+def test_thread_pool(loop, variables):
+    """The variables set in the threads are set in the main thread."""
+    loop.parameters["execution"].value = "thread pool"
+    loop.run()
+    assert variables["last"] == 4
+    assert all(name.startswith("loop") for name in threads(variables))
+    assert "_loop_index" not in variables
+
+
+def test_thread_pool_table(loop, variables):
+    """Each thread has a copy of the table, and the changes are merged."""
+    data = table(variables)
+    loop.parameters["type"].value = "For rows in table"
+    loop.parameters["execution"].value = "thread pool"
+    loop.run()
+    assert data["double"].tolist() == [2, 4, 6, 8]
+    assert all(name.startswith("loop") for name in threads(variables))
+
+
+def test_thread_pool_database(loop, variables, tmp_path):
+    """Each iteration in a thread has its own connection to the database."""
+    system_db = database(str(tmp_path / "seamm.db"), variables)
+    variables["read database"] = True
+    loop.parameters["execution"].value = "thread pool"
+    loop.run()
+    assert variables["thread 1"] == threading.current_thread().name
+    assert all(variables[f"thread {x}"].startswith("loop") for x in range(2, 5))
+    assert {variables[f"name {x}"] for x in range(1, 5)} == {"initial"}
+    assert variables["_system_db"] is system_db
+
+
+def test_thread_pool_changes_database(loop, variables, tmp_path):
+    """A body changing the database runs serially."""
+    system_db = database(str(tmp_path / "seamm.db"), variables)
+    variables["use database"] = True
+    loop.parameters["execution"].value = "thread pool"
+    loop.run()
+    assert threads(variables) == {threading.current_thread().name}
+    assert system_db.n_systems == 5
+
+
+def test_thread_pool_late_change(loop, variables, tmp_path):
+    """Changing the database in a thread stops the loop."""
+    system_db = database(str(tmp_path / "seamm.db"), variables)
+    variables["read database"] = True
+    variables["write at"] = 3
+    loop.parameters["execution"].value = "thread pool"
+    with pytest.raises(RuntimeError, match="tried to change the database"):
+        loop.run()
+    assert system_db.n_systems == 1
+
+
+def test_thread_pool_memory_database(loop, variables):
+    """A body using a database in memory runs serially."""
+    system_db = database(":memory:", variables)
+    variables["use database"] = True
+    loop.parameters["execution"].value = "thread pool"
+    loop.run()
+    assert threads(variables) == {threading.current_thread().name}
+    assert system_db.n_systems == 5
+
+
+def test_thread_pool_references(loop, variables):
+    """The handler for the references is opened again in each thread."""
+    body = loop.loop_node()
+    assert body.references is not None
+    variables["use references"] = True
+    loop.parameters["execution"].value = "thread pool"
+    loop.run()
+    assert all(name.startswith("loop") for name in threads(variables))
+
+
+def test_thread_pool_other_connection(loop, variables):
+    """Using a connection from the main thread stops the loop."""
+    variables["connection"] = sqlite3.connect(":memory:")
+    loop.parameters["execution"].value = "thread pool"
+    with pytest.raises(RuntimeError, match="another thread"):
+        loop.run()
+
+
+@pytest.mark.parametrize(
+    "name, parameter, value",
+    [
+        ("LoopJournal", None, None),
+        ("DirectoryReaper", None, None),
+        ("OutputArchive", "iteration output", "archive"),
+        ("IterationCache", "use cache", "yes"),
+    ],
+)
+def test_setup_error(loop, variables, monkeypatch, name, parameter, value):
+    """If setting up the loop fails, the loop is still cleaned up."""
+
+    class Failing(getattr(loop_module, name)):
+        def __init__(self, *args, **kwargs):
+            raise OSError("cannot set up")
+
+    monkeypatch.setattr(loop_module, name, Failing)
+    if parameter is not None:
+        loop.parameters[parameter].value = value
+    handlers = [(h, h.level) for h in loop_module.job.handlers]
+    with pytest.raises(OSError, match="cannot set up"):
+        loop.run()
+    assert [(h, h.level) for h in loop_module.job.handlers] == handlers
+    assert "_loop_index" not in variables
+    assert loop._journal is None and loop._reaper is None
+
+
+class Sub(seamm.Node):
+    """A step with a subflowchart holding a loop, like e.g. MOPAC."""
+
+    def __init__(self, flowchart=None):
+        super().__init__(flowchart=flowchart, title="Sub")
+        self.subflowchart = seamm.Flowchart(
+            parent=self, directory=flowchart.root_directory
+        )
+        self.inner = loop_step.Loop(flowchart=self.subflowchart)
+        self.subflowchart.add_node(self.inner)
+        start = self.subflowchart.get_node("1")
+        self.subflowchart.add_edge(start, self.inner, edge_type="execution")
+
+    @property
+    def version(self):
+        return "1.0"
+
+
+def test_body_signature_subflowchart(tmp_path, variables):
+    """The parameters in subflowcharts are part of the key for the cache."""
+    flowchart = seamm.Flowchart(directory=str(tmp_path))
+    node = loop_step.Loop(flowchart=flowchart)
+    flowchart.add_node(node)
+    body = Sub(flowchart=flowchart)
+    flowchart.add_node(body)
+    flowchart.add_edge(node, body, edge_type="execution", edge_subtype="loop")
+    flowchart.add_edge(body, node, edge_type="execution")
+
+    before = node._body_signature()
+    body.inner.parameters["values"].value = "$energy 2"
+    after = node._body_signature()
+    assert after["nodes"] != before["nodes"]
+    assert after["variables"] == ["energy"]
+
+
+class Owner(seamm.Node):
+    """A step with its own set_id, numbering the step after it as its child."""
+
+    def __init__(self, flowchart=None):
+        super().__init__(flowchart=flowchart, title="Owner")
+
+    @property
+    def version(self):
+        return "1.0"
+
+    def set_id(self, node_id):
+        if self.visited:
+            return None
+        self.visited = True
+        self._id = node_id
+        child = self.next()
+        child.set_id((*node_id, "child"))
+        return child.next()
+
+
+def test_ids_set_by_other_steps(tmp_path, variables):
+    """Steps numbered by a step with its own set_id get the id each iteration."""
+    flowchart = seamm.Flowchart(directory=str(tmp_path))
+    start = flowchart.get_node("1")
+    node = loop_step.Loop(flowchart=flowchart)
+    flowchart.add_node(node)
+    owner = Owner(flowchart=flowchart)
+    flowchart.add_node(owner)
+    body = Body(flowchart=flowchart)
+    flowchart.add_node(body)
+    flowchart.add_edge(node, owner, edge_type="execution", edge_subtype="loop")
+    flowchart.add_edge(owner, body, edge_type="execution")
+    flowchart.add_edge(body, node, edge_type="execution")
+    flowchart.add_edge(start, node, edge_type="execution")
+    node.parameters["type"].value = "Foreach"
+    node.parameters["variable"].value = "x"
+    node.parameters["values"].value = "1 2 3"
+    flowchart.set_ids()
+
+    node.run()
+    ids = [variables[f"id {x}"] for x in range(1, 4)]
+    assert len(set(ids)) == 3
+    assert all(i[-1] == "child" for i in ids)
+
+
+@pytest.mark.parametrize("execution", ["serial", "process pool", "thread pool"])
+def test_table_file(loop, variables, tmp_path, execution):
+    """The rows of a table in a file, which are not counted up front."""
+    pytest.importorskip("pandas")
+    path = tmp_path / "table.csv"
+    path.write_text("x\n1\n2\n3\n4\n")
+    loop.parameters["type"].value = "For rows in table"
+    loop.parameters["table source"].value = "file"
+    loop.parameters["table file"].value = str(path)
+    loop.parameters["where"].value = "Select rows matching criteria"
+    loop.parameters["row criteria"].value = "x > 1"
+    loop.parameters["batch size"].value = 2
+    loop.parameters["execution"].value = execution
+    assert "batches" not in loop.description_text()
+    loop.run()
+    assert variables["last"] == 4
+    assert {f"pid {x}" for x in range(1, 5)} & set(variables) == {
+        "pid 2",
+        "pid 3",
+        "pid 4",
+    }
+    assert sorted(p.name for p in Path(loop.directory).glob("iter_*")) == [
+        "iter_0000002",
+        "iter_0000003",
+        "iter_0000004",
+    ]
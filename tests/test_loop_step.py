@@ -3,8 +3,12 @@
 
 """Tests for `loop_step` package."""
 
+import concurrent.futures
+import gzip
+
 import pytest  # noqa: F401
 import loop_step  # noqa: F401
+from loop_step.sequences import Batches, FileLines, ForRange
 
 
 @pytest.fixture
@@ -21,3 +25,167 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+@pytest.mark.parametrize(
+    "start, end, step, expected",
+    [
+        (1, 5, 1, [1, 2, 3, 4, 5]),
+        (1, 6, 2, [1, 3, 5]),
+        (5, 1, -1, [5, 4, 3, 2, 1]),
+        (10, 0, -3, [10, 7, 4, 1]),
+        (3, 3, 1, [3]),
+        (3, 3, -1, [3]),
+        (5, 1, 1, []),
+        (1, 5, -1, []),
+        (-2, 2, 2, [-2, 0, 2]),
+    ],
+)
+def test_for_range_integers(start, end, step, expected):
+    values = ForRange(start, end, step)
+    assert len(values) == len(expected)
+    assert list(values) == expected
+    assert [values[k] for k in range(len(values))] == expected
+    assert all(isinstance(v, int) for v in values)
+
+
+def test_for_range_decimal_step():
+    """Decimal steps give the exact values, without drift, and include the end."""
+    values = ForRange(0, 1, 0.1)
+    assert len(values) == 11
+    assert list(values) == [k / 10 for k in range(11)]
+    assert values[3] == 0.3
+    assert values[-1] == 1.0
+
+
+def test_for_range_descending_decimal():
+    values = ForRange(1.0, 0.5, -0.25)
+    assert list(values) == [1.0, 0.75, 0.5]
+
+
+def test_for_range_no_drift():
+    """The 1000th value is exact, unlike adding 0.001 a thousand times."""
+    values = ForRange(0, 1, 0.001)
+    assert len(values) == 1001
+    assert values[1000] == 1.0
+    assert values[999] == 0.999
+
+
+def test_for_range_end_not_reached():
+    """The end is only included if it is on a step."""
+    assert list(ForRange(0, 1, 0.3)) == [0.0, 0.3, 0.6, 0.9]
+    assert list(ForRange(0.5, 2, 1)) == [0.5, 1.5]
+
+
+def test_for_range_large():
+    """Large ranges are not generated to find their length or values."""
+    values = ForRange(0, 10**15, 3)
+    assert len(values) == 10**15 // 3 + 1
+    assert values[-1] == 10**15 - 1
+    assert values[10**14] == 3 * 10**14
+    assert values[2:5] == [6, 9, 12]
+
+
+def test_for_range_index_errors():
+    values = ForRange(1, 3, 1)
+    assert values[-3] == 1
+    with pytest.raises(IndexError):
+        values[3]
+    with pytest.raises(IndexError):
+        values[-4]
+    with pytest.raises(IndexError):
+        ForRange(5, 1, 1)[0]
+
+
+def test_for_range_zero_step():
+    with pytest.raises(ValueError):
+        ForRange(1, 5, 0)
+
+
+@pytest.fixture(params=["values.txt", "values.txt.gz"])
+def values_file(request, tmp_path):
+    """A file of values with blank lines and surrounding whitespace."""
+    text = "water\n\n  methane  \r\n\t\nethane\nhydrogen peroxide\n   \nlast"
+    path = tmp_path / request.param
+    if path.suffix == ".gz":
+        with gzip.open(path, "wt", encoding="utf-8") as fd:
+            fd.write(text)
+    else:
+        path.write_text(text, encoding="utf-8")
+    return path
+
+
+def test_file_lines(values_file):
+    expected = ["water", "methane", "ethane", "hydrogen peroxide", "last"]
+    values = FileLines(values_file)
+    try:
+        assert len(values) == len(expected)
+        assert list(values) == expected
+        assert [values[k] for k in range(len(values))] == expected
+        assert [values[k] for k in (4, 0, 2)] == ["last", "water", "ethane"]
+        assert values[-1] == "last"
+        assert values[1:3] == ["methane", "ethane"]
+        with pytest.raises(IndexError):
+            values[5]
+    finally:
+        values.close()
+
+
+def test_file_lines_threads(values_file):
+    """Threads sharing the file each read the right lines."""
+    expected = ["water", "methane", "ethane", "hydrogen peroxide", "last"] * 200
+    values = FileLines(values_file)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            read = list(executor.map(lambda k: values[k % 5], range(len(expected))))
+        assert read == expected
+    finally:
+        values.close()
+
+
+def test_file_lines_unicode(tmp_path):
+    path = tmp_path / "names.txt"
+    path.write_text("α-pinene\nβ-carotene\n", encoding="utf-8")
+    values = FileLines(path)
+    assert values[1] == "β-carotene"
+    assert values[0] == "α-pinene"
+    values.close()
+
+
+def test_file_lines_empty(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_text("\n  \n", encoding="utf-8")
+    values = FileLines(path)
+    assert len(values) == 0
+    assert list(values) == []
+
+
+@pytest.mark.parametrize(
+    "n, size, expected",
+    [
+        (7, 3, [[0, 1, 2], [3, 4, 5], [6]]),
+        (6, 3, [[0, 1, 2], [3, 4, 5]]),
+        (2, 5, [[0, 1]]),
+        (0, 4, []),
+        (3, 1, [[0], [1], [2]]),
+    ],
+)
+def test_batches(n, size, expected):
+    batches = Batches(list(range(n)), size)
+    assert len(batches) == len(expected)
+    assert list(batches) == expected
+    if n > 0:
+        assert batches[-1] == expected[-1]
+    with pytest.raises(IndexError):
+        batches[len(expected)]
+
+
+def test_batches_of_range():
+    """Batches of a ForRange, which are lists of the values."""
+    batches = Batches(ForRange(10, 1, -2), 2)
+    assert list(batches) == [[10, 8], [6, 4], [2]]
+
+
+def test_batches_size():
+    with pytest.raises(ValueError):
+        Batches([1, 2, 3], 0)
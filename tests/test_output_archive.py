@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the archive of iteration output in `loop_step.output_archive`."""
+
+import os
+
+import pytest
+
+from loop_step.output_archive import OutputArchive
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """An archive that keeps files of up to 100 bytes."""
+    archive = OutputArchive(tmp_path / OutputArchive.filename, max_file_size=100)
+    yield archive
+    archive.close()
+
+
+@pytest.fixture
+def iteration(tmp_path):
+    """The directory of an iteration with small and large files."""
+    path = tmp_path / "iter_1"
+    (path / "step_1").mkdir(parents=True)
+    (path / "iteration.out").write_text("output\n")
+    (path / "step_1" / "energy.json").write_text('{"energy": -1.0}')
+    (path / "step_1" / "large.dat").write_bytes(b"x" * 1000)
+    return path
+
+
+def test_add_directory(archive, iteration):
+    """Small files are moved into the archive, and large files stay."""
+    assert archive.add_directory(1, "iter_1", iteration) == 2
+    assert archive.keys() == ["1"]
+    assert archive.files(1) == ["iteration.out", "step_1/energy.json"]
+    assert archive.read(1, "iteration.out") == b"output\n"
+    assert not (iteration / "iteration.out").exists()
+    assert not (iteration / "step_1" / "energy.json").exists()
+    assert (iteration / "step_1" / "large.dat").exists()
+
+
+def test_empty_directories_removed(archive, iteration):
+    (iteration / "step_1" / "large.dat").unlink()
+    archive.add_directory("a", "iter_1", iteration)
+    assert not iteration.exists()
+
+
+def test_missing_directory(archive, tmp_path):
+    assert archive.add_directory("a", "iter_9", tmp_path / "iter_9") == 0
+    assert archive.keys() == []
+
+
+def test_replace(archive, iteration):
+    """Archiving an iteration again replaces its files, e.g. when resuming."""
+    archive.add_directory("a", "iter_1", iteration)
+    iteration.mkdir(exist_ok=True)
+    (iteration / "new.out").write_text("new")
+    archive.add_directory("a", "iter_1", iteration)
+    assert archive.files("a") == ["new.out"]
+
+
+def test_symlinks_not_archived(archive, iteration):
+    os.symlink(iteration / "iteration.out", iteration / "link.out")
+    archive.add_directory("a", "iter_1", iteration)
+    assert "link.out" not in archive.files("a")
+    assert (iteration / "link.out").is_symlink()
+
+
+def test_read_missing(archive, iteration):
+    archive.add_directory("a", "iter_1", iteration)
+    with pytest.raises(KeyError):
+        archive.read("a", "missing.out")
+    with pytest.raises(KeyError):
+        archive.read("b", "iteration.out")
+
+
+def test_extract(archive, iteration, tmp_path):
+    archive.add_directory("a", "iter_1", iteration)
+    destination = tmp_path / "restored"
+    assert archive.extract("a", destination) == 2
+    assert (destination / "iteration.out").read_text() == "output\n"
+    assert (destination / "step_1" / "energy.json").read_text() == '{"energy": -1.0}'
+
+
+def test_reopen(tmp_path, iteration):
+    """The archive is kept on disk, and added to when opened again."""
+    path = tmp_path / OutputArchive.filename
+    archive = OutputArchive(path)
+    archive.add_directory("a", "iter_1", iteration)
+    archive.close()
+    archive.close()
+
+    archive = OutputArchive(path)
+    assert archive.keys() == ["a"]
+    assert len(archive.files("a")) == 3
+    archive.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for selecting configurations in `loop_step.system_query`."""
+
+import pytest
+
+from loop_step import system_query
+
+molsystem = pytest.importorskip("molsystem")
+
+
+@pytest.fixture
+def system_db():
+    """Three systems with two or three configurations each."""
+    system_db = molsystem.SystemDB(filename=":memory:")
+    for name, configurations in [
+        ("water", ["opt", "freq"]),
+        ("water dimer", ["opt", "freq", "scan"]),
+        ("methane", ["initial", "opt"]),
+    ]:
+        system = system_db.create_system(name)
+        for configuration in configurations:
+            system.create_configuration(configuration)
+    yield system_db
+    system_db.close()
+
+
+def names(system_db, ids):
+    """The system and configuration names for the configuration ids."""
+    result = []
+    for cid in ids:
+        configuration = system_db.get_configuration(cid)
+        result.append(f"{configuration.system.name}/{configuration.name}")
+    return result
+
+
+def select(system_db, *args):
+    return names(system_db, system_query.select_configuration_ids(system_db, *args))
+
+
+def test_all(system_db):
+    assert select(system_db, "is anything", "", "all") == [
+        "water/opt",
+        "water/freq",
+        "water dimer/opt",
+        "water dimer/freq",
+        "water dimer/scan",
+        "methane/initial",
+        "methane/opt",
+    ]
+
+
+@pytest.mark.parametrize(
+    "criterion, name, expected",
+    [
+        ("is", "water", ["water/freq"]),
+        ("is", "wat", []),
+        ("matches", "water*", ["water/freq", "water dimer/scan"]),
+        ("matches", "w?ter", ["water/freq"]),
+        ("matches", "*ane", ["methane/opt"]),
+        ("matches", "[mw]*r", ["water/freq", "water dimer/scan"]),
+        ("regexp", "^water$", ["water/freq"]),
+        ("regexp", "ane", ["methane/opt"]),
+    ],
+)
+def test_system_names(system_db, criterion, name, expected):
+    assert select(system_db, criterion, name, "last") == expected
+
+
+def test_matches_whole_name(system_db):
+    """Patterns match the whole name, unlike regular expressions."""
+    assert select(system_db, "matches", "water", "last") == ["water/freq"]
+    assert select(system_db, "regexp", "water", "last") == [
+        "water/freq",
+        "water dimer/scan",
+    ]
+
+
+@pytest.mark.parametrize(
+    "criterion, name, expected",
+    [
+        ("first", "", ["water/opt", "water dimer/opt", "methane/initial"]),
+        ("1", "", ["water/opt", "water dimer/opt", "methane/initial"]),
+        ("last", "", ["water/freq", "water dimer/scan", "methane/opt"]),
+        ("-1", "", ["water/freq", "water dimer/scan", "methane/opt"]),
+        ("name is", "opt", ["water/opt", "water dimer/opt", "methane/opt"]),
+        ("name matches", "*r*", ["water/freq", "water dimer/freq"]),
+        ("matches", "s*", ["water dimer/scan"]),
+        ("name regexp", "^(i|s)", ["water dimer/scan", "methane/initial"]),
+        ("regexp", "q$", ["water/freq", "water dimer/freq"]),
+    ],
+)
+def test_configurations(system_db, criterion, name, expected):
+    assert select(system_db, "is anything", "", criterion, name) == expected
+
+
+def test_combined(system_db):
+    assert select(system_db, "matches", "water*", "name is", "opt") == [
+        "water/opt",
+        "water dimer/opt",
+    ]
+
+
+def test_unsupported(system_db):
+    with pytest.raises(RuntimeError):
+        system_query.select_configuration_ids(system_db, "contains", "water")
+    with pytest.raises(RuntimeError):
+        system_query.select_configuration_ids(system_db, "is anything", "", "most")
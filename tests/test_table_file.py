@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for reading a table from a file in `loop_step.table_file`."""
+
+import numpy as np
+import pytest
+
+pandas = pytest.importorskip("pandas")
+
+from loop_step import table_query  # noqa: E402
+from loop_step.table_file import TableFile  # noqa: E402
+
+
+@pytest.fixture
+def table():
+    """A table with numerical and text columns."""
+    return pandas.DataFrame(
+        {
+            "Energy": [-1.0, 0.5, -2.5, 3.0, 0.0, -0.5, 1.5],
+            "n": [1, 2, 3, 4, 5, 6, 7],
+            "name": ["a", "b", "c", "d", "e", "f", "g"],
+        }
+    )
+
+
+@pytest.fixture(params=["csv", "parquet"])
+def path(request, table, tmp_path):
+    """The table in a CSV or Parquet file."""
+    if request.param == "csv":
+        path = tmp_path / "table.csv"
+        table.to_csv(path, index=False)
+    else:
+        pytest.importorskip("pyarrow")
+        path = tmp_path / "table.parquet"
+        table.to_parquet(path, index=False)
+    return path
+
+
+def test_rows(path):
+    rows = TableFile(path, chunk_size=3)
+    result = list(rows)
+    assert [index for index, row in result] == [0, 1, 2, 3, 4, 5, 6]
+    assert result[3][1] == {"Energy": 3.0, "n": 4, "name": "d"}
+    assert isinstance(result[3][1]["n"], np.integer)
+    assert rows.n_rows == 7
+    assert rows.length == 7
+
+
+def test_criteria(path):
+    """The rows are selected chunk by chunk, and numbered in the file."""
+    criteria = table_query.parse_criteria("energy < 0 or n == 7")
+    rows = TableFile(path, criteria=criteria, chunk_size=3)
+    assert rows.length is None
+    assert [index for index, row in rows] == [0, 2, 5, 6]
+    assert rows.length == 4
+
+
+def test_count(path):
+    criteria = table_query.parse_criteria("energy < 0")
+    rows = TableFile(path, criteria=criteria, chunk_size=3)
+    assert rows.count() == 3
+    assert rows.n_rows == 7
+    assert TableFile(path, chunk_size=3).count() == 7
+
+
+def test_columns(path):
+    """Only the columns asked for are in the rows, ignoring case."""
+    criteria = table_query.parse_criteria("name == c")
+    rows = TableFile(path, criteria=criteria, columns=["N", "energy"], chunk_size=3)
+    assert list(rows) == [(2, {"n": 3, "Energy": -2.5})]
+
+
+def test_columns_read(path, monkeypatch):
+    """Only the columns that are needed are read from the file."""
+    read = []
+    chunks = TableFile.chunks
+
+    def recording(self, columns=None):
+        for chunk in chunks(self, columns):
+            read.append([*chunk.columns])
+            yield chunk
+
+    monkeypatch.setattr(TableFile, "chunks", recording)
+    criteria = table_query.parse_criteria("energy < 0")
+    rows = TableFile(path, criteria=criteria, columns=["n"], chunk_size=4)
+    list(rows)
+    assert read == [["Energy", "n"], ["Energy", "n"]]
+
+    read.clear()
+    TableFile(path, criteria=criteria, columns=["n"], chunk_size=4).count()
+    assert read == [["Energy"], ["Energy"]]
+
+
+def test_unknown_column(path):
+    with pytest.raises(ValueError):
+        TableFile(path, columns=["mass"])
+    with pytest.raises(ValueError):
+        TableFile(path, criteria=table_query.parse_criteria("mass > 1"))
+
+
+def test_csv_not_read_to_count(tmp_path, table, monkeypatch):
+    """The rows of a CSV file are not counted when it is opened."""
+    path = tmp_path / "table.csv"
+    table.to_csv(path, index=False)
+    monkeypatch.setattr(TableFile, "chunks", None)
+    rows = TableFile(path)
+    assert rows.n_rows is None
+    assert rows.length is None
+
+
+def test_parquet_rows_from_metadata(tmp_path, table):
+    pytest.importorskip("pyarrow")
+    path = tmp_path / "table.parquet"
+    table.to_parquet(path, index=False)
+    rows = TableFile(path)
+    assert rows.n_rows == 7
+    assert rows.length == 7
+
+
+def test_csv_types_from_first_chunk(tmp_path):
+    """The types of the columns stay those of the first chunk."""
+    path = tmp_path / "table.csv"
+    path.write_text("n,code\n1,1\n2,2\n3,x3\n4,4\n")
+    rows = [row for index, row in TableFile(path, columns=["n"], chunk_size=2)]
+    assert [row["n"] for row in rows] == [1, 2, 3, 4]
+
+    with pytest.raises(ValueError, match="same types"):
+        list(TableFile(path, chunk_size=2))
+
+
+def test_csv_types_given(tmp_path):
+    path = tmp_path / "table.csv"
+    path.write_text("n,code\n1,1\n2,2\n3,x3\n4,4\n")
+    rows = TableFile(path, chunk_size=2, dtypes={"n": "int64", "code": str})
+    assert [row["code"] for index, row in rows] == ["1", "2", "x3", "4"]
+
+
+def test_compressed_csv(tmp_path, table):
+    path = tmp_path / "table.csv.gz"
+    table.to_csv(path, index=False)
+    assert len(list(TableFile(path, chunk_size=3))) == 7
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        TableFile(tmp_path / "table.xlsx")
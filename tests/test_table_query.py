@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for selecting the rows of a table in `loop_step.table_query`."""
+
+import numpy as np
+import pytest
+
+pandas = pytest.importorskip("pandas")
+
+from loop_step import table_query  # noqa: E402
+
+
+@pytest.fixture
+def table():
+    """A small table with numerical, boolean and text columns."""
+    return pandas.DataFrame(
+        {
+            "Energy": [-1.0, 0.5, -2.5, 3.0, 0.0, -0.5],
+            "n": [1, 2, 3, 4, 5, 6],
+            "converged": [True, False, True, True, False, True],
+            "name": ["water", "methane", "ethane", "water dimer", "", None],
+        }
+    )
+
+
+@pytest.fixture(params=["masks", "numexpr"])
+def path(request, monkeypatch):
+    """Evaluate the criteria both with numexpr and by combining masks."""
+    if request.param == "numexpr":
+        pytest.importorskip("numexpr")
+        monkeypatch.setattr(table_query, "have_numexpr", True)
+    else:
+        monkeypatch.setattr(table_query, "have_numexpr", False)
+    return request.param
+
+
+def selected(table, text):
+    """The positions of the rows matching the criteria."""
+    criteria = table_query.parse_criteria(text)
+    return table_query.criteria_mask(table, criteria).nonzero()[0].tolist()
+
+
+def test_parse_single():
+    assert table_query.parse_criteria("energy < 0") == [("and", "energy", "<", "0", "")]
+
+
+def test_parse_equals():
+    """'=' is the same as '=='."""
+    assert table_query.parse_criteria("n = 3") == [("and", "n", "==", "3", "")]
+
+
+def test_parse_connectors():
+    assert table_query.parse_criteria("energy < 0 and n >= 2 OR name == water") == [
+        ("and", "energy", "<", "0", ""),
+        ("and", "n", ">=", "2", ""),
+        ("or", "name", "==", "water", ""),
+    ]
+
+
+def test_parse_multiword_operators():
+    assert table_query.parse_criteria(
+        "name does not contain regexp '^w' and name is not empty"
+    ) == [
+        ("and", "name", "does not contain regexp", "^w", ""),
+        ("and", "name", "is not empty", "", ""),
+    ]
+
+
+def test_parse_between():
+    expected = [("and", "energy", "between", "-1", "1")]
+    assert table_query.parse_criteria("energy between -1 and 1") == expected
+    assert table_query.parse_criteria("energy between -1 1") == expected
+
+
+def test_parse_quoted():
+    assert table_query.parse_criteria("'total energy' > 1 and name == 'a b'") == [
+        ("and", "total energy", ">", "1", ""),
+        ("and", "name", "==", "a b", ""),
+    ]
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["energy", "energy <", "energy between 1 and", "energy ~ 1", "n < 1 xor n > 2"],
+)
+def test_parse_errors(text):
+    with pytest.raises(ValueError):
+        table_query.parse_criteria(text)
+
+
+def test_single_criterion(table, path):
+    assert selected(table, "energy < 0") == [0, 2, 5]
+
+
+def test_and(table, path):
+    assert selected(table, "energy < 0 and n > 1") == [2, 5]
+
+
+def test_or(table, path):
+    assert selected(table, "n == 1 or n == 4") == [0, 3]
+
+
+def test_and_before_or(table, path):
+    """'a or b and c' is 'a or (b and c)', not '(a or b) and c'."""
+    assert selected(table, "n == 1 or energy < 0 and n > 5") == [0, 5]
+    assert selected(table, "energy < 0 and n > 5 or n == 1") == [0, 5]
+
+
+def test_between(table, path):
+    assert selected(table, "energy between -1 and 0.5") == [0, 1, 4, 5]
+
+
+def test_between_or(table, path):
+    assert selected(table, "energy between -1 and 0 or n >= 6") == [0, 4, 5]
+
+
+def test_paths_agree(table, monkeypatch):
+    """numexpr and the combined masks select the same rows."""
+    pytest.importorskip("numexpr")
+    text = "energy >= -1 and n != 3 or energy between 2 4 and n < 5"
+    monkeypatch.setattr(table_query, "have_numexpr", False)
+    masks = selected(table, text)
+    monkeypatch.setattr(table_query, "have_numexpr", True)
+    assert selected(table, text) == masks
+
+
+def test_text_criteria(table, path):
+    """Text operators are evaluated with masks, even alongside numbers."""
+    assert selected(table, "name contains water and energy < 0") == [0]
+    assert selected(table, "name is empty or n == 2") == [1, 4, 5]
+
+
+def test_boolean(table, path):
+    assert selected(table, "converged == true and n > 3") == [3, 5]
+
+
+def test_no_criteria(table):
+    mask = table_query.criteria_mask(table, [])
+    assert mask.dtype == bool
+    assert mask.all()
+
+
+def test_column_case(table, path):
+    assert selected(table, "ENERGY > 1") == [3]
+
+
+def test_unknown_column(table, path):
+    with pytest.raises(ValueError):
+        selected(table, "mass > 1 and n > 1")
+
+
+def test_select_rows_matching(table):
+    table.index = [f"r{i}" for i in range(table.shape[0])]
+    indices = table_query.select_rows_matching(table, "energy < 0 and n > 1")
+    assert list(indices) == ["r2", "r5"]
+
+
+def test_mask_is_array(table, path):
+    mask = table_query.criteria_mask(
+        table, table_query.parse_criteria("energy < 0 or n > 5")
+    )
+    assert isinstance(mask, np.ndarray)
+    assert mask.tolist() == [True, False, True, False, False, True]
+
+
+def test_cached_selection(table):
+    """Text matching is only done again if the table has changed."""
+    calls = []
+
+    def select():
+        calls.append(1)
+        return table_query.select_rows_matching(table, [*criteria])
+
+    criteria = tuple(table_query.parse_criteria("name contains water and n < 5"))
+    first = table_query.cached_selection(table, criteria, select)
+    assert list(first) == [0, 3]
+    assert table_query.cached_selection(table, criteria, select) is first
+    assert len(calls) == 1
+
+    # Values changed in place, in text and numerical columns
+    table.loc[1, "name"] = "waterfall"
+    second = table_query.cached_selection(table, criteria, select)
+    assert list(second) == [0, 1, 3]
+    table.loc[0, "n"] = 6
+    assert list(table_query.cached_selection(table, criteria, select)) == [1, 3]
+    assert len(calls) == 3
+
+    # A change to a column not in the criteria
+    table.loc[0, "Energy"] = 10.0
+    table_query.cached_selection(table, criteria, select)
+    assert len(calls) == 3
+
+    # A new column, and a new index
+    table["extra"] = 0
+    table_query.cached_selection(table, criteria, select)
+    assert len(calls) == 4
+    table.index = [f"r{i}" for i in range(table.shape[0])]
+    assert list(table_query.cached_selection(table, criteria, select)) == ["r1", "r3"]
+    assert len(calls) == 5
+
+    # Another table with the same criteria
+    other = table.copy()
+    table_query.cached_selection(other, criteria, select)
+    assert len(calls) == 6
+
+
+def test_numerical_selection_not_cached(table):
+    """Criteria that are quick to evaluate are not cached."""
+    calls = []
+
+    def select():
+        calls.append(1)
+        return table_query.select_rows_matching(table, "energy < 0")
+
+    criteria = tuple(table_query.parse_criteria("energy < 0"))
+    table_query.cached_selection(table, criteria, select)
+    table_query.cached_selection(table, criteria, select)
+    assert len(calls) == 2
+
+
+def test_fingerprint(table):
+    before = table_query.fingerprint(table, ["name"])
+    assert table_query.fingerprint(table, ["NAME"]) == before
+    table.loc[2, "name"] = "propane"
+    assert table_query.fingerprint(table, ["name"]) != before
+
+
+# The column, operator, values and selected rows, covering every operator
+operator_cases = [
+    ("n", "==", "3", "", [2]),
+    ("n", "!=", "3", "", [0, 1, 3, 4, 5]),
+    ("energy", ">", "0", "", [1, 3]),
+    ("energy", ">=", "0", "", [1, 3, 4]),
+    ("energy", "<", "-0.5", "", [0, 2]),
+    ("energy", "<=", "-0.5", "", [0, 2, 5]),
+    ("energy", "between", "-1", "0", [0, 4, 5]),
+    ("name", "==", "water", "", [0]),
+    ("name", "!=", "water", "", [1, 2, 3, 4, 5]),
+    ("name", "contains", "ethane", "", [1, 2]),
+    ("name", "does not contain", "ethane", "", [0, 3, 4, 5]),
+    ("name", "contains regexp", r"^wat\w+$", "", [0]),
+    ("name", "does not contain regexp", "^w", "", [1, 2, 4, 5]),
+    ("name", "is empty", "", "", [4, 5]),
+    ("name", "is not empty", "", "", [0, 1, 2, 3]),
+    ("energy", "is empty", "", "", []),
+    ("n", "contains", "1", "", [0]),
+    ("converged", "==", "yes", "", [0, 2, 3, 5]),
+    ("converged", "!=", "True", "", [1, 4]),
+    ("n", ">", 4, "", [4, 5]),
+    ("n", "between", "2", "4", [1, 2, 3]),
+]
+
+
+@pytest.mark.parametrize("column, op, value, value2, expected", operator_cases)
+def test_criterion(table, column, op, value, value2, expected):
+    """Every operator, for numerical, boolean and text columns."""
+    mask = table_query.criterion_mask(table, column, op, value, value2)
+    assert isinstance(mask, np.ndarray)
+    assert mask.nonzero()[0].tolist() == expected
+
+
+def test_every_operator_tested():
+    """The test above covers all the operators."""
+    tested = {case[1] for case in operator_cases}
+    assert tested == set(table_query.operators)
+
+
+def test_coerce_value(table):
+    assert table_query.coerce_value(table["n"], "3") == 3
+    assert isinstance(table_query.coerce_value(table["n"], "3"), np.integer)
+    assert table_query.coerce_value(table["Energy"], "-0.5") == -0.5
+    assert table_query.coerce_value(table["converged"], "Yes") is True
+    assert table_query.coerce_value(table["converged"], "no") is False
+    # Values that cannot be converted are left alone
+    assert table_query.coerce_value(table["n"], "many") == "many"
+
+
+def test_unknown_operator(table):
+    with pytest.raises(NotImplementedError):
+        table_query.criterion_mask(table, "n", "~", "1")